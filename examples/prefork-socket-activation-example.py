@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+#
+# A server which takes its sockets from a supervisor, under the systemd
+# socket activation protocol, instead of binding them.  Run it from a
+# systemd .socket unit, or locally with the launcher in this directory:
+#
+#     ./socket-activate.py -l tcp://127.0.0.1:10000 --restart -- \
+#         ./prefork-socket-activation-example.py
+#
+# Run on its own, nothing is passed in, so it binds tcp://127.0.0.1:10000
+# itself.
+#
+
+import preforkserver as pfs
+import os
+
+
+class EchoChild(pfs.BaseChild):
+    def process_request(self):
+        data = self.conn.recv(4096)
+        self.conn.sendall(b'[' + str(os.getpid()).encode('utf-8') +
+            b'] ' + data)
+
+
+def main():
+    manager = pfs.Manager(EchoChild, listen_fds=True,
+        listeners=['tcp://127.0.0.1:10000'])
+    print('Serving on %s' % ', '.join(str(l) for l in manager.listeners))
+    manager.run()
+
+
+if __name__ == '__main__':
+    main()
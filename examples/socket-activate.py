@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+#
+# A tiny stand-in for systemd socket activation, for trying out a Manager
+# with listen_fds=True without installing any units.  This binds the
+# sockets itself, then runs the command with them as file descriptors 3
+# and up, and LISTEN_FDS and LISTEN_PID set, just like systemd does.
+#
+#     ./socket-activate.py -l tcp://127.0.0.1:10000 -l unix:///tmp/pf.sock \
+#         --lazy --restart -- ./prefork-socket-activation-example.py
+#
+# With --lazy, the command isn't started until the first connection
+# comes in.  With --restart, it is started again whenever it exits, and
+# since the sockets stay open here, connections made while it is down
+# just wait in the queue rather than being refused.  SIGTERM and SIGINT
+# are passed on to the command, and stop the launcher.
+#
+
+from preforkserver.listeners import parse_listener, bind_listener, \
+    unlink_listener
+from preforkserver.tuning import default_backlog
+import argparse
+import select
+import signal
+import time
+import sys
+import os
+
+stopping = False
+child_pid = None
+
+
+def get_args():
+    p = argparse.ArgumentParser(description='Run a command with sockets '
+        'passed in the way systemd socket activation does')
+    p.add_argument('-l', '--listen', action='append', required=True,
+        help='A listener to bind, like tcp://127.0.0.1:10000.  This can '
+        'be given more than once')
+    p.add_argument('--lazy', action='store_true', default=False,
+        help='Wait for the first connection before starting the command')
+    p.add_argument('--restart', action='store_true', default=False,
+        help='Start the command again whenever it exits')
+    p.add_argument('command', nargs=argparse.REMAINDER,
+        help='The command to run, after --')
+    args = p.parse_args()
+    if args.command and args.command[0] == '--':
+        args.command = args.command[1:]
+    if not args.command:
+        p.error('No command given')
+    return args
+
+
+def on_signal(num, frame):
+    global stopping
+    stopping = True
+    if child_pid:
+        try:
+            os.kill(child_pid, num)
+        except OSError:
+            pass
+
+
+def wait_for_connection(socks):
+    """
+    Block until one of the sockets has something waiting.  Returns False
+    if we were told to stop first
+    """
+    while not stopping:
+        try:
+            ready = select.select(socks, [], [], 1)[0]
+        except (OSError, select.error):
+            continue
+        if ready:
+            return True
+    return False
+
+
+def spawn(socks, command):
+    pid = os.fork()
+    if pid:
+        return pid
+    # Move the sockets out of the way first, so that putting them at
+    # 3, 4, ... doesn't clobber one that is already there
+    fds = [ os.dup(s.fileno()) for s in socks ]
+    for i, fd in enumerate(fds):
+        if fd != 3 + i:
+            os.dup2(fd, 3 + i)
+            os.close(fd)
+        else:
+            # dup() happened to land on the right number already, so this
+            # is the one being passed.  It must stay open, and unlike one
+            # from dup2(), it isn't inherited by default
+            os.set_inheritable(fd, True)
+    env = dict(os.environ)
+    env['LISTEN_FDS'] = str(len(socks))
+    env['LISTEN_PID'] = str(os.getpid())
+    env['LISTEN_FDNAMES'] = ':'.join(str(i) for i in range(len(socks)))
+    try:
+        os.execvpe(command[0], command, env)
+    except OSError as e:
+        sys.stderr.write('Failed to run %s: %s\n' % (command[0], e))
+        os._exit(127)
+
+
+def main():
+    global child_pid
+    args = get_args()
+    specs = [ parse_listener(l) for l in args.listen ]
+    socks = [ bind_listener(spec, default_backlog()) for spec in specs ]
+    for l in args.listen:
+        print('Listening on %s' % l)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    status = 0
+    while not stopping:
+        if args.lazy and not wait_for_connection(socks):
+            break
+        child_pid = spawn(socks, args.command)
+        print('Started %s as %d' % (args.command[0], child_pid))
+        while True:
+            try:
+                pid, status = os.waitpid(child_pid, 0)
+                break
+            except InterruptedError:
+                continue
+        child_pid = None
+        print('%s exited with status %d' % (args.command[0], status >> 8))
+        if not args.restart:
+            break
+        time.sleep(1)
+    for spec, s in zip(specs, socks):
+        s.close()
+        unlink_listener(spec)
+    sys.exit(status >> 8)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Pool limits sized from the container the server runs in.  Rather than
+# fixed numbers, the Manager's limits are worked out from the cgroup v2
+# CPU quota and memory limit, the memory the children actually use, and
+# the memory pressure, and kept up to date as those change:
+#
+#     manager = Manager(MyChild, max_servers=20, min_servers=5,
+#         min_spare_servers=2, max_spare_servers=10,
+#         autosize=CgroupAutoSizer(children_per_cpu=4))
+#
+# max_servers becomes the smaller of:
+#
+#   - children_per_cpu times the CPU quota (cpu.max), or the CPUs this
+#     process may run on if there is no quota
+#   - what fits in memory.max, less memory_headroom, at the measured
+#     proportional set size (PSS) of a child
+#
+# While memory.pressure ("some" avg10) is over pressure_high, that is cut
+# down a step at a time, and it comes back once the pressure is under
+# pressure_low.  The other limits keep the same ratios to max_servers as
+# the ones given to the Manager.  When the limits drop, idle children
+# over the new max_servers are killed.
+#
+# The first sizing happens in the Manager, before there are any children
+# to measure, so memory.max can't be taken into account yet.  Until it
+# can, max_servers is also capped at the value given to the Manager, so
+# set that to what is safe to start with.
+#
+# Without cgroup v2, the host's CPUs and memory are used and there is no
+# pressure signal.
+#
+
+import math
+import time
+import os
+
+__all__ = ['CgroupAutoSizer', 'cgroup_dir']
+
+
+def cgroup_dir():
+    """
+    Returns the cgroup v2 directory of this process, or None
+    """
+    mount = None
+    try:
+        with open('/proc/self/mounts') as fh:
+            for line in fh:
+                parts = line.split()
+                if len(parts) > 2 and parts[2] == 'cgroup2':
+                    mount = parts[1]
+                    break
+        if mount is None:
+            return None
+        with open('/proc/self/cgroup') as fh:
+            for line in fh:
+                if line.startswith('0::'):
+                    path = os.path.join(mount,
+                        line[3:].strip().lstrip('/'))
+                    return path if os.path.isdir(path) else None
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _read(path):
+    try:
+        with open(path) as fh:
+            return fh.read()
+    except (IOError, OSError):
+        return None
+
+
+def _host_memory():
+    text = _read('/proc/meminfo') or ''
+    for line in text.splitlines():
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def _pss(pid):
+    """
+    Returns the proportional set size of pid in bytes, which splits the
+    pages shared with the manager and the other children fairly, or the
+    RSS if that isn't available
+    """
+    text = _read('/proc/%d/smaps_rollup' % pid)
+    if text:
+        for line in text.splitlines():
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) * 1024
+    text = _read('/proc/%d/statm' % pid)
+    if text:
+        return int(text.split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return None
+
+
+class CgroupAutoSizer(object):
+    """
+    Keeps the Manager's pool limits in line with the container's CPU
+    and memory.  Pass this to the Manager as autosize
+    """
+
+    def __init__(self, children_per_cpu=4, memory_headroom=0.1,
+            pressure_high=10.0, pressure_low=2.0, pressure_step=0.1,
+            interval=5.0, floor=1, ceiling=None, sample_size=16, path=None):
+        """
+        children_per_cpu:float  Children per CPU of quota
+        memory_headroom:float   The fraction of memory.max kept free
+        pressure_high:float     Shrink the pool while the "some" avg10 of
+                                memory.pressure, in percent, is over this
+        pressure_low:float      Grow it back while under this
+        pressure_step:float     The fraction to shrink or grow by each
+                                interval
+        interval:float          Seconds between adjustments
+        floor:int               Never go below this many max_servers
+        ceiling:int             Never go above this many, if set
+        sample_size:int         The number of children to measure
+        path:str                The cgroup directory.  This is found
+                                from /proc by default
+        """
+        self.children_per_cpu = float(children_per_cpu)
+        self.memory_headroom = float(memory_headroom)
+        self.pressure_high = float(pressure_high)
+        self.pressure_low = float(pressure_low)
+        self.pressure_step = float(pressure_step)
+        self.interval = float(interval)
+        self.floor = max(1, int(floor))
+        self.ceiling = ceiling
+        self.sample_size = int(sample_size)
+        self.path = path if path is not None else cgroup_dir()
+        # The fraction of the container this manager sizes for.  Each
+        # shard of a ShardedManager gets an equal part
+        self.share = 1.0
+        # The limits given to the Manager, as ratios of max_servers, and
+        # max_servers itself
+        self._ratios = None
+        self._configured = None
+        self._scale = 1.0
+        self._next = 0
+        # The inputs and result of the last adjustment
+        self.cpus = None
+        self.memory_limit = None
+        self.child_pss = None
+        self.pressure = None
+        self.max_servers = None
+
+    def _file(self, name):
+        if self.path is None:
+            return None
+        return _read(os.path.join(self.path, name))
+
+    def read_cpus(self):
+        """
+        Returns the CPU quota as a number of CPUs
+        """
+        text = self._file('cpu.max')
+        if text:
+            quota, period = (text.split() + ['100000'])[:2]
+            if quota != 'max':
+                return float(quota) / float(period)
+        try:
+            return float(len(os.sched_getaffinity(0)))
+        except (AttributeError, OSError):
+            return float(os.cpu_count() or 1)
+
+    def read_memory_limit(self):
+        """
+        Returns memory.max in bytes, or the host's memory if unlimited
+        """
+        text = self._file('memory.max')
+        if text and text.strip() != 'max':
+            return int(text)
+        return _host_memory()
+
+    def read_pressure(self):
+        """
+        Returns the "some" avg10 of memory.pressure, or None
+        """
+        text = self._file('memory.pressure')
+        if not text:
+            return None
+        for line in text.splitlines():
+            if line.startswith('some'):
+                for field in line.split()[1:]:
+                    key, val = field.split('=')
+                    if key == 'avg10':
+                        return float(val)
+        return None
+
+    def measure_children(self, pids):
+        """
+        Returns the average PSS, in bytes, of up to sample_size of pids
+        """
+        sizes = [ size for size in (_pss(pid)
+            for pid in pids[:self.sample_size]) if size ]
+        if not sizes:
+            return None
+        return sum(sizes) / len(sizes)
+
+    def compute(self, cpus, memory_limit, child_pss, pressure, own_rss=0):
+        """
+        Returns max_servers for the given inputs and updates the pressure
+        scaling
+        """
+        limit = int(math.ceil(cpus * self.children_per_cpu * self.share))
+        if memory_limit and child_pss:
+            budget = memory_limit * (1 - self.memory_headroom) * \
+                self.share - own_rss
+            limit = min(limit, int(budget // child_pss))
+        if pressure is not None:
+            if pressure > self.pressure_high:
+                self._scale = max(self.pressure_step,
+                    self._scale * (1 - self.pressure_step))
+            elif pressure < self.pressure_low:
+                self._scale = min(1.0, self._scale + self.pressure_step)
+        limit = int(limit * self._scale)
+        if self.ceiling is not None:
+            limit = min(limit, int(self.ceiling))
+        return max(self.floor, limit)
+
+    def adjust(self, manager, pids=None):
+        """
+        Work out new limits and set them on the manager.  Returns True if
+        they changed
+
+        manager:Manager     The manager to adjust
+        pids:list           The children to measure.  This defaults to
+                            all of the manager's children
+        """
+        if self._ratios is None:
+            top = float(manager.max_servers)
+            self._ratios = (manager.min_servers / top,
+                manager.min_spares / top, manager.max_spares / top)
+            self._configured = manager.max_servers
+        if pids is None:
+            pids = [ ch.pid for ch in manager._children.values() ]
+        self.cpus = self.read_cpus()
+        self.memory_limit = self.read_memory_limit()
+        if pids:
+            pss = self.measure_children(pids)
+            if pss:
+                self.child_pss = pss
+        self.pressure = self.read_pressure()
+        new_max = self.compute(self.cpus, self.memory_limit,
+            self.child_pss, self.pressure, _pss(os.getpid()) or 0)
+        if self.child_pss is None:
+            # Without a child to measure, the memory limit can't be
+            # worked out, so don't go past what we were given
+            new_max = max(self.floor, min(new_max,
+                int(math.ceil(self._configured * self.share))))
+        self.max_servers = new_max
+        min_servers = min(new_max, max(1,
+            int(round(new_max * self._ratios[0]))))
+        min_spares = int(round(new_max * self._ratios[1]))
+        max_spares = max(min_spares, int(round(new_max * self._ratios[2])))
+        limits = (new_max, min_servers, min_spares, max_spares)
+        old = (manager.max_servers, manager.min_servers, manager.min_spares,
+            manager.max_spares)
+        if limits == old:
+            return False
+        (manager.max_servers, manager.min_servers, manager.min_spares,
+            manager.max_spares) = limits
+        return True
+
+    def maybe_adjust(self, manager):
+        """
+        Called from the manager loop.  Adjust if it is time
+        """
+        now = time.time()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        return self.adjust(manager)
@@ -0,0 +1,397 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Traffic capture and replay.  Mix CaptureMixin into your child class to
+# record a sample of the request payloads, along with their timing, to a
+# compact append-only file:
+#
+#     class MyChild(CaptureMixin, BaseChild):
+#         capture_file = '/var/tmp/myserver.cap'
+#         capture_sample_rate = 0.05
+#
+# The file can then be replayed against a test server with replay(), or
+# from the command line:
+#
+#     python -m preforkserver.capture replay myserver.cap 127.0.0.1 10000
+#     python -m preforkserver.capture replay myserver.cap unix:///run/app.sock
+#
+# File format: a magic header, then one record per captured request.  A
+# record is a header (length of the rest of the record, start time,
+# duration in microseconds, protocol and number of chunks) followed by
+# the chunks.  Each chunk is the offset in microseconds from the start of
+# the request, the length, and the raw bytes the client sent.
+#
+
+from preforkserver.listeners import ListenerSpec, parse_listener
+from preforkserver.sockwrap import SocketWrapper
+from collections import namedtuple
+import threading
+import argparse
+import random
+import socket
+import struct
+import time
+import sys
+import os
+
+__all__ = ['CaptureMixin', 'CaptureWriter', 'read_capture', 'replay',
+    'Record']
+
+MAGIC = b'PFSCAP01'
+_REC_HDR = struct.Struct('<IdIBH')
+_CHUNK_HDR = struct.Struct('<II')
+_PROTOS = {'tcp': 0, 'udp': 1}
+_REV_PROTOS = dict([ (v, k) for k, v in _PROTOS.items() ])
+
+# start:float           The epoch time the request was accepted
+# duration:float        Seconds from accept to the end of the request
+# protocol:str          tcp or udp
+# chunks:list           A list of (offset, data) tuples, where offset is
+#                       the seconds from the start of the request
+Record = namedtuple('Record', ['start', 'duration', 'protocol', 'chunks'])
+
+
+class CaptureWriter(object):
+    """
+    Appends records to a capture file.  Each record goes out in a single
+    O_APPEND write, so all the children can safely share the same file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _open(self):
+        self._pid = os.getpid()
+        if not os.path.exists(self.path):
+            self._create()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644)
+
+    def _create(self):
+        """
+        Create the file with its header.  Every child can get here at
+        once, so the header is written to a temporary file which is then
+        linked into place.  Whoever loses the race to link just appends
+        to the winner's file
+        """
+        tmp = '%s.%d.tmp' % (self.path, self._pid)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, MAGIC)
+        finally:
+            os.close(fd)
+        try:
+            os.link(tmp, self.path)
+        except OSError:
+            pass
+        finally:
+            os.unlink(tmp)
+
+    def write(self, start, duration, protocol, chunks):
+        """
+        start:float         The epoch start time of the request
+        duration:float      The duration of the request in seconds
+        protocol:str        tcp or udp
+        chunks:list         A list of (offset_seconds, bytes) tuples
+        """
+        if self._pid != os.getpid():
+            self._open()
+        parts = []
+        for offset, data in chunks:
+            parts.append(_CHUNK_HDR.pack(int(offset * 1e6), len(data)))
+            parts.append(bytes(data))
+        body = b''.join(parts)
+        hdr = _REC_HDR.pack(_REC_HDR.size - 4 + len(body), start,
+            int(duration * 1e6), _PROTOS[protocol], len(chunks))
+        os.write(self._fd, hdr + body)
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+
+def read_capture(path):
+    """
+    Generator yielding a Record for each request in the capture file
+    """
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        while True:
+            hdr = fh.read(_REC_HDR.size)
+            if len(hdr) < _REC_HDR.size:
+                return
+            length, start, duration, proto, nchunks = _REC_HDR.unpack(hdr)
+            body = fh.read(length - (_REC_HDR.size - 4))
+            chunks = []
+            pos = 0
+            for i in range(nchunks):
+                offset, size = _CHUNK_HDR.unpack_from(body, pos)
+                pos += _CHUNK_HDR.size
+                chunks.append((offset / 1e6, body[pos:pos + size]))
+                pos += size
+            yield Record(start, duration / 1e6, _REV_PROTOS[proto], chunks)
+
+
+class _RecordingSocket(SocketWrapper):
+    """
+    Wraps the accepted socket and records everything received on it
+    """
+
+    def __init__(self, sock, capture):
+        SocketWrapper.__init__(self, sock)
+        self._capture = capture
+
+    def recv(self, bufsize, flags=0):
+        data = self._sock.recv(bufsize, flags)
+        self._capture.add(data)
+        return data
+
+    def recv_into(self, buf, nbytes=0, flags=0):
+        n = self._sock.recv_into(buf, nbytes, flags)
+        self._capture.add(memoryview(buf)[:n])
+        return n
+
+    def recvfrom(self, bufsize, flags=0):
+        data, addr = self._sock.recvfrom(bufsize, flags)
+        self._capture.add(data)
+        return data, addr
+
+
+class _Capture(object):
+    """
+    Collects the chunks for a single request
+    """
+
+    def __init__(self, max_bytes):
+        self.start = time.time()
+        self.chunks = []
+        self.remaining = max_bytes
+
+    def add(self, data):
+        if not data or self.remaining <= 0:
+            return
+        data = bytes(data[:self.remaining])
+        self.remaining -= len(data)
+        self.chunks.append((time.time() - self.start, data))
+
+
+class CaptureMixin(object):
+    """
+    Mix this in ahead of BaseChild to record a sample of the requests
+    to capture_file.  For tcp, everything received on self.conn is
+    recorded.  For udp, the payload is recorded
+    """
+    # The file to append the captured requests to
+    capture_file = None
+    # The fraction of requests to capture
+    capture_sample_rate = 1.0
+    # The maximum number of request bytes to keep per request
+    capture_max_bytes = 65536
+
+    _capture = None
+    _capture_writer = None
+
+    def _setup_conn(self):
+        super(CaptureMixin, self)._setup_conn()
+        if not self.capture_file or \
+                random.random() >= self.capture_sample_rate:
+            self._capture = None
+            return
+        if self._capture_writer is None:
+            self._capture_writer = CaptureWriter(self.capture_file)
+        self._capture = _Capture(self.capture_max_bytes)
+        if self.protocol == 'tcp':
+            self.conn = _RecordingSocket(self.conn, self._capture)
+        else:
+            self._capture.add(self.conn)
+
+    def _teardown_conn(self):
+        cap = self._capture
+        if cap is not None:
+            self._capture = None
+            self._capture_writer.write(cap.start, time.time() - cap.start,
+                self.protocol, cap.chunks)
+        super(CaptureMixin, self)._teardown_conn()
+
+
+class _ReplayStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.errors = 0
+        self.latencies = []
+
+    def add(self, latency=None, error=False):
+        with self.lock:
+            self.sent += 1
+            if error:
+                self.errors += 1
+            else:
+                self.latencies.append(latency)
+
+    def summary(self):
+        lats = sorted(self.latencies)
+        ret = {'sent': self.sent, 'errors': self.errors}
+        for name, pct in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            ret[name] = lats[min(int(len(lats) * pct), len(lats) - 1)] \
+                if lats else None
+        ret['max'] = lats[-1] if lats else None
+        return ret
+
+
+def _target(address):
+    """
+    Returns the address family and socket address for a replay target
+    """
+    if isinstance(address, (str, ListenerSpec)):
+        spec = parse_listener(address)
+        return spec.family, spec.address
+    host, port = address[:2]
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return family, (host, int(port))
+
+
+def _replay_one(rec, family, address, speed, timeout, stats):
+    t0 = time.time()
+    try:
+        if rec.protocol == 'tcp':
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(address)
+                for offset, data in rec.chunks:
+                    delay = t0 + offset / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+                while sock.recv(65536):
+                    pass
+            finally:
+                sock.close()
+        else:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            try:
+                for offset, data in rec.chunks:
+                    sock.sendto(data, address)
+            finally:
+                sock.close()
+    except (socket.error, socket.timeout):
+        stats.add(error=True)
+        return
+    stats.add(time.time() - t0)
+
+
+def replay(path, address, speed=1.0, concurrency=256, timeout=10.0):
+    """
+    Replay a capture file against address, preserving the original
+    arrival times and the timing between chunks, scaled by speed.
+    Returns a dict with the number sent, errors and latency percentiles
+
+    path:str            The capture file
+    address:tuple       The (ip, port) of the server to replay against,
+                        or a listener spec like unix:///run/app.sock or
+                        udp://[::1]:10000.  The protocol of each request
+                        is the one it was captured with
+    speed:float         The replay speed.  1.0 is real time and 2.0 is
+                        twice as fast.  0 replays as fast as possible
+    concurrency:int     The maximum number of requests in flight
+    timeout:float       The socket timeout for each request
+    """
+    family, address = _target(address)
+    stats = _ReplayStats()
+    slots = threading.Semaphore(concurrency)
+    threads = []
+    first = None
+    t0 = time.time()
+
+    def run(rec):
+        try:
+            _replay_one(rec, family, address, speed or 1e9, timeout,
+                stats)
+        finally:
+            slots.release()
+
+    for rec in read_capture(path):
+        if first is None:
+            first = rec.start
+        if speed:
+            delay = t0 + (rec.start - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        slots.acquire()
+        t = threading.Thread(target=run, args=(rec,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+        threads = [ t for t in threads if t.is_alive() ]
+    for t in threads:
+        t.join()
+    ret = stats.summary()
+    ret['elapsed'] = time.time() - t0
+    return ret
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Inspect or replay a '
+        'preforkserver capture file')
+    sub = p.add_subparsers(dest='cmd')
+    d = sub.add_parser('dump', help='Print a summary of each record')
+    d.add_argument('path')
+    r = sub.add_parser('replay', help='Replay a capture against a server')
+    r.add_argument('path')
+    r.add_argument('host', help='The host, or a listener spec like '
+        'unix:///run/app.sock')
+    r.add_argument('port', type=int, nargs='?')
+    r.add_argument('-s', '--speed', type=float, default=1.0,
+        help='Replay speed multiplier, 0 for as fast as possible '
+        '[default: %(default)s]')
+    r.add_argument('-c', '--concurrency', type=int, default=256,
+        help='Maximum requests in flight [default: %(default)s]')
+    r.add_argument('-t', '--timeout', type=float, default=10.0,
+        help='Per request socket timeout [default: %(default)s]')
+    args = p.parse_args(argv)
+
+    if args.cmd == 'dump':
+        for rec in read_capture(args.path):
+            print('%.6f %s dur=%.6f chunks=%d bytes=%d' % (rec.start,
+                rec.protocol, rec.duration, len(rec.chunks),
+                sum([ len(c[1]) for c in rec.chunks ])))
+    elif args.cmd == 'replay':
+        target = args.host if args.port is None \
+            else (args.host, args.port)
+        res = replay(args.path, target, args.speed, args.concurrency,
+            args.timeout)
+        for key in ('sent', 'errors', 'elapsed', 'p50', 'p90', 'p99', 'max'):
+            print('%s: %s' % (key, res[key]))
+    else:
+        p.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,13 +20,27 @@
 
 import preforkserver.events as pfe
 from preforkserver.poller import get_poller
-from time import sleep
+from preforkserver.tracing import NULL_TRACE
+from preforkserver.sockstats import tcp_info_queue, tcp_info_queued
+from preforkserver.deadline import DeadlineSocket
+from preforkserver.writer import ResponseWriter
+from preforkserver.reader import BufferPool, RequestReader
+from preforkserver.exceptions import ClientTimeout, ReadLimitError, \
+    TLSHandshakeError
+from preforkserver.listeners import bind_listener, spec_for_socket
+from time import sleep, time
+import logging
 import socket
 import select
 import os
 
 __all__ = ['BaseChild']
 
+# Seconds a draining child's queues must stay empty before it exits.  New
+# connections already stop coming once it gives up its steering seat, so
+# this only covers handshakes that were under way at that point
+_DRAIN_QUIET = 0.5
+
 
 class BaseChild(object):
     """
@@ -37,8 +51,11 @@ class BaseChild(object):
     def __init__(self, max_requests, child_conn, protocol ,
             server_socket=None, manager=None, args=None, kwargs=None):
         """
-        Initialize the passed in child info and call the initialize() hook
+        Initialize the passed in child info and call the initialize() and
+        warmup() hooks.  If reuse_port is set, the socket is bound only
+        after those have completed
         """
+        self._child_conn = child_conn
         # Add handling here for SO_REUSEPORT.  server_socket will be None
         # if we can reuse port
         if not server_socket:
@@ -51,59 +68,263 @@ class BaseChild(object):
                     'manager object.  One must be set.  Cannot start child '
                     'process')
                 os._exit(1)
-            self.pre_bind()
-            server_socket = self._get_server_socket(manager)
-            self.post_bind()
         self._server_socket = server_socket
+        # Maps each listening socket to its ListenerSpec
+        self._listeners = {}
+        if manager is not None:
+            for spec, sock in manager.listen_sockets:
+                self._listeners[sock] = spec
+        elif server_socket is not None:
+            self._listeners[server_socket] = spec_for_socket(server_socket)
         self._max_requests = max_requests
-        self._child_conn = child_conn
         self._poll = get_poller(select.POLLIN | select.POLLPRI)
-        self._poll.register(self._server_socket)
         self._poll.register(self._child_conn)
+        self._tracer = None
+        self._saturated = None
+        self._shed_queue_depth = 0
+        # A shared preforkserver.ratelimit.TokenBucketTable, if the manager
+        # was given one
+        self.rate_limiter = None
+        # A shared preforkserver.cidr.CIDRMatcher, if the manager was given
+        # one
+        self.access_list = None
+        # A shared preforkserver.sharedcache.SharedCache, if the manager
+        # was given one
+        self.shared_cache = None
+        # A preforkserver.singleflight.SingleFlight for coalescing calls
+        # for the same key across children
+        self.singleflight = None
+        self._log_pipeline = None
+        self._deadlines = None
+        self._write_buffer_size = 16384
+        self._tcp_cork = False
+        self._read_buffer_size = 4096
+        self._max_read_size = 1048576
+        self._tls = None
+        self._socket_profile = None
+        # With reuse_port, the effective socket options of the listeners
+        # bound in this child, by listener
+        self.socket_options = {}
+        # The ssl.SSLSocket for the current connection, if it is TLS
+        self._tls_conn = None
+        # A preforkserver.steering.ReusePortSteering, and the sockets this
+        # child bound that it applies to
+        self._steering = None
+        self._steered = []
+        # How long to spend serving what is left in the queues of
+        # self._steered on a normal exit, and whether that is happening
+        self._drain_timeout = 0
+        self._draining = False
+        # The application version of the last message seen on each
+        # broadcast topic
+        self.broadcast_versions = {}
+        self._broadcast_seqs = {}
+        # Messages broadcast before this child was forked
+        inherited = []
+        if manager is not None:
+            self._tracer = manager.tracer
+            self._saturated = manager._saturated
+            self._shed_queue_depth = manager.shed_queue_depth
+            self.rate_limiter = manager.rate_limiter
+            self.access_list = manager.access_list
+            self.shared_cache = manager.shared_cache
+            self.singleflight = manager.singleflight
+            if manager.log_pipeline is not None:
+                self._log_pipeline = manager.log_pipeline
+                self._log_pipeline.attach(manager._child_log_slot)
+            if manager.read_timeout or manager.write_timeout or \
+                    manager.request_timeout or manager.min_recv_rate:
+                self._deadlines = (manager.read_timeout,
+                    manager.write_timeout, manager.request_timeout,
+                    manager.min_recv_rate, manager.min_recv_rate_grace)
+            self._write_buffer_size = manager.write_buffer_size
+            self._tcp_cork = manager.tcp_cork
+            self._read_buffer_size = manager.read_buffer_size
+            self._max_read_size = manager.max_read_size
+            self._tls = manager.tls
+            self._socket_profile = manager.socket_profile
+            self._steering = manager.steering
+            if not manager.tcp_migrate_req:
+                self._drain_timeout = manager.drain_timeout
+            inherited = sorted((seq, topic, version, data)
+                for topic, (seq, version, data) in manager.broadcasts.items())
+        # Read buffers are reused from one connection to the next
+        self._buffer_pool = BufferPool()
+        self._stats = {}
         self.protocol = protocol
+        # The ListenerSpec of the socket the current connection came in on
+        self.listener = None
+        self._listen_socket = None
         self.requests_handled = 0
         # The "conn" will be a socket connection object if this is a tcp 
         # server, and will actually be the payload if this is a udp server
         self.conn = None
         self.address = None
+        # A preforkserver.reader.RequestReader and a
+        # preforkserver.writer.ResponseWriter for the current tcp
+        # connection
+        self.reader = None
+        self.writer = None
         self.closed = False
         self.error = None
         args = args if args else []
         kwargs = kwargs if kwargs else {}
         self.initialize(*args, **kwargs)
+        self.warmup()
+        for msg in inherited:
+            self._deliver_broadcast(*msg)
+        # Only bind our own socket once we are actually ready to serve,
+        # otherwise the kernel would start queueing connections for us
+        # while we are still initializing
+        if manager is not None and manager.reuse_port:
+            self.pre_bind()
+            # Unix sockets are still bound in the manager and shared
+            by_spec = dict([ (spec, sock)
+                for sock, spec in self._listeners.items() ])
+
+            def bind():
+                for spec in manager.listeners:
+                    if spec not in by_spec:
+                        by_spec[spec] = self._get_server_socket(manager, spec)
+                        self._listeners[by_spec[spec]] = spec
+                        self._steered.append(by_spec[spec])
+                return self._steered
+
+            if self._steering is not None:
+                self._steering.join(bind)
+            else:
+                bind()
+            if self._socket_profile is not None:
+                for sock in self._steered:
+                    self.socket_options[str(self._listeners[sock])] = \
+                        self._socket_profile.effective(sock)
+            self._server_socket = by_spec[manager.listeners[0]]
+            self.post_bind()
+        for sock in self._listeners:
+            self._poll.register(sock)
 
     @property
     def bound_address(self):
         """
-        Returns the bound server address as (ip, port) tuple
+        Returns the bound server address as (ip, port) tuple, or the path
+        for a unix socket, or None if the socket is not bound yet
         """
-        return self.server_socket.getsockname()
+        if self._server_socket is None:
+            return None
+        return self._server_socket.getsockname()
 
-    def _get_server_socket(self, manager):
+    @property
+    def bound_addresses(self):
         """
-        Binds the server socket using SO_REUSEPORT and returns it
+        Returns a list of the bound addresses of all the listening sockets
         """
-        addr = (manager.bind_ip, manager.port)
-        protocol = socket.SOCK_STREAM
-        if manager.protocol == 'udp':
-            protocol = socket.SOCK_DGRAM
-        s = socket.socket(socket.AF_INET, protocol)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        s.bind(addr)
-        if protocol == socket.SOCK_STREAM:
-            s.listen(manager.listen)
+        return [ sock.getsockname() for sock in self._listeners ]
+
+    def _get_server_socket(self, manager, spec=None):
+        """
+        Binds a server socket using SO_REUSEPORT and returns it.  spec is
+        the ListenerSpec to bind, the manager's first listener by default
+        """
+        if spec is None:
+            spec = manager.listeners[0]
+        s = bind_listener(spec, manager.listen, reuse_port=True,
+            profile=self._socket_profile)
         del manager
         return s
 
+    def _setup_conn(self):
+        """
+        Internal per-connection setup, called right after the accept and
+        before any of the hooks.  Mixins can extend this, but must call
+        the super() method
+        """
+        if self._deadlines is not None and self.protocol == 'tcp':
+            self.conn = DeadlineSocket(self.conn, *self._deadlines)
+
+    def _teardown_conn(self):
+        """
+        Internal per-connection cleanup, called after
+        post_process_request().  Mixins can extend this, but must call
+        the super() method
+        """
+        return
+
     def _close_conn(self):
-        if self.conn and isinstance(self.conn, socket.SocketType):
-            self.conn.shutdown(socket.SHUT_RDWR)
+        # self.conn may be wrapped by a mixin, so check the protocol
+        # rather than the type
+        if self.conn is not None and self.protocol == 'tcp':
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # The client has already gone away
+                pass
             self.conn.close()
 
+    def _release_io(self):
+        if self.reader is not None:
+            self.reader.release()
+        self.reader = self.writer = None
+        self._tls_conn = None
+
+    def _tls_handshake(self):
+        self._tls.handshake(self._tls_conn)
+        self._incr_stat('tls.handshakes')
+        if self._tls_conn.session_reused:
+            self._incr_stat('tls.resumed')
+
+    def _wait_readable(self, timeout):
+        """
+        Wait up to timeout seconds for more data from the client.  Returns
+        True if there is some.  Bytes that TLS has already decrypted
+        (SSLSocket.pending()) count as readable, since they are off the
+        socket and poll() can't see them
+        """
+        if self._tls_conn is not None and self._tls_conn.pending():
+            return True
+        p = select.poll()
+        p.register(self.conn.fileno(), select.POLLIN | select.POLLPRI)
+        return bool(p.poll(timeout * 1000))
+
+    def _flush_writer(self):
+        if self.writer is not None:
+            self.writer.flush()
+
     def _waiting(self):
+        if self._draining:
+            # The manager may already have closed its end of the pipe
+            return
+        if self._stats:
+            self._child_conn.send([pfe.STATS, self._stats])
+            self._stats = {}
         self._child_conn.send([pfe.WAITING, self.requests_handled])
 
+    def _incr_stat(self, name, value=1):
+        """
+        Increment a counter which is reported to the manager, and shows up
+        in its metrics as child.<name>, the next time this child is waiting
+        """
+        self._stats[name] = self._stats.get(name, 0) + value
+
+    def _should_shed(self):
+        """
+        Returns True if the manager has flagged the pool as saturated and
+        the accept queue is at or over the shed_queue_depth threshold
+        """
+        if not self._saturated.value:
+            return False
+        if self.protocol != 'tcp':
+            return True
+        info = tcp_info_queue(self._listen_socket)
+        if info is None:
+            return True
+        return info[0] >= self._shed_queue_depth
+
+    def _ready(self):
+        self._child_conn.send([pfe.READY, self.requests_handled])
+
     def _busy(self):
+        if self._draining:
+            return
         self._child_conn.send([pfe.BUSY, self.requests_handled])
 
     def _error(self, msg=None):
@@ -125,15 +346,43 @@ class BaseChild(object):
         event = int(event)
         if event & pfe.CLOSE:
             self.closed = True
+        elif event & pfe.BROADCAST:
+            self._deliver_broadcast(*msg)
+
+    def _deliver_broadcast(self, seq, topic, version, data):
+        """
+        Pass a broadcast message to the on_broadcast() hook, unless it was
+        already seen
+        """
+        if seq <= self._broadcast_seqs.get(topic, 0):
+            return
+        self._broadcast_seqs[topic] = seq
+        self.broadcast_versions[topic] = version
+        try:
+            self.on_broadcast(topic, data, version)
+        except Exception as e:
+            # A bad message shouldn't take down a warm child
+            self._incr_stat('broadcast.errors')
+            self.log('Error handling broadcast %r: %s' % (topic, e),
+                logging.ERROR)
+            return
+        self._incr_stat('broadcast.received')
 
-    def _handle_connection(self):
+    def _handle_connection(self, sock=None):
         """
         This is the workhorse that actually accepts the connection
         and calls all the hooks
         """
+        if sock is None:
+            sock = self._server_socket
+        self._listen_socket = sock
+        self.listener = self._listeners.get(sock)
+        if self.listener is not None:
+            self.protocol = self.listener.protocol
+        trace = self._tracer.begin() if self._tracer else NULL_TRACE
         if self.protocol == 'tcp':
             try:
-                self.conn, self.address = self._server_socket.accept()
+                self.conn, self.address = sock.accept()
             except socket.error:
                 # There is a condition where more than 1 process can end up here
                 # on a single connection.  The second one (this one, if we get 
@@ -141,27 +390,98 @@ class BaseChild(object):
                 return
         else:
             try:
-                self.conn, self.address = self._server_socket.recvfrom(8192)
+                self.conn, self.address = sock.recvfrom(8192)
             except socket.error:
                 # There is a condition where more than 1 process can end up 
                 # here on a single connection.  The second one (this one, 
                 # if we get here) will timeout
                 return
+        accepted = trace.mark('accept')
+        inet_tcp = self.protocol == 'tcp' and \
+            not (self.listener and self.listener.is_unix)
+        if inet_tcp and accepted is not None:
+            # The accept span only covers the accept() call.  The kernel
+            # knows how long the connection was queued before that
+            queued = tcp_info_queued(self.conn)
+            if queued:
+                trace.mark_before('accept_queue', accepted.end - queued)
+        if inet_tcp and self._socket_profile is not None:
+            self._socket_profile.apply_conn(self.conn)
+        if inet_tcp and self._tls is not None:
+            self.conn = self._tls_conn = self._tls.wrap(self.conn)
+        self._setup_conn()
+        if self.protocol == 'tcp':
+            self.reader = RequestReader(self.conn, self._buffer_pool,
+                self._read_buffer_size, self._max_read_size)
+            self.writer = ResponseWriter(self.conn, self._write_buffer_size,
+                self._tcp_cork, vectored=self._tls_conn is None)
+        if self._saturated is not None and self._should_shed():
+            try:
+                self.overloaded()
+                self._flush_writer()
+            except ClientTimeout as e:
+                self._incr_stat('client_timeout.%s' % e.reason)
+            self._close_conn()
+            self._incr_stat('shed')
+            trace.mark('overloaded')
+            trace.set_attr('shed', True)
+            trace.finish()
+            self._teardown_conn()
+            self._release_io()
+            return
         self._busy()
-        self.post_accept()
-        if self.allow_deny():
-            self.process_request()
-        else:
-            self.request_denied()
+        # Socket options, the TLS wrap, the reader and writer and the shed
+        # check
+        trace.mark('setup')
+        allowed = None
+        try:
+            if self._tls_conn is not None:
+                self._tls_handshake()
+                trace.mark('tls_handshake')
+            self.post_accept()
+            trace.mark('post_accept')
+            allowed = self.allow_deny()
+            trace.mark('allow_deny')
+            if allowed:
+                self.process_request()
+                trace.mark('process_request')
+            else:
+                self.request_denied()
+                trace.mark('request_denied')
+            self._flush_writer()
+        except ClientTimeout as e:
+            # A slow or stalled client.  Drop it and move on rather than
+            # letting it take the whole child down
+            self._incr_stat('client_timeout.%s' % e.reason)
+            trace.mark('client_timeout')
+            trace.set_attr('client_timeout', e.reason)
+        except ReadLimitError:
+            self._incr_stat('read_limit')
+            trace.mark('read_limit')
+        except TLSHandshakeError:
+            self._incr_stat('tls.handshake_errors')
+            trace.mark('tls_handshake')
+            trace.set_attr('tls_error', True)
         self._close_conn()
+        trace.mark('close_conn')
         self.post_process_request()
+        trace.mark('post_process_request')
+        trace.set_attr('allowed', allowed)
+        trace.set_attr('protocol', self.protocol)
+        trace.finish()
+        self._teardown_conn()
+        self._release_io()
         self._waiting()
 
     def _loop(self):
         while True:
             events = []
             try:
-                events = self._poll.poll(max_events=20)
+                if self._steering is not None:
+                    # Wake up now and then to pick up steering changes
+                    events = self._poll.poll(1, 20)
+                else:
+                    events = self._poll.poll(max_events=20)
             except OSError:
                 pass
             except IOError:
@@ -170,31 +490,92 @@ class BaseChild(object):
                 # This happens when the system call is interrupted
                 pass
             for sock, e in events:
-                if sock == self._server_socket:
+                if sock in self._listeners:
                     try:
-                        self._handle_connection()
+                        self._handle_connection(sock)
                     except Exception as e:
                         self._error(e)
                         self._shutdown(1)
                     self.requests_handled += 1
                 elif sock == self._child_conn:
                     self._handle_parent_event()
+            if self._steering is not None and \
+                    self._steering.check(self._steered):
+                self._incr_stat('steering.attached')
             if self.closed:
+                self._drain()
                 self._shutdown()
             if 0 < self._max_requests <= self.requests_handled:
+                self._drain()
                 self._handled_max_requests()
                 self._shutdown()
 
+    def _drain(self):
+        """
+        Before a normal exit, serve whatever is queued on the reuse_port
+        sockets this child bound, since closing a listener resets the
+        connections still in its queue.  This child first gives up its
+        steering seat, so no new connections are sent to it, then keeps
+        serving until the queues have been quiet for _DRAIN_QUIET seconds,
+        or drain_timeout is up
+        """
+        if not self._drain_timeout or not self._steered:
+            return
+        if not self.closed:
+            # This hit max_requests.  Let the manager replace it
+            self._child_conn.send([pfe.DRAINING, self.requests_handled])
+        if self._steering is not None:
+            self._steering.release(self._steered)
+        self._draining = True
+        poll = get_poller(select.POLLIN)
+        for sock in self._steered:
+            poll.register(sock)
+        now = time()
+        deadline = now + self._drain_timeout
+        quiet = now + _DRAIN_QUIET
+        drained = 0
+        try:
+            while now < deadline and now < quiet:
+                events = poll.poll(min(0.05, deadline - now),
+                    len(self._steered))
+                for sock, ev in events:
+                    self._handle_connection(sock)
+                    self.requests_handled += 1
+                    drained += 1
+                now = time()
+                if events:
+                    quiet = now + _DRAIN_QUIET
+        except Exception as e:
+            # We are on the way out anyway
+            self.log('Error while draining: %s' % e, logging.ERROR)
+        poll.close()
+        if drained:
+            self._incr_stat('drained', drained)
+            try:
+                self._child_conn.send([pfe.STATS, self._stats])
+                self._stats = {}
+            except (IOError, OSError):
+                pass
+
     def _shutdown(self, status=0):
         self._poll.unregister(self._child_conn)
-        self._poll.unregister(self._server_socket)
         self._child_conn.close()
-        self._server_socket.close()
+        for sock in self._listeners:
+            self._poll.unregister(sock)
+        if self._steering is not None and self._steered:
+            # Leave the group under the steering lock, so the kernel's
+            # order of the sockets stays known
+            self._steering.leave(self._steered)
+        for sock in self._listeners:
+            sock.close()
         self.shutdown()
+        if self._tracer:
+            self._tracer.shutdown()
         sleep(0.1)
         os._exit(status)
 
     def run(self):
+        self._ready()
         self._loop()
 
     def resp_to(self, msg):
@@ -210,15 +591,35 @@ class BaseChild(object):
             msg = msg.encode('utf-8')
 
         if self.protocol == 'tcp':
-            self.conn.sendall(msg)
+            # Go through the writer so that this goes out after anything
+            # already written there
+            if self.writer is not None:
+                self.writer.write(msg)
+                self.writer.flush()
+            else:
+                self.conn.sendall(msg)
         else:
-            self._server_socket.sendto(msg, self.address)
+            self._listen_socket.sendto(msg, self.address)
+
+    def log(self, msg, level=logging.INFO):
+        """
+        Log a message.  If the manager has a log_pipeline, this writes to
+        this child's shared memory ring, which never blocks.  Otherwise,
+        this does nothing.  Returns False if the message was dropped.
+
+        msg:str         The message to log
+        level:int       A logging module level, like logging.INFO
+        """
+        if self._log_pipeline is None:
+            return False
+        return self._log_pipeline.log(msg, level)
 
     # Hooks to be overridden
     def pre_bind(self):
         """
         This is just like the hook in the manager class.  It is called just
-        before the socket is bound in the child (if reuse_port is set)
+        before the socket is bound in the child (if reuse_port is set).
+        Note that this happens after initialize() and warmup()
         """
         return
 
@@ -236,6 +637,15 @@ class BaseChild(object):
         """
         return
 
+    def warmup(self):
+        """
+        This is called right after initialize().  Use it to warm caches,
+        open backend connections, etc.  The manager does not count this
+        child as a spare, and with reuse_port the socket is not bound,
+        until this returns
+        """
+        return
+
     def post_accept(self):
         """
         self.conn and self.address are initialized here since a new connection
@@ -258,6 +668,16 @@ class BaseChild(object):
         """
         return
 
+    def overloaded(self):
+        """
+        This hook is called, if load_shedding is enabled in the manager, in
+        place of all the other request hooks when a connection is shed
+        because the pool is saturated.  Send a short error here, like a
+        503 for http, if you wish.  Keep it quick, the point is to get rid
+        of the connection as fast as possible.
+        """
+        return
+
     def process_request(self):
         """
         This hook is called for an allowed connection.  Use self.conn here to
@@ -272,6 +692,20 @@ class BaseChild(object):
         """
         return
 
+    def on_broadcast(self, topic, data, version):
+        """
+        This hook is called with each message from Manager.broadcast(),
+        between requests.  Use it to reload configuration or invalidate
+        cached data in place, without recycling the child.  Messages sent
+        before this child started are delivered right after warmup()
+
+        topic:str       The topic of the message
+        data:object     The message data
+        version:object  The version given to broadcast(), or the
+                        sequence number
+        """
+        return
+
     def shutdown(self):
         """
         This hook is called only when the child is exiting for some reason.
@@ -0,0 +1,284 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A compiled IPv4/IPv6 prefix matcher for use in allow_deny().  The
+# prefixes are merged into sorted, disjoint address intervals which are
+# stored in flat arrays, so a lookup is a binary search over plain machine
+# integers.  Because the arrays hold no Python objects, the pages stay
+# shared copy-on-write between the manager and all of the children.
+#
+#     blocklist = CIDRMatcher.from_file('/etc/myserver/blocklist')
+#     manager = Manager(MyChild, access_list=blocklist)
+#
+#     # In the child
+#     def allow_deny(self):
+#         return self.address[0] not in self.access_list
+#
+# A matcher loaded from a file can be reloaded, which the manager does on
+# SIGHUP.  The newly compiled arrays are written to a file which the
+# children map in on their next lookup, so a reload does not require
+# recycling any children.
+#
+
+from array import array
+import multiprocessing as mp
+import ipaddress
+import tempfile
+import bisect
+import shutil
+import socket
+import struct
+import mmap
+import os
+
+__all__ = ['CIDRMatcher']
+
+_BLOB_HDR = struct.Struct('=8sII')
+_BLOB_MAGIC = b'PFSCIDR1'
+_MASK64 = (1 << 64) - 1
+
+
+def _merge(intervals):
+    """
+    Sort and merge overlapping or adjacent (start, end) intervals
+    """
+    ret = []
+    for start, end in sorted(intervals):
+        if ret and start <= ret[-1][1] + 1:
+            if end > ret[-1][1]:
+                ret[-1][1] = end
+        else:
+            ret.append([start, end])
+    return ret
+
+
+def _compile(prefixes):
+    """
+    Compile an iterable of prefix strings into the 6 flat arrays: the
+    IPv4 starts and ends, and the high and low 64 bits of the IPv6 starts
+    and ends
+    """
+    v4 = []
+    v6 = []
+    for prefix in prefixes:
+        prefix = prefix.strip()
+        if not prefix or prefix.startswith('#'):
+            continue
+        net = ipaddress.ip_network(prefix, strict=False)
+        interval = (int(net.network_address), int(net.broadcast_address))
+        if net.version == 4:
+            v4.append(interval)
+        else:
+            v6.append(interval)
+    v4 = _merge(v4)
+    v6 = _merge(v6)
+    return (
+        array('I', [ i[0] for i in v4 ]),
+        array('I', [ i[1] for i in v4 ]),
+        array('Q', [ i[0] >> 64 for i in v6 ]),
+        array('Q', [ i[0] & _MASK64 for i in v6 ]),
+        array('Q', [ i[1] >> 64 for i in v6 ]),
+        array('Q', [ i[1] & _MASK64 for i in v6 ]),
+    )
+
+
+def _dump(tables, path):
+    n4 = len(tables[0])
+    n6 = len(tables[2])
+    with open(path, 'wb') as fh:
+        fh.write(_BLOB_HDR.pack(_BLOB_MAGIC, n4, n6))
+        for t in tables:
+            t.tofile(fh)
+
+
+def _load(path):
+    """
+    Map a dumped set of tables in read only, returning memoryviews over the
+    mapping so nothing is copied
+    """
+    with open(path, 'rb') as fh:
+        mem = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, n4, n6 = _BLOB_HDR.unpack_from(mem, 0)
+    if magic != _BLOB_MAGIC:
+        raise ValueError('%s is not a compiled prefix table' % path)
+    view = memoryview(mem)
+    ret = []
+    off = _BLOB_HDR.size
+    for code, count in (('I', n4), ('I', n4), ('Q', n6), ('Q', n6),
+            ('Q', n6), ('Q', n6)):
+        size = struct.calcsize(code) * count
+        ret.append(view[off:off + size].cast(code))
+        off += size
+    return tuple(ret)
+
+
+class CIDRMatcher(object):
+    """
+    Matches IPv4 and IPv6 addresses against a set of prefixes.  Lookups
+    are a binary search, so they take at most log2(number of intervals)
+    steps, which is always under the prefix length (32 or 128)
+    """
+
+    def __init__(self, prefixes=None, source=None):
+        """
+        prefixes:list       An iterable of prefix strings, like
+                            '10.0.0.0/8' or '2001:db8::/32'.  Single
+                            addresses are treated as /32 or /128
+        source:str          A file with one prefix per line.  Blank lines
+                            and lines starting with # are ignored.  A
+                            matcher with a source can be reloaded
+        """
+        self.source = source
+        if prefixes is None:
+            prefixes = []
+        if source is not None:
+            prefixes = list(prefixes) + self._read_source()
+        self._tables = _compile(prefixes)
+        # The generation is shared with the children so they can tell
+        # when the manager has reloaded
+        self._shared_gen = mp.RawValue('L', 0)
+        self._gen = 0
+        # Reloaded tables are written here.  This has to exist before the
+        # children are forked so that they know where to look
+        self._blob_dir = tempfile.mkdtemp(prefix='pfs-cidr-')
+        self._owner = os.getpid()
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(source=path)
+
+    def __len__(self):
+        """
+        Returns the number of merged intervals
+        """
+        return len(self._tables[0]) + len(self._tables[2])
+
+    def __contains__(self, ip):
+        return self.match(ip)
+
+    def _read_source(self):
+        with open(self.source) as fh:
+            return fh.readlines()
+
+    def _refresh(self):
+        """
+        Map in the tables for the current shared generation
+        """
+        while True:
+            gen = self._shared_gen.value
+            try:
+                self._tables = _load(self._blob_path(gen))
+            except (IOError, OSError):
+                # The manager has already moved past this generation
+                if gen == self._shared_gen.value:
+                    raise
+                continue
+            self._gen = gen
+            return
+
+    def _blob_path(self, gen):
+        return os.path.join(self._blob_dir, 'gen-%d' % gen)
+
+    def match(self, ip):
+        """
+        Returns True if ip is covered by any of the prefixes
+
+        ip:str          An IPv4 or IPv6 address string
+        """
+        if self._gen != self._shared_gen.value:
+            self._refresh()
+        if ':' in ip and '.' in ip:
+            # Maybe an IPv4 mapped address (::ffff:a.b.c.d) from a dual
+            # stack socket.  Others with a dotted tail, like NAT64's
+            # 64:ff9b::a.b.c.d, are IPv6
+            try:
+                mapped = ipaddress.IPv6Address(ip.split('%', 1)[0]) \
+                    .ipv4_mapped
+            except ValueError:
+                return False
+            if mapped is not None:
+                ip = str(mapped)
+        if ':' not in ip:
+            try:
+                n = struct.unpack('!I', socket.inet_aton(ip))[0]
+            except (socket.error, OSError):
+                return False
+            starts, ends = self._tables[0], self._tables[1]
+            i = bisect.bisect_right(starts, n) - 1
+            return i >= 0 and n <= ends[i]
+
+        try:
+            hi, lo = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6,
+                ip.split('%', 1)[0]))
+        except (socket.error, OSError, ValueError):
+            return False
+        shi, slo, ehi, elo = self._tables[2:]
+        # bisect_right over the (hi, lo) pairs
+        a, b = 0, len(shi)
+        while a < b:
+            mid = (a + b) // 2
+            if hi < shi[mid] or (hi == shi[mid] and lo < slo[mid]):
+                b = mid
+            else:
+                a = mid + 1
+        i = a - 1
+        if i < 0:
+            return False
+        return hi < ehi[i] or (hi == ehi[i] and lo <= elo[i])
+
+    def reload(self, prefixes=None):
+        """
+        Recompile from prefixes, or from the source file if prefixes is
+        None, and publish the new tables to the children.  This must be
+        called in the process which created the matcher (the manager).
+        If compiling fails, the current tables are left in place and the
+        exception is raised
+        """
+        if os.getpid() != self._owner:
+            raise RuntimeError('reload() must be called from the process '
+                'which created the matcher')
+        if prefixes is None:
+            if self.source is None:
+                raise ValueError('No prefixes were given and this matcher '
+                    'has no source')
+            prefixes = self._read_source()
+        tables = _compile(prefixes)
+        gen = self._gen + 1
+        path = self._blob_path(gen)
+        _dump(tables, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        self._tables = tables
+        self._gen = gen
+        self._shared_gen.value = gen
+        # Any child still on the previous generation will see the new
+        # generation number before it tries to load anything
+        old = self._blob_path(gen - 1)
+        if os.path.exists(old):
+            os.unlink(old)
+
+    def close(self):
+        """
+        Remove any compiled table files.  Only the creating process does
+        anything here
+        """
+        if os.getpid() == self._owner and self._blob_dir is not None:
+            shutil.rmtree(self._blob_dir, True)
+            self._blob_dir = None
@@ -0,0 +1,147 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Per-connection I/O deadlines.  When any of the Manager's read_timeout,
+# write_timeout, request_timeout or min_recv_rate options are set, the
+# child wraps each accepted connection in a DeadlineSocket before any of
+# the hooks run.  Every blocking call on it gets a socket timeout which
+# is the smaller of the per-call limit and whatever is left of the total
+# request deadline.  Going over any of them raises ClientTimeout, and the
+# child closes the connection and moves on to the next one.
+#
+
+from preforkserver.exceptions import ClientTimeout
+from preforkserver.sockwrap import SocketWrapper
+import socket
+import time
+
+__all__ = ['DeadlineSocket']
+
+
+class DeadlineSocket(SocketWrapper):
+    """
+    Wraps an accepted socket and enforces the deadlines.  Anything not
+    overridden here is passed through to the real socket
+    """
+
+    def __init__(self, sock, read_timeout=None, write_timeout=None,
+            total_timeout=None, min_recv_rate=None, rate_grace=5.0):
+        """
+        sock:socket.socket      The accepted connection
+        read_timeout:float      Max seconds to wait on any single read
+        write_timeout:float     Max seconds to wait on any single write
+        total_timeout:float     Max seconds for the entire request
+        min_recv_rate:float     Minimum average bytes per second received
+                                from the client once rate_grace seconds
+                                have passed
+        rate_grace:float        Seconds before min_recv_rate is enforced
+        """
+        SocketWrapper.__init__(self, sock)
+        self._read_timeout = read_timeout
+        self._write_timeout = write_timeout
+        self._min_recv_rate = min_recv_rate
+        self._rate_grace = rate_grace
+        self._start = time.monotonic()
+        self._deadline = self._start + total_timeout if total_timeout \
+            else None
+        self.bytes_received = 0
+
+    def _timeout(self, limit, op):
+        """
+        Set the socket timeout for the next call.  Returns it, along with
+        the reason for a ClientTimeout if it runs out
+        """
+        timeout = limit
+        reason = op
+        now = time.monotonic()
+        if self._deadline is not None:
+            left = self._deadline - now
+            if left <= 0:
+                raise ClientTimeout('total', 'request deadline exceeded')
+            if timeout is None or left < timeout:
+                timeout = left
+                reason = 'total'
+        if op == 'read' and self._min_recv_rate:
+            # The client falls under the minimum rate once it has been
+            # waited on for longer than what it has sent so far is worth,
+            # so a client sending nothing at all is dropped too
+            left = self._start + max(self._rate_grace,
+                self.bytes_received / self._min_recv_rate) - now
+            if timeout is None or left < timeout:
+                timeout = max(left, 0.001)
+                reason = 'throughput'
+        self._sock.settimeout(timeout)
+        return timeout, reason
+
+    def _call(self, limit, op, func, *args):
+        timeout, reason = self._timeout(limit, op)
+        try:
+            return func(*args)
+        except socket.timeout:
+            if reason == 'total':
+                raise ClientTimeout('total', 'request deadline exceeded')
+            if reason == 'throughput':
+                raise ClientTimeout('throughput', 'client sent %d bytes in '
+                    '%.1fs, under the minimum of %s bytes/s' %
+                    (self.bytes_received, time.monotonic() - self._start,
+                    self._min_recv_rate))
+            raise ClientTimeout(op, '%s timed out after %.3fs' %
+                (op, timeout))
+
+    def _received(self, n):
+        self.bytes_received += n
+        if self._min_recv_rate is None:
+            return
+        elapsed = time.monotonic() - self._start
+        if elapsed > self._rate_grace and \
+                self.bytes_received / elapsed < self._min_recv_rate:
+            raise ClientTimeout('throughput', 'client is sending at %.1f '
+                'bytes/s, under the minimum of %s' %
+                (self.bytes_received / elapsed, self._min_recv_rate))
+
+    def recv(self, bufsize, flags=0):
+        data = self._call(self._read_timeout, 'read', self._sock.recv,
+            bufsize, flags)
+        self._received(len(data))
+        return data
+
+    def recv_into(self, buf, nbytes=0, flags=0):
+        n = self._call(self._read_timeout, 'read', self._sock.recv_into, buf,
+            nbytes, flags)
+        self._received(n)
+        return n
+
+    def send(self, data, flags=0):
+        return self._call(self._write_timeout, 'write', self._sock.send,
+            data, flags)
+
+    def sendall(self, data, flags=0):
+        # sendall() applies the timeout to the whole call, not each send
+        return self._call(self._write_timeout, 'write', self._sock.sendall,
+            data, flags)
+
+    def sendmsg(self, buffers, *args):
+        return self._call(self._write_timeout, 'write', self._sock.sendmsg,
+            buffers, *args)
+
+    def sendfile(self, file, offset=0, count=None):
+        return self._call(self._write_timeout, 'write', self._sock.sendfile,
+            file, offset, count)
@@ -33,6 +33,18 @@ EXITING = EXITING_ERROR | EXITING_MAX
 # Sent from manager (parent): Tell the child to exit after handling it's
 # current request
 CLOSE = 16
+# Sent from child: A dict of counter increments since the last STATS event
+STATS = 32
+# Sent from child: Child has finished initializing and is ready to serve
+READY = 64
+# Manager only: The child has been forked, but has not sent READY yet
+STARTING = 128
+# Sent from manager (parent): A (seq, topic, version, data) message from
+# Manager.broadcast()
+BROADCAST = 256
+# Sent from child: Child hit max_requests and is serving what is left in
+# its reuse_port queues before exiting
+DRAINING = 512
 
 # A dictionary to map the event numbers to strings
 EVENT_NAMES = {
@@ -42,4 +54,9 @@ EVENT_NAMES = {
     EXITING_MAX: 'EXITING_MAX',
     EXITING: 'EXITING',
     CLOSE: 'CLOSE',
+    STATS: 'STATS',
+    READY: 'READY',
+    STARTING: 'STARTING',
+    BROADCAST: 'BROADCAST',
+    DRAINING: 'DRAINING',
 }
@@ -18,6 +18,11 @@
 #    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import socket
+
+__all__ = ['ManagerError', 'ChildError', 'EventMaskError', 'ClientTimeout',
+    'ReadLimitError', 'TLSHandshakeError']
+
 class ManagerError(Exception):
     pass
 
@@ -26,3 +31,26 @@ class ChildError(Exception):
 
 class EventMaskError(Exception):
     pass
+
+class ClientTimeout(ChildError, socket.timeout):
+    """
+    Raised from self.conn when a client goes over one of the per-connection
+    deadlines.  reason is one of 'read', 'write', 'total' or 'throughput'
+    """
+
+    def __init__(self, reason, msg):
+        ChildError.__init__(self, msg)
+        self.reason = reason
+
+class ReadLimitError(ChildError):
+    """
+    Raised from self.reader when a client sends more than max_read_size
+    bytes without the delimiter it is waiting for
+    """
+    pass
+
+class TLSHandshakeError(ChildError):
+    """
+    Raised when the TLS handshake with a client fails or times out
+    """
+    pass
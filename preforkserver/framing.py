@@ -0,0 +1,350 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Children for common wire formats.  Instead of process_request(),
+# override handle_message(), which is called once for every message on
+# the connection.  Whatever it returns is framed and sent back.  The
+# connection is kept open for more messages until the client closes it,
+# goes idle for keepalive_timeout seconds, or max_messages have been
+# handled.  Pipelined messages are handled in order and their responses
+# are sent together.
+#
+#     class Echo(LineChild):
+#         def handle_message(self, line):
+#             return line
+#
+#     class Hello(HTTPChild):
+#         def handle_message(self, req):
+#             return (200, [('Content-Type', 'text/plain')], b'hello\n')
+#
+# These are tcp only and use self.reader and self.writer.
+#
+
+from preforkserver.child import BaseChild
+from preforkserver.exceptions import ReadLimitError
+from http.client import responses
+import struct
+
+__all__ = ['FramedChild', 'LineChild', 'LengthPrefixedChild', 'HTTPChild',
+    'HTTPRequest']
+
+
+class FramedChild(BaseChild):
+    """
+    The base for the framed children.  Subclasses implement
+    _read_message() and _write_response()
+    """
+    # Seconds to wait for the next message before closing the connection
+    keepalive_timeout = 30.0
+    # The most messages to handle on one connection, 0 for no limit
+    max_messages = 0
+
+    def _wait_for_data(self):
+        if self.reader.buffered:
+            return True
+        if self.reader.eof:
+            return False
+        return self._wait_readable(self.keepalive_timeout)
+
+    def _read_message(self):
+        """
+        Returns the next message, or None if the connection is done
+        """
+        raise NotImplementedError('_read_message() must be implemented')
+
+    def _write_response(self, msg, resp):
+        raise NotImplementedError('_write_response() must be implemented')
+
+    def _handle_one(self):
+        msg = self._read_message()
+        if msg is None:
+            return False
+        resp = self.handle_message(msg)
+        if isinstance(resp, memoryview):
+            # A view into the read buffer would be overwritten by the next
+            # read, before the writer is flushed
+            resp = bytes(resp)
+        if resp is not None:
+            self._write_response(msg, resp)
+        return True
+
+    def process_request(self):
+        self.messages_handled = 0
+        while True:
+            if not self.reader.buffered:
+                # Nothing is pipelined behind the last message, so send
+                # what we have before waiting on the client
+                self.writer.flush()
+                if not self._wait_for_data():
+                    break
+            if not self._handle_one():
+                break
+            self.messages_handled += 1
+            if 0 < self.max_messages <= self.messages_handled:
+                break
+
+    # Hooks to be overridden
+    def handle_message(self, msg):
+        """
+        This hook is called for every message received on the connection.
+        Return the response to send, or None to send nothing.  msg is a
+        memoryview into the read buffer, call bytes() on it to keep it
+        past this call
+        """
+        return None
+
+
+class LineChild(FramedChild):
+    """
+    Newline (or any delimiter) separated messages.  handle_message() gets
+    the line without the delimiter, and the delimiter is added to the
+    response
+    """
+    delimiter = b'\n'
+    # The longest line allowed, including the delimiter
+    max_line = 65536
+
+    def _read_message(self):
+        line = self.reader.read_until(self.delimiter, self.max_line)
+        dlen = len(self.delimiter)
+        if len(line) < dlen or line[-dlen:] != self.delimiter:
+            # EOF, possibly in the middle of a line
+            return None
+        return line[:-dlen]
+
+    def _write_response(self, msg, resp):
+        self.writer.write(resp)
+        self.writer.write(self.delimiter)
+
+
+class LengthPrefixedChild(FramedChild):
+    """
+    Binary messages, each preceded by its length as a fixed size integer.
+    The response is framed the same way
+    """
+    # The struct format of the length prefix
+    prefix_format = '!I'
+    # The largest message allowed, not including the prefix
+    max_message_size = 1048576
+
+    def _read_message(self):
+        prefix = struct.Struct(self.prefix_format)
+        try:
+            length = prefix.unpack(self.reader.read_exactly(prefix.size))[0]
+        except EOFError:
+            return None
+        if length > self.max_message_size:
+            raise ReadLimitError('message of %d bytes is over the limit of '
+                '%d' % (length, self.max_message_size))
+        try:
+            return self.reader.read_exactly(length)
+        except EOFError:
+            return None
+
+    def _write_response(self, msg, resp):
+        if isinstance(resp, str):
+            # The prefix is the length in bytes, not characters
+            resp = resp.encode('utf-8')
+        self.writer.write(struct.pack(self.prefix_format, len(resp)))
+        self.writer.write(resp)
+
+
+class HTTPRequest(object):
+    """
+    A parsed HTTP request.  headers maps lower cased names to values,
+    with repeated headers joined by ', '
+    """
+    __slots__ = ('method', 'target', 'path', 'query', 'version', 'headers',
+        'body', 'keep_alive')
+
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.target = target
+        self.path, _, self.query = target.partition('?')
+        self.version = version
+        self.headers = headers
+        self.body = body
+        conn = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in conn
+        else:
+            self.keep_alive = 'close' not in conn
+
+    def __repr__(self):
+        return '<HTTPRequest %s %s %s>' % (self.method, self.target,
+            self.version)
+
+
+class _HTTPError(Exception):
+
+    def __init__(self, status, msg=''):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+class HTTPChild(FramedChild):
+    """
+    A minimal HTTP/1.1 server with keep-alive and pipelining.
+    handle_message() gets an HTTPRequest and returns a tuple of
+    (status, headers, body), where headers is a list of (name, value)
+    tuples, or just the body for a 200.  Content-Length and Connection
+    are filled in.  Request bodies may use Content-Length or chunked
+    encoding
+    """
+    keepalive_timeout = 5.0
+    max_messages = 100
+    # The most bytes allowed for the request line and headers together
+    max_header_size = 8192
+    # The largest request body allowed
+    max_body_size = 1048576
+
+    def _read_body(self, headers):
+        te = headers.get('transfer-encoding')
+        if te is not None:
+            if te.lower() != 'chunked':
+                raise _HTTPError(501, 'unsupported transfer-encoding')
+            return self._read_chunked()
+        length = headers.get('content-length')
+        if length is None:
+            return b''
+        try:
+            length = int(length)
+        except ValueError:
+            raise _HTTPError(400, 'bad content-length')
+        if length < 0:
+            raise _HTTPError(400, 'bad content-length')
+        if length > self.max_body_size:
+            raise _HTTPError(413)
+        return self.reader.read_exactly(length)
+
+    def _read_chunked(self):
+        chunks = []
+        total = 0
+        while True:
+            line = bytes(self.reader.read_line(self.max_header_size))
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise _HTTPError(400, 'bad chunk size')
+            if size == 0:
+                break
+            total += size
+            if total > self.max_body_size:
+                raise _HTTPError(413)
+            # Chunks must be copied out, since the next read reuses the
+            # buffer
+            chunks.append(bytes(self.reader.read_exactly(size)))
+            if self.reader.read_exactly(2) != b'\r\n':
+                raise _HTTPError(400, 'bad chunk')
+        # Skip any trailers
+        while self.reader.read_line(self.max_header_size) not in (b'\r\n',
+                b'\n', b''):
+            pass
+        return b''.join(chunks)
+
+    def _read_message(self):
+        try:
+            head = self.reader.read_until(b'\r\n\r\n', self.max_header_size)
+        except ReadLimitError:
+            raise _HTTPError(431)
+        if head[-4:] != b'\r\n\r\n':
+            # EOF
+            return None
+        if len(head) > self.max_header_size:
+            raise _HTTPError(431)
+        lines = bytes(head[:-4]).decode('latin-1').lstrip('\r\n') \
+            .split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise _HTTPError(400, 'bad request line')
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not name or name != name.strip():
+                raise _HTTPError(400, 'bad header')
+            name = name.lower()
+            value = value.strip()
+            if name in headers:
+                headers[name] += ', ' + value
+            else:
+                headers[name] = value
+        return HTTPRequest(parts[0], parts[1], parts[2], headers,
+            self._read_body(headers))
+
+    def _send(self, status, headers, body, keep_alive, version='HTTP/1.1',
+            head_only=False):
+        out = ['%s %d %s\r\n' % (version, status, responses.get(status, ''))]
+        have_length = False
+        for name, value in headers:
+            lname = name.lower()
+            if lname == 'content-length':
+                have_length = True
+            elif lname == 'connection':
+                continue
+            out.append('%s: %s\r\n' % (name, value))
+        if not have_length:
+            out.append('Content-Length: %d\r\n' % len(body))
+        if not keep_alive:
+            out.append('Connection: close\r\n')
+        elif version == 'HTTP/1.0':
+            out.append('Connection: keep-alive\r\n')
+        out.append('\r\n')
+        self.writer.write(''.join(out).encode('latin-1'))
+        if body and not head_only:
+            self.writer.write(body)
+
+    def _handle_one(self):
+        try:
+            req = self._read_message()
+        except _HTTPError as e:
+            self._send(e.status, [], b'', False)
+            return False
+        except EOFError:
+            return False
+        if req is None:
+            return False
+        if 0 < self.max_messages <= self.messages_handled + 1:
+            req.keep_alive = False
+        resp = self.handle_message(req)
+        if isinstance(resp, tuple):
+            status, headers, body = resp
+        else:
+            status, headers, body = 200, [], resp
+        if isinstance(headers, dict):
+            headers = headers.items()
+        if body is None:
+            body = b''
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        elif isinstance(body, memoryview):
+            body = bytes(body)
+        self._send(status, headers, body, req.keep_alive,
+            'HTTP/1.0' if req.version == 'HTTP/1.0' else 'HTTP/1.1',
+            req.method == 'HEAD')
+        return req.keep_alive
+
+    # Hooks to be overridden
+    def handle_message(self, req):
+        """
+        This hook is called for every request on the connection.  req is
+        an HTTPRequest.  Return (status, headers, body), or just the body
+        """
+        return (404, [], b'')
@@ -0,0 +1,257 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Listener specs.  The Manager can serve any number of listening sockets
+# from the same pool of children.  Each is given as a url style string:
+#
+#     tcp://127.0.0.1:8000        tcp over IPv4
+#     tcp://[::1]:8000            tcp over IPv6
+#     udp://0.0.0.0:5353          udp, IPv4 or IPv6 the same way
+#     unix:///run/myapp.sock      A Unix domain stream socket
+#     unix-dgram:///run/myapp.dg  A Unix domain datagram socket
+#     unix://@myapp               A Linux abstract stream socket
+#
+#     manager = Manager(MyChild, listeners=['tcp://0.0.0.0:8000',
+#         'unix:///run/myapp.sock'])
+#
+# In the child, self.listener is the spec of the socket the current
+# connection came in on.  self.protocol is 'tcp' for every stream socket,
+# Unix domain ones included, and 'udp' for every datagram socket.
+#
+# Sockets can also be bound by a supervisor and passed in, either as
+# file descriptor numbers or under systemd's socket activation protocol
+# (LISTEN_FDS/LISTEN_PID).  See the Manager's listen_fds argument and
+# examples/socket-activate.py.
+#
+
+from preforkserver.exceptions import ManagerError
+from collections import namedtuple
+import socket
+import stat
+import os
+
+__all__ = ['ListenerSpec', 'parse_listener', 'legacy_listener',
+    'bind_listener', 'unlink_listener', 'spec_for_socket', 'sd_listen_fds',
+    'inherit_listener']
+
+# The first file descriptor passed under the systemd protocol
+SD_LISTEN_FDS_START = 3
+
+_SCHEMES = {
+    'tcp': socket.SOCK_STREAM,
+    'udp': socket.SOCK_DGRAM,
+    'unix': socket.SOCK_STREAM,
+    'unix-dgram': socket.SOCK_DGRAM,
+}
+
+
+class ListenerSpec(namedtuple('ListenerSpec', ['scheme', 'family', 'type',
+        'address'])):
+    """
+    scheme:str          One of tcp, udp, unix or unix-dgram
+    family:int          The socket address family
+    type:int            socket.SOCK_STREAM or socket.SOCK_DGRAM
+    address:object      The address to bind to.  An (ip, port) tuple for
+                        inet sockets or a path for unix ones.  Abstract
+                        socket paths start with a NUL byte
+    """
+    __slots__ = ()
+
+    @property
+    def protocol(self):
+        """
+        tcp for stream sockets and udp for datagram sockets, which is what
+        the child's protocol is set to
+        """
+        return 'tcp' if self.type == socket.SOCK_STREAM else 'udp'
+
+    @property
+    def is_unix(self):
+        return self.family == getattr(socket, 'AF_UNIX', None)
+
+    @property
+    def is_abstract(self):
+        return self.is_unix and self.address.startswith('\0')
+
+    def __str__(self):
+        if self.is_unix:
+            path = '@' + self.address[1:] if self.is_abstract \
+                else self.address
+            return '%s://%s' % (self.scheme, path)
+        host, port = self.address
+        if self.family == socket.AF_INET6:
+            host = '[%s]' % host
+        return '%s://%s:%d' % (self.scheme, host, port)
+
+
+def _inet_spec(scheme, host, port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return ListenerSpec(scheme, family, _SCHEMES[scheme], (host, int(port)))
+
+
+def parse_listener(spec):
+    """
+    Returns a ListenerSpec for the url style string spec.  A ListenerSpec
+    is returned as is
+    """
+    if isinstance(spec, ListenerSpec):
+        return spec
+    scheme, sep, rest = str(spec).partition('://')
+    scheme = scheme.lower()
+    if not sep or scheme not in _SCHEMES or not rest:
+        raise ManagerError('Invalid listener %r.  Must be one of %s '
+            'followed by :// and an address' % (spec, ', '.join(_SCHEMES)))
+    if scheme.startswith('unix'):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ManagerError('Unix domain sockets are not supported here')
+        if rest.startswith('@'):
+            rest = '\0' + rest[1:]
+        return ListenerSpec(scheme, socket.AF_UNIX, _SCHEMES[scheme], rest)
+    host, sep, port = rest.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ManagerError('Invalid listener %r, no port given' % spec)
+    if host.startswith('['):
+        host = host[1:-1]
+    return _inet_spec(scheme, host, port)
+
+
+def legacy_listener(bind_ip, port, protocol):
+    """
+    Returns the ListenerSpec for the Manager's original bind_ip, port and
+    protocol options
+    """
+    return _inet_spec(protocol, bind_ip, port)
+
+
+def spec_for_socket(sock):
+    """
+    Returns a ListenerSpec describing an already bound socket
+    """
+    stream = sock.type == socket.SOCK_STREAM
+    if sock.family == getattr(socket, 'AF_UNIX', None):
+        addr = sock.getsockname()
+        if isinstance(addr, bytes):
+            addr = addr.decode('utf-8', 'replace')
+        return ListenerSpec('unix' if stream else 'unix-dgram', sock.family,
+            sock.type, addr)
+    return ListenerSpec('tcp' if stream else 'udp', sock.family, sock.type,
+        sock.getsockname()[:2])
+
+
+def bind_listener(spec, backlog, reuse_port=False, profile=None):
+    """
+    Create, bind and, for stream sockets, listen on a socket for spec.
+    A stale socket file left at a unix path is removed first
+
+    spec:ListenerSpec       What to bind
+    backlog:int             The listen backlog
+    reuse_port:bool         Set SO_REUSEPORT as well as SO_REUSEADDR, for
+                            inet sockets
+    profile:SocketProfile   Socket options from preforkserver.tuning
+    """
+    s = socket.socket(spec.family, spec.type)
+    try:
+        if spec.is_unix:
+            if not spec.is_abstract:
+                _remove_stale(spec.address)
+        else:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(spec.address)
+        tcp = spec.type == socket.SOCK_STREAM and not spec.is_unix
+        if profile is not None:
+            if tcp:
+                profile.apply_listener(s, True)
+            else:
+                profile.apply_buffers(s)
+        if spec.type == socket.SOCK_STREAM:
+            s.listen(backlog)
+        if profile is not None and tcp:
+            profile.apply_listener(s, False)
+    except Exception:
+        s.close()
+        raise
+    return s
+
+
+def _remove_stale(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise ManagerError('%s exists and is not a socket' % path)
+    os.unlink(path)
+
+
+def unlink_listener(spec):
+    """
+    Remove the socket file for a unix listener, if there is one
+    """
+    if spec.is_unix and not spec.is_abstract:
+        try:
+            os.unlink(spec.address)
+        except OSError:
+            pass
+
+
+def sd_listen_fds(unset_environment=True):
+    """
+    Returns the file descriptors passed to this process under the systemd
+    socket activation protocol, which is an empty list if there are none
+    or they were meant for another process
+
+    unset_environment:bool  Remove the LISTEN_* variables so that they
+                            aren't passed on to anything this process runs
+    """
+    try:
+        pid = int(os.environ.get('LISTEN_PID', ''))
+        count = int(os.environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    finally:
+        if unset_environment:
+            for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+                os.environ.pop(name, None)
+    if pid != os.getpid() or count < 1:
+        return []
+    return list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count))
+
+
+def inherit_listener(fd):
+    """
+    Wrap an already bound socket, passed in by a supervisor as fd.
+    Returns a (ListenerSpec, socket) tuple
+    """
+    try:
+        sock = socket.socket(fileno=int(fd))
+    except (OSError, socket.error) as e:
+        raise ManagerError('File descriptor %s is not a socket: %s' %
+            (fd, e))
+    if sock.type == socket.SOCK_STREAM and \
+            not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+        # Leave the descriptor open for whoever owns it
+        sock.detach()
+        raise ManagerError('Socket %s is not listening' % fd)
+    # Keep it out of anything the children exec
+    sock.set_inheritable(False)
+    return (spec_for_socket(sock), sock)
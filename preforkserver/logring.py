@@ -0,0 +1,328 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Non-blocking logging for the children.  Each child writes its records
+# into its own single producer/single consumer ring buffer in shared
+# memory, which never blocks.  If the ring is full, the record is dropped
+# and counted.  The manager is the single consumer: it drains all the
+# rings in batches from its main loop and hands them to a sink, so no
+# child ever waits on the disk or syslog.
+#
+#     pipeline = LogPipeline(FileSink('/var/log/myserver.log'))
+#     manager = Manager(MyChild, log_pipeline=pipeline)
+#
+#     # In the child
+#     self.log('handled %s' % self.address[0])
+#
+
+from preforkserver.shm import anon_mmap
+import logging
+import struct
+import time
+import os
+
+__all__ = ['LogPipeline', 'FileSink', 'SyslogSink']
+
+# head, tail and dropped.  head and dropped are only written by the child
+# and tail is only written by the manager
+_RING_HDR = struct.Struct('=QQQ')
+_RING_HDR_SIZE = 64
+# length of the message, time, pid, level.  The level is a full int since
+# logging allows any number, custom levels included
+_REC_HDR = struct.Struct('=IdIi')
+
+
+class _Ring(object):
+    """
+    A view over one ring in the shared mapping
+    """
+
+    def __init__(self, mem, offset, size):
+        self._mem = mem
+        self._hdr = offset
+        self._data = offset + _RING_HDR_SIZE
+        self.size = size
+
+    def _copy_in(self, pos, data):
+        pos %= self.size
+        first = min(len(data), self.size - pos)
+        self._mem[self._data + pos:self._data + pos + first] = data[:first]
+        if first < len(data):
+            rest = len(data) - first
+            self._mem[self._data:self._data + rest] = data[first:]
+
+    def _copy_out(self, pos, length):
+        pos %= self.size
+        first = min(length, self.size - pos)
+        ret = self._mem[self._data + pos:self._data + pos + first]
+        if first < length:
+            ret += self._mem[self._data:self._data + length - first]
+        return ret
+
+    def write(self, msg, level):
+        """
+        Producer side.  Returns False if the record was dropped
+        """
+        head, tail, dropped = _RING_HDR.unpack_from(self._mem, self._hdr)
+        rec = _REC_HDR.pack(len(msg), time.time(), os.getpid(), level) + msg
+        if len(rec) > self.size - (head - tail):
+            struct.pack_into('=Q', self._mem, self._hdr + 16, dropped + 1)
+            return False
+        self._copy_in(head, rec)
+        # Publish the record only once the bytes are in place
+        struct.pack_into('=Q', self._mem, self._hdr, head + len(rec))
+        return True
+
+    def read_all(self):
+        """
+        Consumer side.  Returns a list of (time, pid, level, msg) tuples
+        """
+        ret = []
+        head, tail, dropped = _RING_HDR.unpack_from(self._mem, self._hdr)
+        while tail < head:
+            length, ts, pid, level = _REC_HDR.unpack(
+                self._copy_out(tail, _REC_HDR.size))
+            msg = self._copy_out(tail + _REC_HDR.size, length)
+            ret.append((ts, pid, level, msg.decode('utf-8', 'replace')))
+            tail += _REC_HDR.size + length
+        struct.pack_into('=Q', self._mem, self._hdr + 8, tail)
+        return ret
+
+    def dropped(self):
+        return _RING_HDR.unpack_from(self._mem, self._hdr)[2]
+
+    def reset(self):
+        _RING_HDR.pack_into(self._mem, self._hdr, 0, 0, 0)
+
+
+class LogPipeline(object):
+    """
+    Owns the rings and the sink.  The manager calls setup() with the
+    number of rings to create before any children are forked, and then
+    drain() periodically
+    """
+
+    def __init__(self, sink, ring_size=65536, interval=0.5):
+        """
+        sink:FileSink       Anything with a write(records) method, which
+                            takes a list of (time, pid, level, msg) tuples
+        ring_size:int       The size, in bytes, of each child's ring
+        interval:float      How often, in seconds, the manager drains
+        """
+        self.sink = sink
+        self.ring_size = int(ring_size)
+        self.interval = float(interval)
+        self.dropped = 0
+        self._rings = []
+        self._free = []
+        self._last_dropped = []
+        self._owned = range(0)
+        self._local = []
+        self._mem = None
+        self._next_drain = 0
+        # The ring the current (child) process writes to
+        self._slot = None
+
+    def setup(self, num_rings):
+        """
+        Allocate num_rings rings.  This must happen before the fork
+        """
+        stride = _RING_HDR_SIZE + self.ring_size
+        self._mem = anon_mmap(stride * num_rings)
+        self._rings = [ _Ring(self._mem, i * stride, self.ring_size)
+            for i in range(num_rings) ]
+        self._free = list(range(num_rings - 1, -1, -1))
+        self._last_dropped = [0] * num_rings
+        self._owned = range(num_rings)
+
+    def partition(self, first, count):
+        """
+        Limit this process to count rings, starting at first.  Each
+        sub-manager of a ShardedManager calls this after the fork so that
+        they never hand out, or drain, the same ring
+        """
+        self._owned = range(first, first + count)
+        self._free = list(reversed(self._owned))
+
+    def grow(self, num_rings):
+        """
+        Make sure this process owns at least num_rings rings, for when the
+        pool limits go up.  The extra rings are in a new mapping, which
+        only the children forked from here on share, and they are the
+        only ones that get the new slots.  Returns the number added
+        """
+        add = num_rings - len(self._owned)
+        if add <= 0 or self._mem is None:
+            return 0
+        stride = _RING_HDR_SIZE + self.ring_size
+        mem = anon_mmap(stride * add)
+        first = len(self._rings)
+        self._rings.extend([ _Ring(mem, i * stride, self.ring_size)
+            for i in range(add) ])
+        self._last_dropped.extend([0] * add)
+        self._owned = list(self._owned) + list(range(first, first + add))
+        self._free.extend(range(first + add - 1, first - 1, -1))
+        return add
+
+    def acquire(self):
+        """
+        Reserve a ring for a child which is about to be forked.  Children
+        which are draining or waiting to be reaped still hold theirs, so
+        if all the rings are in use a quarter more are added.  Returns
+        the slot number, or None if that fails too
+        """
+        if not self._free and self._mem is not None:
+            owned = len(self._owned)
+            try:
+                self.grow(owned + max(1, owned // 4))
+            except (OSError, EnvironmentError):
+                pass
+        return self._free.pop() if self._free else None
+
+    def release(self, slot):
+        """
+        Drain and free the ring in slot once its child has exited
+        """
+        if slot is None:
+            return
+        ring = self._rings[slot]
+        records = ring.read_all()
+        if records:
+            self._write(records)
+        self._count_dropped(slot)
+        ring.reset()
+        self._last_dropped[slot] = 0
+        self._free.append(slot)
+
+    def attach(self, slot):
+        """
+        Called in the child to select its ring
+        """
+        self._slot = slot
+
+    def log(self, msg, level=logging.INFO):
+        """
+        Write a record to this child's ring.  This never blocks.  Returns
+        False if the record was dropped
+        """
+        if not isinstance(msg, bytes):
+            msg = str(msg).encode('utf-8')
+        if self._slot is None:
+            # No ring was available for this child
+            return False
+        return self._rings[self._slot].write(msg, level)
+
+    def log_local(self, msg, level=logging.INFO):
+        """
+        Queue a record from the manager itself.  These go out with the
+        next drain
+        """
+        self._local.append((time.time(), os.getpid(), level, str(msg)))
+
+    def drain(self, force=False):
+        """
+        Drain every ring into the sink.  Unless force is set, this only
+        does anything once per interval.  Returns the number of records
+        written
+        """
+        now = time.time()
+        if not force and now < self._next_drain:
+            return 0
+        self._next_drain = now + self.interval
+        records = self._local
+        self._local = []
+        for slot in self._owned:
+            records.extend(self._rings[slot].read_all())
+            self._count_dropped(slot)
+        if records:
+            records.sort(key=lambda r: r[0])
+            self._write(records)
+        return len(records)
+
+    def _count_dropped(self, slot):
+        dropped = self._rings[slot].dropped()
+        self.dropped += dropped - self._last_dropped[slot]
+        self._last_dropped[slot] = dropped
+
+    def _write(self, records):
+        try:
+            self.sink.write(records)
+        except Exception:
+            self.dropped += len(records)
+
+    def close(self):
+        self.drain(True)
+        self.sink.close()
+
+
+class FileSink(object):
+    """
+    Appends records to a file, one batch per write
+    """
+    fmt = '%(time)s [%(pid)d] %(level)s: %(msg)s\n'
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = open(path, 'a')
+
+    def write(self, records):
+        out = []
+        for ts, pid, level, msg in records:
+            out.append(self.fmt % {
+                'time': time.strftime('%Y-%m-%d %H:%M:%S',
+                    time.localtime(ts)) + ('%.3f' % (ts % 1))[1:],
+                'pid': pid,
+                'level': logging.getLevelName(level),
+                'msg': msg,
+            })
+        self._fh.write(''.join(out))
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+
+
+class SyslogSink(object):
+    """
+    Sends records to the local syslog
+    """
+
+    def __init__(self, ident='preforkserver', facility=None):
+        import syslog
+        self._syslog = syslog
+        if facility is None:
+            facility = syslog.LOG_DAEMON
+        syslog.openlog(ident, 0, facility)
+        self._prio = {
+            logging.DEBUG: syslog.LOG_DEBUG,
+            logging.INFO: syslog.LOG_INFO,
+            logging.WARNING: syslog.LOG_WARNING,
+            logging.ERROR: syslog.LOG_ERR,
+            logging.CRITICAL: syslog.LOG_CRIT,
+        }
+
+    def write(self, records):
+        for ts, pid, level, msg in records:
+            self._syslog.syslog(self._prio.get(level, self._syslog.LOG_INFO),
+                '[%d] %s' % (pid, msg))
+
+    def close(self):
+        self._syslog.closelog()
@@ -20,13 +20,22 @@
 
 from preforkserver.exceptions import ManagerError
 from preforkserver.poller import get_poller
+from preforkserver.metrics import Metrics
+from preforkserver.scaling import ChildInfo, PoolSnapshot, DefaultPolicy
+from preforkserver.listeners import parse_listener, legacy_listener, \
+    bind_listener, unlink_listener, sd_listen_fds, inherit_listener
+from preforkserver.tuning import default_backlog, tcp_migrate_req
+from preforkserver.steering import ReusePortSteering
+import preforkserver.sockstats as sockstats
 import preforkserver.events as pfe
 import multiprocessing as mp
+from collections import deque
 import select
 import threading
 import weakref
 import signal
 import socket
+import time
 import os
 
 __all__ = ['Manager']
@@ -36,12 +45,20 @@ class ManagerChild(object):
     """
     Class to represent a child in the Manager
     """
+    # There is one of these per child, so keep them small
+    __slots__ = ('pid', 'conn', 'current_state', 'total_processed',
+        'started', 'state_since', 'log_slot', 'outbox')
 
     def __init__(self, pid, parent_conn):
         self.pid = pid
         self.conn = parent_conn
-        self.current_state = pfe.WAITING
+        self.current_state = pfe.STARTING
         self.total_processed = 0
+        self.started = time.time()
+        self.state_since = self.started
+        self.log_slot = None
+        # Broadcasts which didn't fit in the pipe yet, by topic
+        self.outbox = {}
 
     def close(self):
         self.conn.close()
@@ -56,8 +73,18 @@ class Manager(object):
     def __init__(self, child_class, child_args=None, child_kwargs=None, 
             max_servers=20, min_servers=5,
             min_spare_servers=2, max_spare_servers=10, max_requests=0, 
-            bind_ip='127.0.0.1', port=10000, protocol='tcp', listen=5 ,
-            reuse_port=False):
+            bind_ip='127.0.0.1', port=10000, protocol='tcp', listen=None,
+            reuse_port=False, tracer=None, crash_window=60,
+            crash_threshold=10, crash_backoff=0.5, crash_backoff_max=30,
+            stats_interval=5, load_shedding=False, shed_queue_depth=1,
+            rate_limiter=None, access_list=None, log_pipeline=None,
+            scaling_policy=None, read_timeout=None, write_timeout=None,
+            request_timeout=None, min_recv_rate=None,
+            min_recv_rate_grace=5, write_buffer_size=16384,
+            tcp_cork=False, read_buffer_size=4096, max_read_size=1048576,
+            listeners=None, tls=None, socket_profile=None,
+            shared_cache=None, singleflight=None, steering=None,
+            drain_timeout=5, autosize=None, listen_fds=None):
         """
         child_class<BaseChild>       : An implentation of BaseChild to define
                                        the child processes
@@ -75,7 +102,8 @@ class Manager(object):
         bind_ip<str>                 : The IP address to bind to
         port<int>                    : The port that the server should listen on
         protocol<str>                  : The protocol to use (tcp or udp)
-        listen<int>                  : Listen backlog
+        listen<int>                  : Listen backlog.  The default is
+                                       the kernel's limit, somaxconn
         reuse_port<bool>             : This will use SO_REUSEPORT and create
                                        the listen sock in each child rather
                                        than in the parent process.  
@@ -83,6 +111,138 @@ class Manager(object):
                                        balanced distribution of connections
                                        and it is highly recommended that
                                        you turn this on if available
+        tracer<Tracer>               : A preforkserver.tracing.Tracer.  If
+                                       set, a sampled subset of requests
+                                       in the children will be traced with
+                                       a span for each hook
+        crash_window<float>          : The sliding window, in seconds, used
+                                       for crash loop detection
+        crash_threshold<int>         : The number of children exiting with
+                                       an error within crash_window which
+                                       puts the manager in a degraded,
+                                       crash looping state
+        crash_backoff<float>         : The initial delay, in seconds,
+                                       between forks while degraded.  This
+                                       doubles with each further error exit
+        crash_backoff_max<float>     : The maximum delay between forks while
+                                       degraded
+        stats_interval<float>        : How often, in seconds, to sample the
+                                       kernel's accept queue and drop
+                                       counters for the listening
+                                       socket(s).  Zero disables sampling
+        load_shedding<bool>          : If True, children will quickly reject
+                                       connections, via the overloaded()
+                                       hook, when all max_servers children
+                                       are busy
+        shed_queue_depth<int>        : With load_shedding on, only shed a
+                                       connection if at least this many
+                                       more are waiting in the accept queue
+                                       (tcp only).  This keeps the queue
+                                       short without rejecting everything
+        rate_limiter<TokenBucketTable> : A shared memory rate limiter from
+                                       preforkserver.ratelimit.  This is
+                                       available in all the children as
+                                       self.rate_limiter
+        access_list<CIDRMatcher>     : A compiled prefix matcher from
+                                       preforkserver.cidr.  This is
+                                       available in all the children as
+                                       self.access_list, and is reloaded
+                                       from its source on SIGHUP
+        log_pipeline<LogPipeline>    : A preforkserver.logring.LogPipeline.
+                                       If set, each child gets its own
+                                       shared memory ring to log() into,
+                                       which the manager drains to the
+                                       pipeline's sink.  log() in the
+                                       manager goes to the same sink
+        scaling_policy<ScalingPolicy> : A preforkserver.scaling.ScalingPolicy
+                                       which decides when to fork and kill
+                                       children.  The default is the
+                                       DefaultPolicy, which uses the
+                                       server and spare limits above
+        read_timeout<float>          : The max seconds a child will wait on
+                                       any single read from a tcp client
+        write_timeout<float>         : The max seconds a child will wait on
+                                       any single write to a tcp client
+        request_timeout<float>       : The max seconds of I/O for an entire
+                                       tcp connection
+        min_recv_rate<float>         : The minimum average bytes/second a
+                                       tcp client must send once
+                                       min_recv_rate_grace seconds have
+                                       passed, to drop trickling clients
+        min_recv_rate_grace<float>   : See min_recv_rate
+        write_buffer_size<int>       : The number of bytes a child's
+                                       self.writer will queue before it
+                                       sends them
+        tcp_cork<bool>               : Set TCP_CORK on a connection while
+                                       its self.writer has a response in
+                                       progress (Linux only)
+        read_buffer_size<int>        : The size of the first buffer a
+                                       child's self.reader reads into
+        max_read_size<int>           : The most self.reader will buffer
+                                       looking for a delimiter, or read at
+                                       once.  Going over raises
+                                       ReadLimitError
+        listeners<list>              : A list of listener specs, like
+                                       tcp://[::1]:8000 or
+                                       unix:///run/app.sock (see
+                                       preforkserver.listeners), all
+                                       served by the same children.  This
+                                       replaces bind_ip, port and protocol.
+                                       With reuse_port, unix sockets are
+                                       still bound here and shared
+        tls<TLSConfig>               : A preforkserver.tls.TLSConfig.  If
+                                       set, connections on the tcp
+                                       listeners are TLS.  The context is
+                                       built here, before forking
+        socket_profile<SocketProfile> : A preforkserver.tuning.SocketProfile
+                                       of options for the tcp listeners
+                                       and accepted connections.  What the
+                                       kernel actually set is in
+                                       socket_options
+        shared_cache<SharedCache>    : A shared memory cache from
+                                       preforkserver.sharedcache.  This is
+                                       available in all the children as
+                                       self.shared_cache
+        singleflight<SingleFlight>   : A preforkserver.singleflight
+                                       .SingleFlight, so only one child
+                                       at a time calls the backend for a
+                                       key.  This is available in all the
+                                       children as self.singleflight
+        steering<ReusePortSteering>  : With reuse_port, steer connections
+                                       to a stable child by client address
+                                       or CPU.  See preforkserver.steering
+        drain_timeout<float>         : With reuse_port, a child which is
+                                       exiting normally serves what is left
+                                       in its own accept queue, for up to
+                                       this many seconds, before closing
+                                       its socket.  It is taken out of the
+                                       group first, using 'flow' steering
+                                       if none was given.  This is skipped
+                                       when net.ipv4.tcp_migrate_req is
+                                       on, since then the kernel hands
+                                       the queue to another child.  Zero
+                                       disables draining
+        autosize<CgroupAutoSizer>    : Work out the pool limits from the
+                                       cgroup's CPU quota, memory limit
+                                       and memory pressure and keep them
+                                       up to date.  The limits given above
+                                       set the ratios, and max_servers is
+                                       also the cap until the children's
+                                       memory has been measured.  See
+                                       preforkserver.autosize
+        listen_fds<list>             : Serve sockets which were bound by a
+                                       supervisor and passed in, rather
+                                       than binding any.  This is a list
+                                       of file descriptor numbers, or True
+                                       for the systemd LISTEN_FDS and
+                                       LISTEN_PID protocol.  With True,
+                                       if nothing was passed in, the
+                                       listeners are bound as usual.
+                                       Passed in sockets override
+                                       listeners, bind_ip, port and
+                                       protocol, are shared by the
+                                       children even with reuse_port, and
+                                       are never unlinked
         """
         if not child_args:
             child_args = []
@@ -113,18 +273,119 @@ class Manager(object):
                 'than maxSpareServers!')
 
         self.max_requests = int(max_requests)
-        self.bind_ip = bind_ip
-        self.port = int(port)
-        self.protocol = protocol.lower()
-        if protocol not in self.validProtocols:
-            raise ManagerError('Invalid protocol %s, must be in: %r' %
-                (protocol, self.validProtocols))
-
-        self.listen = int(listen)
+        # (ListenerSpec, socket) for each socket passed in by a supervisor
+        self._inherited = []
+        if listen_fds:
+            fds = sd_listen_fds() if listen_fds is True else listen_fds
+            self._inherited = [ inherit_listener(fd) for fd in fds ]
+        if self._inherited:
+            self.listeners = [ spec for spec, sock in self._inherited ]
+        elif listeners:
+            self.listeners = [ parse_listener(l) for l in listeners ]
+        else:
+            protocol = protocol.lower()
+            if protocol not in self.validProtocols:
+                raise ManagerError('Invalid protocol %s, must be in: %r' %
+                    (protocol, self.validProtocols))
+            self.listeners = [ legacy_listener(bind_ip, port, protocol) ]
+        # These describe the first listener
+        first = self.listeners[0]
+        self.protocol = first.protocol
+        self.bind_ip = first.address[0] if not first.is_unix else None
+        self.port = first.address[1] if not first.is_unix else 0
+
+        self.listen = int(listen) if listen else default_backlog()
         self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.tracer = tracer
+        self.crash_window = float(crash_window)
+        self.crash_threshold = int(crash_threshold)
+        self.crash_backoff = float(crash_backoff)
+        self.crash_backoff_max = float(crash_backoff_max)
+        self.degraded = False
+        self._error_exits = deque()
+        self._backoff = self.crash_backoff
+        self._next_spawn = 0
+        self.metrics = Metrics()
+        self.stats_interval = float(stats_interval)
+        self.socket_stats = {}
+        # The number of connections (tcp) or bytes (udp) waiting in the
+        # kernel for a child to pick up, as of the last sample
+        self.queue_depth = 0
+        self._next_stats = 0
+        self._last_overflows = None
+        self.load_shedding = bool(load_shedding)
+        self.shed_queue_depth = int(shed_queue_depth)
+        # This is shared with the children, which check it after accepting
+        self._saturated = mp.RawValue('b', 0) if self.load_shedding else None
+        self.rate_limiter = rate_limiter
+        self.access_list = access_list
+        # Set by the SIGHUP handler, for the main loop to act on
+        self._reload_pending = False
+        self.shared_cache = shared_cache
+        self.singleflight = singleflight
+        self.drain_timeout = float(drain_timeout)
+        # Whether the kernel migrates the queue of a closed reuse_port
+        # socket to the rest of its group
+        self.tcp_migrate_req = self.reuse_port and tcp_migrate_req()
+        self.steering = steering
+        if self.steering is not None and not self.reuse_port:
+            raise ManagerError('steering requires reuse_port')
+        if self.steering is None and self.reuse_port and \
+                self.drain_timeout and not self.tcp_migrate_req:
+            # A draining child has to leave the group, or the kernel
+            # keeps sending it new connections
+            self.steering = ReusePortSteering('flow')
+        if self.steering is not None:
+            seats = self.max_servers
+            if autosize is not None and autosize.ceiling:
+                seats = max(seats, int(autosize.ceiling))
+            self.steering.setup(seats)
+        self.log_pipeline = log_pipeline
+        # Slots of killed children, queued by the reaper threads for
+        # release once the process is really gone
+        self._reaped_log_slots = deque()
+        self._child_log_slot = None
+        self.autosize = autosize
+        if self.autosize is not None:
+            self.autosize.adjust(self, [])
+            self._autosize_metrics()
+        if self.log_pipeline is not None:
+            self.log_pipeline.setup(self.max_servers)
+        if self.reuse_port and not self.tcp_migrate_req:
+            self.log('net.ipv4.tcp_migrate_req is off; exiting children '
+                'will drain their own accept queues')
+        self.scaling_policy = scaling_policy if scaling_policy is not None \
+            else DefaultPolicy()
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.request_timeout = request_timeout
+        self.min_recv_rate = min_recv_rate
+        self.min_recv_rate_grace = float(min_recv_rate_grace)
+        self.write_buffer_size = int(write_buffer_size)
+        self.tcp_cork = tcp_cork
+        self.read_buffer_size = int(read_buffer_size)
+        self.max_read_size = int(max_read_size)
+        self.tls = tls
+        self.socket_profile = socket_profile
+        # The effective socket options of each listener bound here, by
+        # listener
+        self.socket_options = {}
+        # The last message broadcast on each topic, as (seq, version,
+        # data).  Children forked later start from these
+        self.broadcasts = {}
+        self._broadcast_seq = 0
+        if self.tls is not None:
+            self.tls.setup()
+        # A list of (ListenerSpec, socket) for the sockets bound here
+        self.listen_sockets = list(self._inherited)
         self.server_socket = None
         self._stop = threading.Event()
+        # Set in the sub-managers of a ShardedManager, for talking to the
+        # top level manager
+        self._uplink = None
         self._children = {}
+        # Children which hit max_requests and are draining, by pipe fd
+        self._draining = {}
         self._poll = get_poller(select.POLLIN | select.POLLPRI)
 
         # Bind the socket now so that it can be used before run is called
@@ -133,37 +394,71 @@ class Manager(object):
             self.pre_bind()
             self._bind()
             self.post_bind()
+        else:
+            # Only binds the listeners which can't use SO_REUSEPORT
+            self._bind()
 
     @property
     def bound_address(self):
         """
-        returns the newly bound server address as an (ip, port) tuple
+        returns the newly bound server address as an (ip, port) tuple, or
+        the path for a unix socket
         """
         ret = None 
         if self.server_socket is not None:
             ret = self.server_socket.getsockname()
         return ret
 
+    @property
+    def bound_addresses(self):
+        """
+        returns a list of the bound addresses of all the sockets bound in
+        the manager
+        """
+        return [ sock.getsockname() for spec, sock in self.listen_sockets ]
+
     def _start_child(self):
         """
-        Fork off a child and set up communication pipes
+        Fork off a child and set up communication pipes.  Returns False if
+        the fork was held back due to crash loop backoff
         """
+        if not self._spawn_allowed():
+            return False
         parent_pipe, child_pipe = mp.Pipe()
         self._poll.register(parent_pipe)
-        manager = weakref.proxy(self) if self.reuse_port else None
+        manager = weakref.proxy(self)
+        if self.log_pipeline is not None:
+            self._release_log_slots()
+            self._child_log_slot = self.log_pipeline.acquire()
+            if self._child_log_slot is None:
+                # Its log() calls will fail
+                self.metrics.incr('log.no_ring')
         pid = os.fork()
 
         if not pid:
-            ch = self._ChildClass(self.max_requests, child_pipe, 
-                self.protocol, self.server_socket, manager ,
-                self._child_args, self._child_kwargs)
             parent_pipe.close()
+            if self._uplink is not None:
+                self._uplink.conn.close()
+            try:
+                ch = self._ChildClass(self.max_requests, child_pipe, 
+                    self.protocol, self.server_socket, manager ,
+                    self._child_args, self._child_kwargs)
+            except Exception as e:
+                # Never let an exception in the child's initialization
+                # escape into the forked copy of the manager loop
+                try:
+                    child_pipe.send([pfe.EXITING_ERROR,
+                        'initialization failed: %s' % e])
+                finally:
+                    os._exit(1)
             ch.run()
         else:
-            self._children[parent_pipe.fileno()] = ManagerChild(pid,
-                                                                parent_pipe)
+            child = ManagerChild(pid, parent_pipe)
+            child.log_slot = self._child_log_slot
+            self._children[parent_pipe.fileno()] = child
             child_pipe.close()
-            return
+            self.metrics.incr('children.forked')
+            return True
 
     def _kill_child(self, child, background=True):
         """
@@ -177,73 +472,349 @@ class Manager(object):
         except:
             pass
 
+        self._children.pop(fd, None)
+        self._draining.pop(fd, None)
+
         try:
             child.conn.send([pfe.CLOSE, ''])
             child.close()
         except IOError:
             pass
 
-        if fd in self._children:
-            del self._children[fd]
         if background:
-            t = threading.Thread(target=os.waitpid, args=(child.pid, 0))
+            t = threading.Thread(target=self._reap, args=(child,))
             t.daemon = True
             t.start()
         else:
             os.waitpid(child.pid, 0)
+            self._reaped(child)
+            if self.log_pipeline is not None:
+                self.log_pipeline.release(child.log_slot)
+
+    def _reap(self, child):
+        """
+        Wait for a killed child, in a background thread
+        """
+        os.waitpid(child.pid, 0)
+        self._reaped(child)
+        # The log ring can only be reused once the child can no longer
+        # write to it.  The main loop does the actual release
+        self._reaped_log_slots.append(child.log_slot)
 
     def _handle_child_event(self, child):
-        event, msg = child.conn.recv()
+        try:
+            event, msg = child.conn.recv()
+        except EOFError:
+            # The child went away without telling us
+            event, msg = pfe.EXITING_ERROR, 'child exited unexpectedly'
         event = int(event)
 
-        if event & pfe.EXITING:
+        if event & pfe.STATS:
+            for key, val in msg.items():
+                self.metrics.incr('child.%s' % key, val)
+        elif event & pfe.EXITING:
+            self.metrics.incr('children.exits')
             if event == pfe.EXITING_ERROR:
                 self.log('Child %d exited due to error: %s' % (child.pid, msg))
+                self._record_error_exit()
             fd = child.conn.fileno()
             self._poll.unregister(child.conn)
-            del self._children[fd]
+            self._children.pop(fd, None)
+            self._draining.pop(fd, None)
             child.close()
             os.waitpid(child.pid, 0)
+            self._reaped(child)
+            if self.log_pipeline is not None:
+                self.log_pipeline.release(child.log_slot)
+        elif event & pfe.DRAINING:
+            # The child is out of the pool, so it can be replaced, but the
+            # pipe stays open for its last stats and EXITING_MAX
+            fd = child.conn.fileno()
+            del self._children[fd]
+            self._draining[fd] = child
+            self.metrics.incr('children.draining')
         else:
-            child.current_state = int(event)
+            if event == pfe.READY:
+                # The child is now a spare
+                event = pfe.WAITING
+                self.metrics.incr('children.ready')
+            if event != child.current_state:
+                child.state_since = time.time()
+            child.current_state = event
             child.total_processed = int(msg)
 
+    def broadcast(self, topic, data=None, version=None):
+        """
+        Send a message to every child.  Each child gets it between requests
+        in its on_broadcast() hook.  The last message on each topic is
+        kept, and children started later get it right after warmup(), so
+        the whole pool always sees the latest of each.  Returns the
+        sequence number of the message
+
+        The message goes through each child's pipe, so keep data small.
+        For big data, put it in shared memory or a file and broadcast
+        where to find it.  A child whose pipe is full gets it from the
+        main loop once there is room, and a newer message on the same
+        topic replaces one still waiting.
+
+        topic:str       What the message is about, e.g. 'config'
+        data:object     Anything that can be pickled
+        version:object  An application version for the data.  This
+                        defaults to the sequence number
+        """
+        self._broadcast_seq += 1
+        seq = self._broadcast_seq
+        if version is None:
+            version = seq
+        self.broadcasts[topic] = (seq, version, data)
+        msg = (seq, topic, version, data)
+        for child in list(self._children.values()):
+            # Only the latest message on a topic matters, so a newer one
+            # replaces one still waiting
+            if child.outbox.pop(topic, None) is not None:
+                self.metrics.incr('broadcast.superseded')
+            child.outbox[topic] = msg
+            self._flush_outbox(child)
+            if topic in child.outbox:
+                self.metrics.incr('broadcast.deferred')
+        return seq
+
+    def _flush_outbox(self, child):
+        """
+        Send child its queued broadcasts for as long as its pipe has room.
+        A busy child doesn't read its pipe, and the manager must never
+        block on one, so whatever is left waits for the next pass of the
+        loop
+        """
+        if not child.outbox:
+            return
+        poll = select.poll()
+        poll.register(child.conn.fileno(), select.POLLOUT)
+        while child.outbox and poll.poll(0):
+            msg = child.outbox.pop(next(iter(child.outbox)))
+            try:
+                child.conn.send([pfe.BROADCAST, msg])
+            except (IOError, OSError):
+                # The child is on its way out.  The loop will reap it
+                child.outbox.clear()
+                return
+            self.metrics.incr('broadcast.sent')
+
+    def _autosize_metrics(self):
+        a = self.autosize
+        self.metrics.gauge('autosize.max_servers', self.max_servers)
+        self.metrics.gauge('autosize.cpus', a.cpus)
+        self.metrics.gauge('autosize.memory_limit', a.memory_limit or 0)
+        self.metrics.gauge('autosize.child_pss', a.child_pss or 0)
+        self.metrics.gauge('autosize.memory_pressure', a.pressure or 0)
+
+    def _record_error_exit(self):
+        """
+        Track an error exit for crash loop detection
+        """
+        now = time.time()
+        self.metrics.incr('children.error_exits')
+        self._error_exits.append(now)
+        self._trim_error_exits(now)
+        if self.degraded:
+            self._backoff = min(self._backoff * 2, self.crash_backoff_max)
+        elif len(self._error_exits) >= self.crash_threshold:
+            self.degraded = True
+            self._backoff = self.crash_backoff
+            self._next_spawn = now + self._backoff
+            self.log('Crash loop detected: %d children exited with errors '
+                'in the last %ds.  Backing off forks' %
+                (len(self._error_exits), self.crash_window))
+        self._update_crash_metrics()
+
+    def _trim_error_exits(self, now):
+        while self._error_exits and \
+                self._error_exits[0] < now - self.crash_window:
+            self._error_exits.popleft()
+
+    def _check_crash_loop(self):
+        """
+        Leave the degraded state once no child has exited with an error
+        for a full crash_window
+        """
+        if not self.degraded:
+            return
+        now = time.time()
+        self._trim_error_exits(now)
+        if not self._error_exits:
+            self.degraded = False
+            self._backoff = self.crash_backoff
+            self._next_spawn = 0
+            self.log('Crash loop has cleared, resuming normal forking')
+            self._update_crash_metrics()
+
+    def _spawn_allowed(self):
+        """
+        Returns whether a fork is allowed right now.  This is always True
+        unless we are in a crash loop
+        """
+        if not self.degraded:
+            return True
+        now = time.time()
+        if now < self._next_spawn:
+            self.metrics.incr('crash_loop.forks_delayed')
+            return False
+        self._next_spawn = now + self._backoff
+        return True
+
+    def _update_crash_metrics(self):
+        self.metrics.gauge('crash_loop.degraded', int(self.degraded))
+        self.metrics.gauge('crash_loop.backoff',
+            self._backoff if self.degraded else 0)
+        self.metrics.gauge('crash_loop.recent_error_exits',
+            len(self._error_exits))
+
+    def _drain_logs(self, force=False):
+        """
+        Drain the children's log rings into the sink
+        """
+        if self.log_pipeline is None:
+            return
+        self._release_log_slots()
+        self.log_pipeline.drain(force)
+        self.metrics.gauge('log.dropped', self.log_pipeline.dropped)
+
+    def _release_log_slots(self):
+        """
+        Free the log rings of the children the reaper threads are done
+        with
+        """
+        while self._reaped_log_slots:
+            self.log_pipeline.release(self._reaped_log_slots.popleft())
+
+    def _sample_socket_stats(self):
+        """
+        Sample the kernel queue stats for the listening socket(s) and
+        update the metrics.  For reuse_port, this covers every child's
+        socket
+        """
+        if not self.stats_interval:
+            return
+        now = time.time()
+        if now < self._next_stats:
+            return
+        self._next_stats = now + self.stats_interval
+        stats = self._listener_stats()
+        self.socket_stats = stats
+        if not stats:
+            # Only unix listeners, which there are no queue numbers for
+            self.queue_depth = 0
+            return
+        for key, val in stats.items():
+            self.metrics.gauge('%s.%s' % (self.protocol, key), val)
+
+        if self.protocol == 'tcp':
+            self.queue_depth = stats.get('queue', 0)
+            overflows = stats.get('listen_overflows')
+            if overflows is not None:
+                if self._last_overflows is not None and \
+                        overflows > self._last_overflows:
+                    self.log('Listen queue overflows went up by %d '
+                        '(host wide).  Current queue: %d, backlog: %s' %
+                        (overflows - self._last_overflows, self.queue_depth,
+                        stats.get('backlog', self.listen)))
+                self._last_overflows = overflows
+        else:
+            self.queue_depth = stats.get('rx_queue', 0)
+
+    def _listener_stats(self):
+        """
+        Sample every inet listener with the same protocol as the first
+        one and add the numbers up.  The kernel doesn't give us queue
+        numbers for unix sockets
+        """
+        bound = dict([ (spec, sock) for spec, sock in self.listen_sockets ])
+        ret = {}
+        for spec in self.listeners:
+            if spec.is_unix or spec.protocol != self.protocol:
+                continue
+            sock = bound.get(spec)
+            port = sock.getsockname()[1] if sock is not None \
+                else spec.address[1]
+            for key, val in sockstats.sample(spec.protocol, port,
+                    sock).items():
+                if key not in ret:
+                    ret[key] = val
+                elif key.endswith('_max'):
+                    ret[key] = max(ret[key], val)
+                elif key not in ('listen_overflows', 'listen_drops'):
+                    # The overflow and drop counters are host wide
+                    ret[key] += val
+        return ret
+
+    def snapshot(self):
+        """
+        Returns a preforkserver.scaling.PoolSnapshot of the current state
+        of the children and the pool limits
+        """
+        now = time.time()
+        children = []
+        for ch in self._children.values():
+            busy_for = now - ch.state_since \
+                if ch.current_state & pfe.BUSY else 0
+            children.append(ChildInfo(ch.pid, ch.current_state,
+                ch.total_processed, now - ch.started, busy_for))
+        return PoolSnapshot(children, self.max_servers, self.min_servers,
+            self.min_spares, self.max_spares, self.queue_depth, now)
+
     def _assess_state(self):
         """
         Check the state of all the children and handle startups and shutdowns
         accordingly
         """
-        total_busy = 0
-        children = list(self._children.values())
-        num_children = len(children)
-
-        for ch in children:
-            if ch.current_state & pfe.BUSY:
-                total_busy += 1
-
-        spares = num_children - total_busy
-        if spares < self.min_spares:
-            # We need to fork more children
-            diff2max = self.max_servers - num_children
-            to_fork = spares
-            if diff2max - spares < 0:
-                to_fork = diff2max
-            for i in range(to_fork):
-                self._start_child()
-        elif spares > self.max_spares + self.min_servers:
-            # We have too many spares and need to kill some
-            to_kill = spares - self.max_spares
-            children = sorted(children,
-                cmp=lambda x, y: cmp(x.total_processed, y.total_processed),
-                reverse=True)
+        self._check_crash_loop()
+        snap = self.snapshot()
+        num_children = len(snap.children)
+        total_busy = len([ ch for ch in snap.children
+            if ch.state & pfe.BUSY ])
+        starting = len([ ch for ch in snap.children
+            if ch.state & pfe.STARTING ])
+
+        # Children which are still starting are not spares
+        spares = num_children - total_busy - starting
+        saturated = num_children >= self.max_servers and not spares
+        self.metrics.gauge('pool.children', num_children)
+        self.metrics.gauge('pool.busy', total_busy)
+        self.metrics.gauge('pool.starting', starting)
+        self.metrics.gauge('pool.saturated', int(saturated))
+        if self._saturated is not None:
+            self._saturated.value = int(saturated)
 
+        to_fork, to_kill = self.scaling_policy.assess(snap)
+        if to_kill:
+            by_pid = dict([ (ch.pid, ch) for ch in self._children.values() ])
             # Send closes
-            for ch in children[:to_kill]:
+            for pid in to_kill:
+                if pid in by_pid:
+                    self._kill_child(by_pid[pid])
+                    num_children -= 1
+
+        if num_children > self.max_servers:
+            # The limits were lowered.  Kill idle children to get back
+            # under max_servers
+            killed = set(to_kill)
+            idle = [ ch for ch in self._children.values()
+                if ch.current_state & pfe.WAITING and ch.pid not in killed ]
+            for ch in idle[:num_children - self.max_servers]:
                 self._kill_child(ch)
+                num_children -= 1
+
+        for i in range(min(to_fork, self.max_servers - num_children)):
+            if not self._start_child():
+                break
 
-        if num_children < self.min_servers:
-            for i in range(self.min_servers - num_children):
-                self._start_child()
+    def _reaped(self, child):
+        """
+        Called once a child is gone.  If it died without leaving the
+        steering group, drop it from there
+        """
+        if self.steering is not None:
+            self.steering.reap(child.pid)
 
     def _init_children(self):
         for i in range(self.min_servers):
@@ -251,21 +822,25 @@ class Manager(object):
 
     def _bind(self):
         """
-        Bind the socket
+        Bind the sockets
         """
-        if self.reuse_port:
-            # The socket will be created in the child processes
-            return
-        address = (self.bind_ip, self.port)
-        protocol = socket.SOCK_STREAM
-        if self.protocol == 'udp':
-            protocol = socket.SOCK_DGRAM
-
-        self.server_socket = socket.socket(socket.AF_INET, protocol)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind(address)
-        if self.protocol == 'tcp':
-            self.server_socket.listen(self.listen)
+        inherited = set([ spec for spec, sock in self._inherited ])
+        for spec in self.listeners:
+            if spec in inherited:
+                continue
+            if self.reuse_port and not spec.is_unix:
+                # The socket will be created in the child processes
+                continue
+            sock = bind_listener(spec, self.listen,
+                profile=self.socket_profile)
+            self.listen_sockets.append((spec, sock))
+            if self.socket_profile is not None:
+                self.socket_options[str(spec)] = \
+                    self.socket_profile.effective(sock)
+                self.log('Socket options for %s: %r' % (spec,
+                    self.socket_options[str(spec)]))
+        if self.listen_sockets:
+            self.server_socket = self.listen_sockets[0][1]
 
     def _signal_setup(self):
         # Set the signal handlers
@@ -294,6 +869,11 @@ class Manager(object):
                 if fd in self._children:
                     ch = self._children[fd]
                     self._handle_child_event(ch)
+                elif fd in self._draining:
+                    self._handle_child_event(self._draining[fd])
+                elif self._uplink is not None and \
+                        fd == self._uplink.fileno():
+                    self._uplink.handle(self)
                 else:
                     try:
                         self._poll.unregister(sock)
@@ -304,20 +884,51 @@ class Manager(object):
                     except Exception as e:
                         self.log('Error closing child pipe: %s' % e)
 
+            if self._reload_pending:
+                self._reload_pending = False
+                self.reload_access_list()
+            for child in list(self._children.values()):
+                self._flush_outbox(child)
+            self._drain_logs()
+            self._sample_socket_stats()
+            if self.tls is not None:
+                self.tls.maybe_rotate()
+            if self.autosize is not None and \
+                    self.autosize.maybe_adjust(self):
+                self._autosize_metrics()
+                if self.log_pipeline is not None:
+                    self.log_pipeline.grow(self.max_servers)
+                self.log('Pool limits adjusted to max_servers=%d '
+                    'min_servers=%d min_spares=%d max_spares=%d' %
+                    (self.max_servers, self.min_servers, self.min_spares,
+                    self.max_spares))
             self._assess_state()
+            if self._uplink is not None:
+                self._uplink.report(self)
 
     def _shutdown_server(self):
         self.log('Starting server shutdown')
-        children = list(self._children.values())
+        children = list(self._children.values()) + \
+            list(self._draining.values())
 
         # First loop through and tell the children to close
         for child in children:
             self._kill_child(child, False)
 
-        if self.server_socket:
-            self.server_socket.close()
+        for spec, sock in self.listen_sockets:
+            sock.close()
+            if self._uplink is None and (spec, sock) not in self._inherited:
+                # In a shard, the top level manager does this, and the
+                # supervisor owns the ones it passed in
+                unlink_listener(spec)
+
+        if self.access_list is not None:
+            self.access_list.close()
 
         self.log('Server shutdown completed')
+        if self.log_pipeline is not None:
+            self._drain_logs(True)
+            self.log_pipeline.close()
 
     def run(self):
         self.pre_signal_setup()
@@ -401,9 +1012,27 @@ class Manager(object):
     # Signal handling.  These can be overridden in a subclass as well
     def hup_handler(self, frame, num):
         """
-        Handle a SIGHUP.  By default, this does nothing
+        Handle a SIGHUP.  By default, this has the main loop reload the
+        access_list, if there is one with a source file, and otherwise
+        does nothing
         """
-        return
+        if self.access_list is not None and self.access_list.source:
+            self._reload_pending = True
+
+    def reload_access_list(self):
+        """
+        Recompile the access_list from its source.  The children pick up
+        the new prefixes on their next lookup.  On failure, the current
+        prefixes stay in place
+        """
+        try:
+            self.access_list.reload()
+        except Exception as e:
+            self.log('Failed to reload the access list from %s: %s' %
+                (self.access_list.source, e))
+        else:
+            self.log('Reloaded the access list from %s: %d intervals' %
+                (self.access_list.source, len(self.access_list)))
 
     def int_handler(self, frame, num):
         """
@@ -421,6 +1050,8 @@ class Manager(object):
     def log(self, msg):
         """
         You can define a logging method and log internal messages and messages
-        you generate.  By default, this does nothing.
+        you generate.  By default, this does nothing unless a log_pipeline
+        was given, in which case the message goes to its sink.
         """
-        return
+        if self.log_pipeline is not None:
+            self.log_pipeline.log_local(msg)
@@ -0,0 +1,64 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A very small metrics registry.  The Manager keeps one of these in
+# self.metrics and updates it from the main loop.  There is no export
+# mechanism here on purpose; call snapshot() from one of the manager
+# hooks and ship the numbers wherever you need them.
+#
+
+__all__ = ['Metrics']
+
+
+class Metrics(object):
+    """
+    Holds named counters, which only go up, and gauges, which are set to
+    a point in time value
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+
+    def incr(self, name, value=1):
+        """
+        Increment the counter, name, by value
+        """
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Set the gauge, name, to value
+        """
+        self._gauges[name] = value
+
+    def get(self, name, default=0):
+        if name in self._gauges:
+            return self._gauges[name]
+        return self._counters.get(name, default)
+
+    def snapshot(self):
+        """
+        Returns a dict of all the current counters and gauges
+        """
+        ret = dict(self._counters)
+        ret.update(self._gauges)
+        return ret
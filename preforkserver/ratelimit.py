@@ -0,0 +1,147 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A per-client token bucket rate limiter which lives in shared memory, so
+# every child of a Manager sees the same buckets.  Pass an instance to the
+# Manager as rate_limiter and use it from allow_deny():
+#
+#     def allow_deny(self):
+#         return self.rate_limiter.allow(self.address[0])
+#
+
+from preforkserver.shm import anon_mmap, StripedLock, key_hash
+import struct
+import time
+
+__all__ = ['TokenBucketTable']
+
+# Each slot is: key hash, tokens, last update time
+_SLOT = struct.Struct('=Qdd')
+# The number of slots in each bucket.  A key only ever lives in its own
+# bucket, so a lookup touches at most this many slots
+BUCKET_SLOTS = 8
+
+
+class TokenBucketTable(object):
+    """
+    A fixed size hash table of token buckets in shared memory.  Keys hash
+    to a bucket of BUCKET_SLOTS slots, and each bucket is protected by one
+    of a set of striped locks.  When a bucket is full, the least recently
+    used slot is evicted, so stale clients age out on their own.
+
+    This must be created in the manager process, before the children
+    are forked
+    """
+
+    def __init__(self, rate, burst, size=65536, stripes=64):
+        """
+        rate:float      Tokens added per second, per client
+        burst:float     The bucket size, which is the maximum burst
+        size:int        The total number of client slots.  This is rounded
+                        up to a multiple of BUCKET_SLOTS
+        stripes:int     The number of locks to spread the buckets over
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.num_buckets = max(1, (int(size) + BUCKET_SLOTS - 1) //
+            BUCKET_SLOTS)
+        self.size = self.num_buckets * BUCKET_SLOTS
+        self._bucket_len = BUCKET_SLOTS * _SLOT.size
+        self._mem = anon_mmap(self.size * _SLOT.size)
+        self._locks = StripedLock(stripes)
+
+    def allow(self, key, cost=1.0):
+        """
+        Take cost tokens from key's bucket.  Returns True if there were
+        enough tokens, False if the client is over its rate
+
+        key:str         The client key, like an ip address
+        cost:float      The number of tokens this request costs
+        """
+        h = key_hash(key)
+        bucket = h % self.num_buckets
+        base = bucket * self._bucket_len
+        mem = self._mem
+        now = time.monotonic()
+
+        with self._locks.get(bucket):
+            victim = None
+            victim_last = None
+            for i in range(BUCKET_SLOTS):
+                off = base + i * _SLOT.size
+                slot_key, tokens, last = _SLOT.unpack_from(mem, off)
+                if slot_key == h:
+                    tokens = min(self.burst, tokens + (now - last) * self.rate)
+                    allowed = tokens >= cost
+                    if allowed:
+                        tokens -= cost
+                    _SLOT.pack_into(mem, off, h, tokens, now)
+                    return allowed
+                if slot_key == 0:
+                    if victim_last != 0:
+                        victim, victim_last = off, 0
+                elif victim_last is None or \
+                        (victim_last != 0 and last < victim_last):
+                    victim, victim_last = off, last
+            # This is a new (or evicted) client, which starts with a full
+            # bucket.  A cost over the burst is refused without taking
+            # anything, the same as above
+            allowed = cost <= self.burst
+            tokens = self.burst - cost if allowed else self.burst
+            _SLOT.pack_into(mem, victim, h, tokens, now)
+            return allowed
+
+    def tokens(self, key):
+        """
+        Returns the number of tokens currently available to key, without
+        taking any
+        """
+        h = key_hash(key)
+        bucket = h % self.num_buckets
+        base = bucket * self._bucket_len
+        now = time.monotonic()
+        with self._locks.get(bucket):
+            for i in range(BUCKET_SLOTS):
+                slot_key, tokens, last = _SLOT.unpack_from(self._mem,
+                    base + i * _SLOT.size)
+                if slot_key == h:
+                    return min(self.burst, tokens + (now - last) * self.rate)
+        return self.burst
+
+    def reset(self, key=None):
+        """
+        Forget key, or every client if key is None
+        """
+        if key is None:
+            for i in range(self.num_buckets):
+                with self._locks.get(i):
+                    start = i * self._bucket_len
+                    self._mem[start:start + self._bucket_len] = \
+                        b'\x00' * self._bucket_len
+            return
+        h = key_hash(key)
+        bucket = h % self.num_buckets
+        base = bucket * self._bucket_len
+        with self._locks.get(bucket):
+            for i in range(BUCKET_SLOTS):
+                off = base + i * _SLOT.size
+                if _SLOT.unpack_from(self._mem, off)[0] == h:
+                    _SLOT.pack_into(self._mem, off, 0, 0.0, 0.0)
@@ -0,0 +1,223 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A buffered request reader.  For tcp, each accepted connection gets one
+# as self.reader.  It reads with recv_into() straight into a bytearray
+# taken from a per-child pool of buffers, and hands back memoryviews into
+# that buffer, so the request path doesn't allocate a new bytes object
+# for every recv() and concatenation.
+#
+#     def process_request(self):
+#         line = self.reader.read_line()
+#         length = int(line)
+#         body = self.reader.read_exactly(length)
+#
+# A view is only good until the next read from the reader, since the
+# buffer is reused.  Call bytes() on it to keep a copy.
+#
+
+from preforkserver.exceptions import ReadLimitError
+
+__all__ = ['BufferPool', 'RequestReader']
+
+
+class BufferPool(object):
+    """
+    A per-process pool of bytearrays in a few size classes.  Buffers go
+    back to the pool when a connection is done and are handed out again
+    to the next one
+    """
+
+    def __init__(self, sizes=(4096, 16384, 65536, 262144, 1048576),
+            max_free=4):
+        """
+        sizes:tuple         The buffer sizes to pool, smallest first
+        max_free:int        The most free buffers to keep in each class
+        """
+        self.sizes = tuple(sorted(sizes))
+        self.max_free = max_free
+        self._free = dict([ (size, []) for size in self.sizes ])
+
+    def get(self, size):
+        """
+        Returns a bytearray of at least size bytes
+        """
+        for cls in self.sizes:
+            if cls >= size:
+                free = self._free[cls]
+                return free.pop() if free else bytearray(cls)
+        # Bigger than anything we pool
+        return bytearray(size)
+
+    def put(self, buf):
+        """
+        Return a buffer to the pool
+        """
+        free = self._free.get(len(buf))
+        if free is not None and len(free) < self.max_free:
+            free.append(buf)
+
+
+class RequestReader(object):
+    """
+    Reads from a connected socket into a pooled buffer
+    """
+
+    def __init__(self, sock, pool, buffer_size=4096, max_size=1048576):
+        """
+        sock:socket.socket      The connection, or anything wrapping it
+                                which has recv_into()
+        pool:BufferPool         Where to get buffers from
+        buffer_size:int         The size of the first buffer
+        max_size:int            The most that will be buffered while
+                                looking for a delimiter, or read with
+                                read_exactly()
+        """
+        self._sock = sock
+        self._pool = pool
+        self._buffer_size = buffer_size
+        self.max_size = max_size
+        self._buf = None
+        self._view = None
+        self._start = 0
+        self._end = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    @property
+    def buffered(self):
+        """
+        The number of bytes read from the socket and not consumed yet
+        """
+        return self._end - self._start
+
+    def _make_room(self, need):
+        """
+        Make sure there is space for need bytes of data in the buffer,
+        starting from self._start
+        """
+        if self._buf is None:
+            self._buf = self._pool.get(max(need, self._buffer_size))
+            self._view = memoryview(self._buf)
+            return
+        have = self._end - self._start
+        if need <= len(self._buf):
+            if self._start and self._start + need > len(self._buf):
+                # Slide what we have down to the front
+                self._buf[:have] = self._view[self._start:self._end]
+                self._start = 0
+                self._end = have
+            return
+        buf = self._pool.get(need)
+        buf[:have] = self._view[self._start:self._end]
+        self._view.release()
+        self._pool.put(self._buf)
+        self._buf = buf
+        self._view = memoryview(buf)
+        self._start = 0
+        self._end = have
+
+    def _fill(self, need):
+        """
+        Read once from the socket, making sure there is room for at least
+        need bytes in total.  Returns the number of bytes read, 0 at EOF
+        """
+        self._make_room(need)
+        n = self._sock.recv_into(self._view[self._end:])
+        if not n:
+            self.eof = True
+            return 0
+        self._end += n
+        self.bytes_read += n
+        return n
+
+    def _consume(self, n):
+        if not n:
+            return memoryview(b'')
+        ret = self._view[self._start:self._start + n]
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
+        return ret
+
+    def read(self, n=65536):
+        """
+        Returns up to n bytes, reading from the socket only if nothing is
+        buffered.  Returns an empty view at EOF
+        """
+        if self._start == self._end and not self.eof:
+            self._fill(min(n, self.max_size))
+        return self._consume(min(n, self._end - self._start))
+
+    def read_exactly(self, n):
+        """
+        Returns exactly n bytes.  Raises EOFError if the client closes
+        the connection first
+        """
+        if n > self.max_size:
+            raise ReadLimitError('read of %d bytes is over the limit of %d' %
+                (n, self.max_size))
+        while self._end - self._start < n:
+            if self.eof or not self._fill(n):
+                raise EOFError('connection closed after %d of %d bytes' %
+                    (self._end - self._start, n))
+        return self._consume(n)
+
+    def read_until(self, delim, limit=None):
+        """
+        Returns everything up to and including delim.  At EOF, whatever
+        is left is returned without the delimiter, and then an empty view.
+        Raises ReadLimitError if limit, or max_size, bytes are buffered
+        without finding delim
+        """
+        limit = min(limit, self.max_size) if limit else self.max_size
+        scan = self._start
+        while True:
+            pos = self._buf.find(delim, scan, self._end) \
+                if self._buf is not None else -1
+            if pos >= 0:
+                return self._consume(pos + len(delim) - self._start)
+            have = self._end - self._start
+            if have >= limit:
+                raise ReadLimitError('no %r in the first %d bytes' %
+                    (delim, limit))
+            if self.eof or not self._fill(min(have + 1, limit)):
+                return self._consume(have)
+            # Don't search the same bytes again.  This is relative to
+            # _start since the data may have been moved
+            scan = max(self._start, self._start + have - len(delim) + 1)
+
+    def read_line(self, limit=None):
+        """
+        Returns the next line, including the trailing newline
+        """
+        return self.read_until(b'\n', limit)
+
+    def release(self):
+        """
+        Give the buffer back to the pool.  Any views handed out are no
+        longer valid after this
+        """
+        if self._buf is not None:
+            self._view.release()
+            self._pool.put(self._buf)
+        self._buf = self._view = None
+        self._start = self._end = 0
@@ -0,0 +1,106 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# The scaling policy decides how many children to fork and which ones to
+# kill.  The Manager builds a PoolSnapshot on every pass of its main loop
+# and hands it to the policy's assess() method.  Subclass ScalingPolicy
+# and pass an instance to the Manager as scaling_policy to change the
+# behavior.  preforkserver.simulator can run a policy offline.
+#
+
+from collections import namedtuple
+import preforkserver.events as pfe
+
+__all__ = ['ChildInfo', 'PoolSnapshot', 'ScalingPolicy', 'DefaultPolicy']
+
+# pid:int               The child's pid
+# state:int             The child's current state, from preforkserver.events
+# total_processed:int   The number of requests the child has handled
+# age:float             Seconds since the child was forked
+# busy_for:float        Seconds the child has been busy, 0 if it is not
+ChildInfo = namedtuple('ChildInfo', ['pid', 'state', 'total_processed',
+    'age', 'busy_for'])
+
+# children:list         A list of ChildInfo
+# max_servers:int       The current pool limits from the manager
+# min_servers:int
+# min_spares:int
+# max_spares:int
+# queue_depth:int       Connections (or bytes for udp) waiting in the kernel
+#                       as of the last sample
+# now:float             The time of the snapshot
+PoolSnapshot = namedtuple('PoolSnapshot', ['children', 'max_servers',
+    'min_servers', 'min_spares', 'max_spares', 'queue_depth', 'now'])
+
+
+class ScalingPolicy(object):
+    """
+    The interface for scaling policies
+    """
+
+    def assess(self, snapshot):
+        """
+        Look at the snapshot and decide what to do.  Returns a tuple of
+        (number_to_fork, list_of_pids_to_kill).  The manager will never
+        fork past max_servers, regardless of what is returned here
+
+        snapshot:PoolSnapshot       The current state of the pool
+        """
+        raise NotImplementedError('You must implement the assess() method')
+
+
+class DefaultPolicy(ScalingPolicy):
+    """
+    The classic Net::Server::Prefork style policy.  Keep at least
+    min_spares idle children, fork up to max_servers to do so, and kill
+    idle children, busiest first, when there are too many spares.
+
+    Children which are still starting are not spares, but they are
+    counted toward the spares we are waiting on so that a slow
+    initialize() doesn't cause a fork on every pass
+    """
+
+    def assess(self, snapshot):
+        children = snapshot.children
+        num_children = len(children)
+        idle = [ ch for ch in children if ch.state & pfe.WAITING ]
+        starting = len([ ch for ch in children if ch.state & pfe.STARTING ])
+        spares = len(idle)
+        to_fork = 0
+        to_kill = []
+
+        if spares + starting < snapshot.min_spares:
+            # We need to fork more children
+            to_fork = min(snapshot.min_spares - spares - starting,
+                snapshot.max_servers - num_children)
+        elif spares > snapshot.max_spares + snapshot.min_servers:
+            # We have too many spares and need to kill some.  The children
+            # that have processed the most go first so that they get
+            # recycled
+            num_kill = min(spares - snapshot.max_spares,
+                num_children - snapshot.min_servers)
+            idle.sort(key=lambda ch: ch.total_processed, reverse=True)
+            to_kill = [ ch.pid for ch in idle[:num_kill] ]
+
+        if num_children + to_fork < snapshot.min_servers:
+            to_fork = snapshot.min_servers - num_children
+
+        return (max(to_fork, 0), to_kill)
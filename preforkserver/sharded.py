@@ -0,0 +1,447 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A manager of managers, for very large pools.  A single Manager polls
+# every child's pipe and looks at every child on each pass of its loop,
+# so its work grows with the size of the pool.  A ShardedManager forks a
+# number of sub-managers, each running an ordinary Manager over its own
+# slice of the children:
+#
+#     manager = ShardedManager(MyChild, shards=4, max_servers=4000,
+#         min_servers=400, min_spare_servers=100, max_spare_servers=400)
+#     manager.run()
+#
+# All the Manager arguments are accepted and the pool limits are split
+# between the shards.  The listening sockets and any shared memory
+# (shared_cache, rate_limiter, ...) are created once, before the shards
+# are forked, so they are shared by the whole pool.  With reuse_port,
+# the children of every shard bind their own sockets as usual.
+#
+# With numa=True there is one shard per NUMA node, and each shard, along
+# with all its children, is pinned to the CPUs of its node.
+#
+# Each sub-manager reports its state up every report_interval seconds,
+# and snapshot() adds these up.  A sub-manager which dies is started
+# again after restart_backoff seconds.
+#
+
+from preforkserver.exceptions import ManagerError
+from preforkserver.manager import Manager
+from preforkserver.listeners import unlink_listener
+from preforkserver.metrics import Metrics
+from preforkserver.poller import get_poller
+import preforkserver.events as pfe
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import threading
+import select
+import signal
+import glob
+import time
+import os
+
+__all__ = ['ShardedManager', 'numa_nodes']
+
+
+def _parse_cpulist(text):
+    """
+    Parse a kernel cpu list, like "0-3,8-11", into a set of ints
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def numa_nodes():
+    """
+    Returns a list with the set of usable CPUs of each NUMA node, or an
+    empty list if that isn't known
+    """
+    try:
+        allowed = os.sched_getaffinity(0)
+    except (AttributeError, OSError):
+        return []
+    nodes = []
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    for path in sorted(paths, key=lambda p: int(p.split('/')[-2][4:])):
+        try:
+            with open(path) as fh:
+                cpus = _parse_cpulist(fh.read()) & allowed
+        except (IOError, OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(cpus)
+    return nodes
+
+
+def _split(total, parts, index):
+    """
+    The share of total for part index of parts
+    """
+    return total // parts + (1 if index < total % parts else 0)
+
+
+class _Uplink(object):
+    """
+    The sub-manager's end of the pipe to the top level manager
+    """
+
+    def __init__(self, conn, index, interval):
+        self.conn = conn
+        self.index = index
+        self.interval = interval
+        self._next_report = 0
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def handle(self, manager):
+        """
+        Handle a message from the top level manager
+        """
+        try:
+            msg = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            # The top level manager is gone
+            manager.close()
+            return
+        if msg[0] == 'broadcast':
+            manager.broadcast(*msg[1:])
+        elif msg[0] == 'stop':
+            manager.close()
+
+    def report(self, manager):
+        """
+        Send this shard's state up, once per interval
+        """
+        now = time.time()
+        if now < self._next_report:
+            return
+        self._next_report = now + self.interval
+        children = busy = starting = 0
+        for ch in manager._children.values():
+            children += 1
+            if ch.current_state & pfe.BUSY:
+                busy += 1
+            elif ch.current_state & pfe.STARTING:
+                starting += 1
+        state = {
+            'pid': os.getpid(),
+            'children': children,
+            'busy': busy,
+            'starting': starting,
+            'queue_depth': manager.queue_depth,
+            'degraded': manager.degraded,
+            'metrics': manager.metrics.snapshot(),
+            'time': now,
+        }
+        try:
+            self.conn.send(('state', self.index, state))
+        except (IOError, OSError):
+            manager.close()
+
+
+class _Shard(object):
+    """
+    The top level manager's view of one sub-manager
+    """
+    __slots__ = ('index', 'pid', 'conn', 'limits', 'log_first', 'cpus',
+        'state', 'restart_at')
+
+    def __init__(self, index, limits, log_first, cpus):
+        self.index = index
+        self.pid = None
+        self.conn = None
+        # (max_servers, min_servers, min_spare_servers, max_spare_servers)
+        self.limits = limits
+        self.log_first = log_first
+        self.cpus = cpus
+        self.state = None
+        self.restart_at = 0
+
+
+class ShardedManager(object):
+    """
+    Runs the pool as a number of sub-managers, each a regular Manager
+    over a slice of the children
+    """
+
+    def __init__(self, child_class, shards=None, numa=False,
+            report_interval=1.0, restart_backoff=1.0,
+            manager_class=Manager, **kwargs):
+        """
+        child_class<BaseChild>      The child class, as for the Manager
+        shards<int>                 The number of sub-managers.  This
+                                    defaults to the number of NUMA nodes
+                                    if numa is set, or 2
+        numa<bool>                  Pin each shard, and its children, to
+                                    the CPUs of one NUMA node
+        report_interval<float>      Seconds between state reports from
+                                    each sub-manager
+        restart_backoff<float>      Seconds to wait before starting a
+                                    sub-manager which died
+        manager_class<Manager>      The Manager subclass to run in each
+                                    shard.  Its hooks run in the shards
+        **kwargs                    Anything the Manager takes.  The pool
+                                    limits are totals for the whole pool
+        """
+        self.nodes = numa_nodes() if numa else []
+        if shards is None:
+            shards = len(self.nodes) if self.nodes else 2
+        self.num_shards = int(shards)
+        if self.num_shards < 1:
+            raise ManagerError('shards must be at least 1')
+        self.report_interval = float(report_interval)
+        self.restart_backoff = float(restart_backoff)
+        # This binds the sockets and sets up the shared state once, for
+        # all the shards
+        self.manager = manager_class(child_class, **kwargs)
+        m = self.manager
+        if m.max_servers < self.num_shards:
+            raise ManagerError('max_servers (%d) must be at least the '
+                'number of shards (%d)' % (m.max_servers, self.num_shards))
+        if m.autosize is not None:
+            # Each shard sizes itself for its part of the container
+            m.autosize.share = 1.0 / self.num_shards
+        self.shards = []
+        log_first = 0
+        for i in range(self.num_shards):
+            limits = tuple(_split(total, self.num_shards, i) for total in
+                (m.max_servers, m.min_servers, m.min_spares, m.max_spares))
+            cpus = self.nodes[i % len(self.nodes)] if self.nodes else None
+            self.shards.append(_Shard(i, limits, log_first, cpus))
+            log_first += limits[0]
+        if m.log_pipeline is not None:
+            # The shards drain the rings.  This process only writes the
+            # records it logs itself
+            m.log_pipeline.partition(0, 0)
+        self.metrics = Metrics()
+        # The last message on each topic, as (seq, version, data)
+        self.broadcasts = {}
+        self._broadcast_seq = 0
+        self._stop = threading.Event()
+
+    def _start_shard(self, shard):
+        parent_conn, child_conn = mp.Pipe()
+        pid = os.fork()
+        if not pid:
+            parent_conn.close()
+            # Don't hold the other shards' pipes open
+            for other in self.shards:
+                if other.conn is not None:
+                    other.conn.close()
+            status = 0
+            try:
+                self._run_shard(shard, child_conn)
+            except Exception as e:
+                self.manager.log('Shard %d failed: %s' % (shard.index, e))
+                if self.manager.log_pipeline is not None:
+                    self.manager.log_pipeline.drain(True)
+                status = 1
+            finally:
+                os._exit(status)
+        child_conn.close()
+        shard.pid = pid
+        shard.conn = parent_conn
+        shard.state = None
+        self.metrics.incr('shards.started')
+
+    def _run_shard(self, shard, conn):
+        """
+        Runs in the forked sub-manager
+        """
+        if shard.cpus:
+            os.sched_setaffinity(0, shard.cpus)
+        m = self.manager
+        (m.max_servers, m.min_servers, m.min_spares,
+            m.max_spares) = shard.limits
+        if m._saturated is not None:
+            # Saturation is per shard
+            m._saturated = mp.RawValue('b', 0)
+        if m.tls is not None:
+            # The top level manager rotates the shared ticket key
+            m.tls.ticket_rotation = 0
+        if m.log_pipeline is not None:
+            m.log_pipeline.partition(shard.log_first, shard.limits[0])
+            # The top level writes what it logged before the fork
+            m.log_pipeline._local = []
+        for topic, (seq, version, data) in sorted(self.broadcasts.items(),
+                key=lambda item: item[1][0]):
+            m.broadcast(topic, data, version)
+        # An epoll instance is shared across a fork, so each shard needs
+        # its own
+        m._poll.close()
+        m._poll = get_poller(select.POLLIN | select.POLLPRI)
+        m._uplink = _Uplink(conn, shard.index, self.report_interval)
+        m._poll.register(m._uplink)
+        m.run()
+
+    def _handle_shard_event(self, shard):
+        try:
+            msg = shard.conn.recv()
+        except (EOFError, IOError, OSError):
+            self._shard_exited(shard)
+            return
+        if msg[0] == 'state':
+            shard.state = msg[2]
+
+    def _shard_exited(self, shard):
+        shard.conn.close()
+        shard.conn = None
+        try:
+            os.waitpid(shard.pid, 0)
+        except OSError:
+            pass
+        shard.pid = None
+        shard.state = None
+        if not self._stop.is_set():
+            self.metrics.incr('shards.exits')
+            shard.restart_at = time.time() + self.restart_backoff
+
+    def broadcast(self, topic, data=None, version=None):
+        """
+        Manager.broadcast() for every child of every shard.  Returns the
+        sequence number of the message
+        """
+        self._broadcast_seq += 1
+        if version is None:
+            version = self._broadcast_seq
+        self.broadcasts[topic] = (self._broadcast_seq, version, data)
+        for shard in self.shards:
+            if shard.conn is not None:
+                try:
+                    shard.conn.send(('broadcast', topic, data, version))
+                except (IOError, OSError):
+                    pass
+        return self._broadcast_seq
+
+    def snapshot(self):
+        """
+        Returns a dict of the whole pool's state, added up from the last
+        report of each shard.  Every counter and gauge from the shards'
+        metrics is summed, except queue_depth, which is the same listen
+        queue seen from every shard, so the largest is used
+        """
+        ret = {
+            'shards': self.num_shards,
+            'shards_running': 0,
+            'children': 0,
+            'busy': 0,
+            'starting': 0,
+            'queue_depth': 0,
+            'degraded': 0,
+            'metrics': self.metrics.snapshot(),
+        }
+        metrics = ret['metrics']
+        for shard in self.shards:
+            st = shard.state
+            if shard.pid is not None:
+                ret['shards_running'] += 1
+            if st is None:
+                continue
+            for key in ('children', 'busy', 'starting'):
+                ret[key] += st[key]
+            ret['queue_depth'] = max(ret['queue_depth'], st['queue_depth'])
+            ret['degraded'] += int(st['degraded'])
+            for key, val in st['metrics'].items():
+                metrics[key] = metrics.get(key, 0) + val
+        return ret
+
+    def _signal_setup(self):
+        signal.signal(signal.SIGHUP, self.hup_handler)
+        signal.signal(signal.SIGINT, self.int_handler)
+        signal.signal(signal.SIGTERM, self.term_handler)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.time()
+            for shard in self.shards:
+                if shard.pid is None and now >= shard.restart_at:
+                    self._start_shard(shard)
+            conns = dict((shard.conn, shard) for shard in self.shards
+                if shard.conn is not None)
+            try:
+                ready = wait(list(conns), 1)
+            except (IOError, OSError):
+                ready = []
+            for conn in ready:
+                self._handle_shard_event(conns[conn])
+            if self.manager._reload_pending:
+                self.manager._reload_pending = False
+                self.manager.reload_access_list()
+            if self.manager.tls is not None:
+                self.manager.tls.maybe_rotate()
+            if self.manager.log_pipeline is not None:
+                self.manager.log_pipeline.drain()
+
+    def _shutdown(self):
+        for shard in self.shards:
+            if shard.pid is None:
+                continue
+            try:
+                shard.conn.send(('stop',))
+            except (IOError, OSError):
+                pass
+        for shard in self.shards:
+            if shard.pid is not None:
+                self._shard_exited(shard)
+        m = self.manager
+        for spec, sock in m.listen_sockets:
+            sock.close()
+            if (spec, sock) not in m._inherited:
+                unlink_listener(spec)
+        m.listen_sockets = []
+        if m.access_list is not None:
+            m.access_list.close()
+        if m.log_pipeline is not None:
+            m.log_pipeline.close()
+
+    def run(self):
+        self._signal_setup()
+        self._loop()
+        self._shutdown()
+
+    def close(self):
+        """
+        Stop the whole pool
+        """
+        self._stop.set()
+
+    # Signal handlers.  These can be overridden in a subclass
+    def hup_handler(self, frame, num):
+        """
+        Handle a SIGHUP.  This runs the manager's hup_handler() once, here,
+        since everything it reloads is shared by the shards
+        """
+        self.manager.hup_handler(frame, num)
+
+    def int_handler(self, frame, num):
+        self._stop.set()
+
+    def term_handler(self, frame, num):
+        self._stop.set()
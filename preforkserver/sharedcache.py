@@ -0,0 +1,368 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A key/value cache in shared memory, so that every child of a Manager
+# shares one cache instead of each keeping its own copy.  Pass an
+# instance to the Manager as shared_cache and use it from the children:
+#
+#     value = self.shared_cache.get(key)
+#     if value is None:
+#         value = expensive(key)
+#         self.shared_cache.set(key, value, ttl=60)
+#
+# Keys are str or bytes and values are bytes.  Pickle or encode anything
+# else yourself.
+#
+# The memory is split into segments, each with its own lock, so children
+# only contend when their keys land in the same segment.  Each segment
+# has an open addressing (linear probing) index and a set of fixed size
+# slab classes.  An entry goes in a slot of the smallest class it fits.
+# When a class is full, a CLOCK sweep, which approximates LRU, evicts an
+# entry which hasn't been read since the hand last passed it.  Expired
+# entries are dropped when they are found.
+#
+
+from preforkserver.shm import anon_mmap, StripedLock, key_hash
+import struct
+import time
+
+__all__ = ['SharedCache']
+
+# hits, misses, sets, evictions
+_SEG_STATS = struct.Struct('=QQQQ')
+# Per slab class: free list head and clock hand.  Slot references are
+# stored plus one, so that zero means none
+_CLASS_HDR = struct.Struct('=II')
+# Index entry: key hash and a slot reference, (class << 24 | slot) + 1
+_INDEX = struct.Struct('=QI')
+# Slot header: key hash, expiry time (0 for never), value length, key
+# length and the reference bit.  A free slot has a zero hash and keeps
+# the next free slot in the value length
+_ENTRY = struct.Struct('=QdIHB')
+_ENTRY_SIZE = 24
+
+
+class _Segment(object):
+    """
+    One independently locked part of the cache.  All methods must be
+    called with the segment's lock held
+    """
+
+    def __init__(self, mem, offset, slab_sizes, slab_bytes):
+        self._mem = mem
+        self._slab_sizes = slab_sizes
+        self._stats_off = offset
+        self._class_off = offset + _SEG_STATS.size
+        off = self._class_off + _CLASS_HDR.size * len(slab_sizes)
+        self._slots = []
+        self._slab_off = []
+        total = 0
+        for size in slab_sizes:
+            count = min(slab_bytes // size, 0xffffff)
+            self._slots.append(count)
+            self._slab_off.append(off)
+            off += count * size
+            total += count
+        cap = 8
+        while cap < total * 3 // 2:
+            cap *= 2
+        self._mask = cap - 1
+        self._index_off = off
+        self.end = off + cap * _INDEX.size
+
+    def init(self):
+        """
+        Chain every slot into its class's free list
+        """
+        mem = self._mem
+        for cls, size in enumerate(self._slab_sizes):
+            base = self._slab_off[cls]
+            count = self._slots[cls]
+            for slot in range(count):
+                nxt = slot + 2 if slot + 1 < count else 0
+                _ENTRY.pack_into(mem, base + slot * size, 0, 0.0, nxt, 0, 0)
+            _CLASS_HDR.pack_into(mem, self._class_off + cls * _CLASS_HDR.size,
+                1 if count else 0, 0)
+
+    def _count(self, which):
+        # which is an index into _SEG_STATS
+        off = self._stats_off + which * 8
+        struct.pack_into('=Q', self._mem, off,
+            struct.unpack_from('=Q', self._mem, off)[0] + 1)
+
+    def stats(self):
+        return _SEG_STATS.unpack_from(self._mem, self._stats_off)
+
+    def _slot_off(self, ref):
+        ref -= 1
+        cls = ref >> 24
+        return self._slab_off[cls] + (ref & 0xffffff) * self._slab_sizes[cls]
+
+    def _find(self, h, key):
+        """
+        Returns (index position, slot ref) for key, or (None, None)
+        """
+        mem = self._mem
+        pos = h & self._mask
+        while True:
+            ih, ref = _INDEX.unpack_from(mem, self._index_off +
+                pos * _INDEX.size)
+            if not ref:
+                return (None, None)
+            if ih == h:
+                off = self._slot_off(ref)
+                klen = _ENTRY.unpack_from(mem, off)[3]
+                start = off + _ENTRY_SIZE
+                if mem[start:start + klen] == key:
+                    return (pos, ref)
+            pos = (pos + 1) & self._mask
+
+    def _unindex(self, pos):
+        """
+        Remove the index entry at pos, shifting later entries back so
+        that no probe sequence is broken
+        """
+        mem = self._mem
+        mask = self._mask
+        base = self._index_off
+        i = pos
+        j = (i + 1) & mask
+        while True:
+            ih, ref = _INDEX.unpack_from(mem, base + j * _INDEX.size)
+            if not ref:
+                break
+            home = ih & mask
+            if ((j - home) & mask) >= ((j - i) & mask):
+                _INDEX.pack_into(mem, base + i * _INDEX.size, ih, ref)
+                i = j
+            j = (j + 1) & mask
+        _INDEX.pack_into(mem, base + i * _INDEX.size, 0, 0)
+
+    def _index(self, h, ref):
+        mem = self._mem
+        pos = h & self._mask
+        while _INDEX.unpack_from(mem, self._index_off +
+                pos * _INDEX.size)[1]:
+            pos = (pos + 1) & self._mask
+        _INDEX.pack_into(mem, self._index_off + pos * _INDEX.size, h, ref)
+
+    def _free(self, ref):
+        cls = (ref - 1) >> 24
+        hdr = self._class_off + cls * _CLASS_HDR.size
+        head, hand = _CLASS_HDR.unpack_from(self._mem, hdr)
+        _ENTRY.pack_into(self._mem, self._slot_off(ref), 0, 0.0, head, 0, 0)
+        _CLASS_HDR.pack_into(self._mem, hdr, ((ref - 1) & 0xffffff) + 1, hand)
+
+    def _remove(self, pos, ref):
+        self._unindex(pos)
+        self._free(ref)
+
+    def _alloc(self, cls, now):
+        """
+        Returns a free slot ref in cls, evicting an entry if need be
+        """
+        mem = self._mem
+        hdr = self._class_off + cls * _CLASS_HDR.size
+        head, hand = _CLASS_HDR.unpack_from(mem, hdr)
+        if head:
+            off = self._slab_off[cls] + (head - 1) * self._slab_sizes[cls]
+            nxt = _ENTRY.unpack_from(mem, off)[2]
+            _CLASS_HDR.pack_into(mem, hdr, nxt, hand)
+            return (cls << 24 | (head - 1)) + 1
+        # CLOCK: clear reference bits until we find an entry without one,
+        # or an expired one
+        size = self._slab_sizes[cls]
+        count = self._slots[cls]
+        while True:
+            off = self._slab_off[cls] + hand * size
+            h, expires, vlen, klen, refbit = _ENTRY.unpack_from(mem, off)
+            if refbit and not (expires and expires <= now):
+                struct.pack_into('=B', mem, off + 22, 0)
+                hand = (hand + 1) % count
+                continue
+            ref = (cls << 24 | hand) + 1
+            key = bytes(mem[off + _ENTRY_SIZE:off + _ENTRY_SIZE + klen])
+            pos = self._find(h, key)[0]
+            if pos is not None:
+                self._unindex(pos)
+            _CLASS_HDR.pack_into(mem, hdr, 0, (hand + 1) % count)
+            self._count(3)
+            return ref
+
+    def get(self, h, key, now):
+        pos, ref = self._find(h, key)
+        if ref is None:
+            self._count(1)
+            return None
+        mem = self._mem
+        off = self._slot_off(ref)
+        eh, expires, vlen, klen, refbit = _ENTRY.unpack_from(mem, off)
+        if expires and expires <= now:
+            self._remove(pos, ref)
+            self._count(1)
+            return None
+        if not refbit:
+            struct.pack_into('=B', mem, off + 22, 1)
+        self._count(0)
+        start = off + _ENTRY_SIZE + klen
+        return mem[start:start + vlen]
+
+    def set(self, h, key, value, expires, now):
+        need = _ENTRY_SIZE + len(key) + len(value)
+        for cls, size in enumerate(self._slab_sizes):
+            if size >= need and self._slots[cls]:
+                break
+        else:
+            return False
+        pos, ref = self._find(h, key)
+        if ref is not None:
+            if (ref - 1) >> 24 == cls:
+                # Same class, so overwrite it where it is
+                self._write(self._slot_off(ref), h, key, value, expires)
+                self._count(2)
+                return True
+            self._remove(pos, ref)
+        ref = self._alloc(cls, now)
+        self._write(self._slot_off(ref), h, key, value, expires)
+        self._index(h, ref)
+        self._count(2)
+        return True
+
+    def _write(self, off, h, key, value, expires):
+        mem = self._mem
+        _ENTRY.pack_into(mem, off, h, expires, len(value), len(key), 1)
+        start = off + _ENTRY_SIZE
+        mem[start:start + len(key)] = key
+        start += len(key)
+        mem[start:start + len(value)] = value
+
+    def delete(self, h, key):
+        pos, ref = self._find(h, key)
+        if ref is None:
+            return False
+        self._remove(pos, ref)
+        return True
+
+
+class SharedCache(object):
+    """
+    A shared memory key/value cache with CLOCK eviction and per entry
+    TTLs.
+
+    This must be created in the manager process, before the children
+    are forked
+    """
+
+    def __init__(self, size=64 * 1024 * 1024,
+            slab_sizes=(128, 512, 2048, 8192, 32768, 131072), segments=16,
+            default_ttl=None):
+        """
+        size:int            The total bytes for the slabs.  This is split
+                            evenly over the segments and slab classes
+        slab_sizes:tuple    The slot size of each slab class.  An entry
+                            takes 24 bytes plus its key and value, and
+                            values over the largest size are not cached
+        segments:int        The number of independently locked segments
+        default_ttl:float   The TTL, in seconds, for set() without one.
+                            None means entries only go when evicted
+        """
+        self.slab_sizes = tuple(sorted(slab_sizes))
+        self.segments = int(segments)
+        self.default_ttl = default_ttl
+        slab_bytes = int(size) // self.segments // len(self.slab_sizes)
+        # Lay out a segment at offset zero to find out how big one is
+        seg_size = _Segment(None, 0, self.slab_sizes, slab_bytes).end
+        self._mem = anon_mmap(seg_size * self.segments)
+        self._segs = []
+        for i in range(self.segments):
+            seg = _Segment(self._mem, i * seg_size, self.slab_sizes,
+                slab_bytes)
+            seg.init()
+            self._segs.append(seg)
+        self._locks = StripedLock(self.segments)
+        # The largest value that can be stored, less the key length
+        self.max_item_size = self.slab_sizes[-1] - _ENTRY_SIZE
+
+    def _key(self, key):
+        if not isinstance(key, (bytes, bytearray)):
+            key = str(key).encode('utf-8')
+        h = key_hash(key)
+        # The high bits pick the segment and the low bits the index slot
+        return (key, h, (h >> 40) % self.segments)
+
+    def get(self, key, default=None):
+        """
+        Returns a copy of the value stored for key, or default if it is
+        missing or expired
+        """
+        key, h, seg = self._key(key)
+        with self._locks.get(seg):
+            ret = self._segs[seg].get(h, key, time.time())
+        return default if ret is None else ret
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value for key.  Returns False if it is too big to cache
+
+        key:str|bytes       The key
+        value:bytes         The value
+        ttl:float           Seconds until the entry expires.  The
+                            default_ttl is used if this is None
+        """
+        key, h, seg = self._key(key)
+        if ttl is None:
+            ttl = self.default_ttl
+        now = time.time()
+        expires = now + ttl if ttl else 0.0
+        with self._locks.get(seg):
+            return self._segs[seg].set(h, key, value, expires, now)
+
+    def delete(self, key):
+        """
+        Remove key.  Returns True if it was there
+        """
+        key, h, seg = self._key(key)
+        with self._locks.get(seg):
+            return self._segs[seg].delete(h, key)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        """
+        Remove everything
+        """
+        for i, seg in enumerate(self._segs):
+            with self._locks.get(i):
+                start = seg._index_off
+                self._mem[start:seg.end] = b'\x00' * (seg.end - start)
+                seg.init()
+
+    def stats(self):
+        """
+        Returns a dict of the hits, misses, sets and evictions, summed
+        over the segments
+        """
+        totals = [0, 0, 0, 0]
+        for seg in self._segs:
+            for i, val in enumerate(seg.stats()):
+                totals[i] += val
+        return dict(zip(('hits', 'misses', 'sets', 'evictions'), totals))
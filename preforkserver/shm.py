@@ -0,0 +1,77 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Shared memory building blocks.  Everything here must be created in the
+# manager before the children are forked.  The children then inherit the
+# same anonymous mapping and semaphores, which is what makes them shared.
+#
+
+import multiprocessing as mp
+import hashlib
+import mmap
+
+__all__ = ['anon_mmap', 'StripedLock', 'key_hash']
+
+
+def anon_mmap(size):
+    """
+    Returns an anonymous, shared (MAP_SHARED) mapping of size bytes, which
+    is zero filled.  The mapping is shared with any process forked after
+    this is created
+    """
+    return mmap.mmap(-1, size)
+
+
+def key_hash(key):
+    """
+    Returns a stable, non-zero 64 bit hash of key.  Unlike hash(), this is
+    the same in every process, regardless of PYTHONHASHSEED.  Zero is
+    reserved to mark empty slots
+
+    key:str|bytes       The key to hash
+    """
+    if not isinstance(key, (bytes, bytearray)):
+        key = str(key).encode('utf-8')
+    h = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+    return h or 1
+
+
+class StripedLock(object):
+    """
+    A fixed set of process shared locks.  A given bucket always maps to the
+    same lock, so contention is spread over all the stripes rather than
+    serialized on one lock
+    """
+
+    def __init__(self, stripes=64):
+        """
+        stripes:int     The number of locks to create
+        """
+        self._locks = [ mp.Lock() for i in range(int(stripes)) ]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def get(self, bucket):
+        """
+        Returns the lock for bucket
+        """
+        return self._locks[bucket % len(self._locks)]
@@ -0,0 +1,245 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A discrete event simulator for scaling policies.  This runs a policy
+# against an arrival trace, a list of (arrival_time, service_time) tuples,
+# the same way the Manager would: the policy is consulted every
+# assess_interval seconds, forks take fork_time seconds before a child
+# can take work, and requests queue in FIFO order when no child is idle.
+#
+#     trace = poisson_trace(rate=200, duration=600, service_mean=0.05)
+#     print(simulate(DefaultPolicy(), trace, max_servers=50))
+#
+# trace_from_capture() builds a trace from a preforkserver.capture file so
+# that real traffic can be used.
+#
+
+from preforkserver.scaling import ChildInfo, PoolSnapshot
+from collections import deque
+import preforkserver.events as pfe
+import itertools
+import random
+import heapq
+
+__all__ = ['simulate', 'poisson_trace', 'trace_from_capture']
+
+# Event types, in the order they are processed when they share a time
+_READY = 0
+_DONE = 1
+_ARRIVE = 2
+_ASSESS = 3
+
+
+class _SimChild(object):
+    __slots__ = ('pid', 'started', 'state', 'state_since', 'processed',
+        'closing')
+
+    def __init__(self, pid, now):
+        self.pid = pid
+        self.started = now
+        self.state = None
+        self.state_since = now
+        self.processed = 0
+        self.closing = False
+
+
+def poisson_trace(rate, duration, service_mean, seed=None):
+    """
+    Returns a synthetic trace with Poisson arrivals and exponentially
+    distributed service times
+
+    rate:float          Mean arrivals per second
+    duration:float      Length of the trace in seconds
+    service_mean:float  Mean service time in seconds
+    seed:int            Random seed, for repeatable runs
+    """
+    rnd = random.Random(seed)
+    ret = []
+    t = rnd.expovariate(rate)
+    while t < duration:
+        ret.append((t, rnd.expovariate(1.0 / service_mean)))
+        t += rnd.expovariate(rate)
+    return ret
+
+
+def trace_from_capture(path):
+    """
+    Returns a trace built from a preforkserver.capture file, using the
+    recorded start times and durations
+    """
+    from preforkserver.capture import read_capture
+    recs = [ (r.start, r.duration) for r in read_capture(path) ]
+    if not recs:
+        return []
+    recs.sort()
+    first = recs[0][0]
+    return [ (start - first, dur) for start, dur in recs ]
+
+
+def _pct(values, pct):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * pct), len(values) - 1)]
+
+
+def simulate(policy, trace, max_servers=20, min_servers=5,
+        min_spare_servers=2, max_spare_servers=10, max_requests=0,
+        fork_time=0.05, assess_interval=1.0, child_rss=30.0):
+    """
+    Run policy against trace and return a dict of results:
+
+        requests        Number of requests served
+        delay_mean      Mean time spent queued, in seconds
+        delay_p50       Median queueing delay
+        delay_p99       99th percentile queueing delay
+        delay_max       Maximum queueing delay
+        queue_max       The longest the queue got
+        forks           Number of children forked
+        kills           Number of children the policy killed
+        children_mean   Time weighted mean number of children
+        idle_mean       Time weighted mean number of idle children
+        idle_mb_mean    idle_mean * child_rss, the memory held by idle
+                        children
+
+    policy:ScalingPolicy    The policy to test
+    trace:list              A list of (arrival_time, service_time) tuples
+    max_servers ...         The same limits the Manager takes
+    fork_time:float         Seconds from fork until a child can take work
+    assess_interval:float   Seconds between calls to the policy
+    child_rss:float         Resident memory of one child, in MB
+    """
+    events = []
+    seq = itertools.count()
+    children = {}
+    pids = itertools.count(1)
+    queue = deque()
+    delays = []
+    stats = {'forks': 0, 'kills': 0, 'queue_max': 0}
+    area = {'children': 0.0, 'idle': 0.0}
+    clock = {'now': 0.0, 'last': 0.0}
+    end = trace[-1][0] if trace else 0.0
+
+    def push(t, kind, data=None):
+        heapq.heappush(events, (t, kind, next(seq), data))
+
+    def account(now):
+        dt = now - clock['last']
+        if dt > 0:
+            live = [ c for c in children.values() if c.state is not None ]
+            area['children'] += len(children) * dt
+            area['idle'] += len([ c for c in live
+                if c.state == pfe.WAITING ]) * dt
+        clock['last'] = now
+
+    def start_work(ch, now):
+        arrival, service = queue.popleft()
+        delays.append(now - arrival)
+        ch.state = pfe.BUSY
+        ch.state_since = now
+        push(now + service, _DONE, ch.pid)
+
+    def fork(now):
+        ch = _SimChild(next(pids), now)
+        children[ch.pid] = ch
+        stats['forks'] += 1
+        push(now + fork_time, _READY, ch.pid)
+
+    def retire(ch):
+        del children[ch.pid]
+
+    for arrival, service in trace:
+        push(arrival, _ARRIVE, service)
+    for i in range(min_servers):
+        fork(0.0)
+    push(0.0, _ASSESS)
+
+    while events:
+        now, kind, _, data = heapq.heappop(events)
+        account(now)
+        clock['now'] = now
+
+        if kind == _ARRIVE:
+            queue.append((now, data))
+            stats['queue_max'] = max(stats['queue_max'], len(queue))
+            for ch in children.values():
+                if ch.state == pfe.WAITING and not ch.closing:
+                    start_work(ch, now)
+                    break
+        elif kind == _READY:
+            ch = children.get(data)
+            if ch is None:
+                continue
+            ch.state = pfe.WAITING
+            ch.state_since = now
+            if queue:
+                start_work(ch, now)
+        elif kind == _DONE:
+            ch = children[data]
+            ch.processed += 1
+            ch.state = pfe.WAITING
+            ch.state_since = now
+            if ch.closing or 0 < max_requests <= ch.processed:
+                retire(ch)
+            elif queue:
+                start_work(ch, now)
+        elif kind == _ASSESS:
+            infos = []
+            for ch in children.values():
+                if ch.state is None:
+                    state = pfe.STARTING
+                else:
+                    state = ch.state
+                busy_for = now - ch.state_since if state & pfe.BUSY else 0
+                infos.append(ChildInfo(ch.pid, state, ch.processed,
+                    now - ch.started, busy_for))
+            snap = PoolSnapshot(infos, max_servers, min_servers,
+                min_spare_servers, max_spare_servers, len(queue), now)
+            to_fork, to_kill = policy.assess(snap)
+            for pid in to_kill:
+                ch = children.get(pid)
+                if ch is None:
+                    continue
+                stats['kills'] += 1
+                if ch.state == pfe.BUSY:
+                    ch.closing = True
+                else:
+                    retire(ch)
+            for i in range(min(to_fork, max_servers - len(children))):
+                fork(now)
+            if now < end or queue or any([ c.state == pfe.BUSY
+                    for c in children.values() ]):
+                push(now + assess_interval, _ASSESS)
+
+    elapsed = clock['last'] or 1.0
+    delays.sort()
+    return {
+        'requests': len(delays),
+        'delay_mean': sum(delays) / len(delays) if delays else 0.0,
+        'delay_p50': _pct(delays, 0.5),
+        'delay_p99': _pct(delays, 0.99),
+        'delay_max': delays[-1] if delays else 0.0,
+        'queue_max': stats['queue_max'],
+        'forks': stats['forks'],
+        'kills': stats['kills'],
+        'children_mean': area['children'] / elapsed,
+        'idle_mean': area['idle'] / elapsed,
+        'idle_mb_mean': area['idle'] / elapsed * child_rss,
+    }
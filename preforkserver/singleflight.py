@@ -0,0 +1,212 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Request coalescing across children.  When many children miss on the
+# same key at once, only the first one calls the backend.  The rest wait
+# for its result to show up in the shared cache:
+#
+#     cache = SharedCache()
+#     manager = Manager(MyChild, shared_cache=cache,
+#         singleflight=SingleFlight(cache))
+#
+#     # In the child
+#     value = self.singleflight.do(key, lambda: fetch(key), ttl=30)
+#
+# The table of in-flight keys is in shared memory, next to the cache.  If
+# the child doing the work dies, or takes longer than timeout, one of the
+# waiters takes over.  If the call raises, the error is not shared.  The
+# waiters race again and one of them makes the call.  A result too big
+# for the cache can't be handed over, so each waiter makes the call
+# itself.
+#
+
+from preforkserver.shm import anon_mmap, StripedLock, key_hash
+import struct
+import time
+import os
+
+__all__ = ['SingleFlight']
+
+# Each slot is: key hash, owner pid, generation, deadline and state
+_SLOT = struct.Struct('=QiIdB')
+_SLOT_SIZE = 32
+BUCKET_SLOTS = 8
+
+_FREE = 0
+_RUNNING = 1
+# The owner finished, but the result could not be cached
+_UNCACHED = 2
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SingleFlight(object):
+    """
+    Coordinates calls for the same key across all the children.
+
+    This must be created in the manager process, before the children
+    are forked
+    """
+
+    def __init__(self, cache, timeout=30.0, size=1024, stripes=64,
+            poll_min=0.0005, poll_max=0.02):
+        """
+        cache:SharedCache   Where results are handed over
+        timeout:float       Seconds a call may take before a waiter gives
+                            up on it and makes the call itself
+        size:int            The number of in-flight keys that can be
+                            tracked.  Calls that don't fit just run
+        stripes:int         The number of locks to spread the buckets over
+        poll_min:float      The first wait, in seconds, between checks
+                            for the result.  This doubles up to poll_max
+        poll_max:float      The longest wait between checks
+        """
+        self.cache = cache
+        self.timeout = float(timeout)
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.num_buckets = max(1, (int(size) + BUCKET_SLOTS - 1) //
+            BUCKET_SLOTS)
+        self._bucket_len = BUCKET_SLOTS * _SLOT_SIZE
+        self._mem = anon_mmap(self.num_buckets * self._bucket_len)
+        self._locks = StripedLock(stripes)
+
+    def _claim(self, h, now):
+        """
+        Returns ('owner', off, gen) if we are to make the call, ('wait',
+        off, gen) if someone else is making it, or ('run', None, 0) if
+        there is no room to track it
+        """
+        bucket = h % self.num_buckets
+        base = bucket * self._bucket_len
+        mem = self._mem
+        with self._locks.get(bucket):
+            free = None
+            for i in range(BUCKET_SLOTS):
+                off = base + i * _SLOT_SIZE
+                key, pid, gen, deadline, state = _SLOT.unpack_from(mem, off)
+                if key == h:
+                    if state == _RUNNING and deadline > now and _alive(pid):
+                        return ('wait', off, gen)
+                    if state == _UNCACHED and deadline > now:
+                        return ('run', None, 0)
+                    # Take over a dead, late or finished flight
+                    gen += 1
+                    _SLOT.pack_into(mem, off, h, os.getpid(), gen,
+                        now + self.timeout, _RUNNING)
+                    return ('owner', off, gen)
+                if free is None and (state == _FREE or deadline <= now):
+                    free = off
+            if free is None:
+                return ('run', None, 0)
+            gen = _SLOT.unpack_from(mem, free)[2] + 1
+            _SLOT.pack_into(mem, free, h, os.getpid(), gen,
+                now + self.timeout, _RUNNING)
+            return ('owner', free, gen)
+
+    def _release(self, h, off, gen, state):
+        bucket = h % self.num_buckets
+        with self._locks.get(bucket):
+            key, pid, cur_gen, deadline, cur = _SLOT.unpack_from(self._mem,
+                off)
+            if key != h or cur_gen != gen:
+                # Someone took over after we timed out
+                return
+            if state == _FREE:
+                _SLOT.pack_into(self._mem, off, 0, 0, gen, 0.0, _FREE)
+            else:
+                # Tell the waiters to make the call themselves, for a
+                # while
+                _SLOT.pack_into(self._mem, off, h, pid, gen,
+                    time.time() + self.timeout, state)
+
+    def _changed(self, h, off, gen):
+        """
+        Returns True if the flight we are waiting on is over, one way or
+        another
+        """
+        bucket = h % self.num_buckets
+        with self._locks.get(bucket):
+            key, pid, cur_gen, deadline, state = _SLOT.unpack_from(
+                self._mem, off)
+        return key != h or cur_gen != gen or state != _RUNNING or \
+            deadline <= time.time() or not _alive(pid)
+
+    def do(self, key, func, ttl=None):
+        """
+        Returns the cached value for key, or calls func() to make it.
+        Only one child calls func() for a key at a time.  The others wait
+        for the result, up to timeout seconds
+
+        key:str|bytes       The key
+        func:callable       Returns the value as bytes
+        ttl:float           The TTL for the cached result
+        """
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+        if not isinstance(key, (bytes, bytearray)):
+            key = str(key).encode('utf-8')
+        h = key_hash(key)
+        give_up = time.time() + self.timeout
+        while True:
+            role, off, gen = self._claim(h, time.time())
+            if role == 'run':
+                return func()
+            if role == 'owner':
+                state = _UNCACHED
+                try:
+                    # The last owner may have filled the cache between
+                    # our miss and the claim
+                    value = self.cache.get(key)
+                    if value is not None:
+                        state = _FREE
+                        return value
+                    value = func()
+                    if self.cache.set(key, value, ttl):
+                        state = _FREE
+                    return value
+                except Exception:
+                    state = _FREE
+                    raise
+                finally:
+                    self._release(h, off, gen, state)
+            # Wait for the owner
+            delay = self.poll_min
+            while True:
+                time.sleep(delay)
+                delay = min(delay * 2, self.poll_max)
+                value = self.cache.get(key)
+                if value is not None:
+                    return value
+                if time.time() >= give_up:
+                    return func()
+                if self._changed(h, off, gen):
+                    # Go around and see who makes the call now
+                    break
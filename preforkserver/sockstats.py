@@ -0,0 +1,200 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Helpers for reading the kernel's view of the listening sockets: how many
+# connections are sitting in the accept queue, and how many packets or
+# SYNs have been dropped.  These are all Linux specific.  On any other
+# system, or if /proc is unavailable, the functions return None or empty
+# results rather than raising.
+#
+
+import struct
+import socket
+
+__all__ = ['tcp_info_queue', 'tcp_info_queued', 'tcp_listen_queues',
+    'tcp_listen_drops', 'udp_queues', 'sample']
+
+# The state column value for a listening socket in /proc/net/tcp
+_TCP_LISTEN = '0A'
+# struct tcp_info starts with 8 bytes of u8 fields, then a run of u32s:
+# rto, ato, snd_mss, rcv_mss, unacked, sacked.  For a listening socket,
+# unacked is the current accept queue length and sacked is the backlog
+_TCP_INFO_FMT = '=8xIIIIII'
+_TCP_INFO_LEN = struct.calcsize(_TCP_INFO_FMT)
+# Further on, after lost, retrans and fackets, is last_data_sent, the
+# milliseconds since data was last sent.  On an accepted connection, it
+# counts from when the handshake completed until the first send
+_TCP_INFO_SENT_FMT = '=44xI'
+_TCP_INFO_SENT_LEN = struct.calcsize(_TCP_INFO_SENT_FMT)
+
+
+def tcp_info_queue(sock):
+    """
+    Returns a (queue_len, backlog) tuple for a listening tcp socket using
+    TCP_INFO, or None if that is not supported here
+
+    sock:socket.socket      A bound and listening tcp socket
+    """
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        raw = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO,
+            _TCP_INFO_LEN)
+    except (OSError, socket.error):
+        return None
+    if len(raw) < _TCP_INFO_LEN:
+        return None
+    unacked, sacked = struct.unpack(_TCP_INFO_FMT, raw)[4:6]
+    return (unacked, sacked)
+
+
+def tcp_info_queued(conn):
+    """
+    Returns the seconds a tcp connection spent in the accept queue, to
+    the millisecond, or None if that is not supported here.  This must
+    be called right after accept(), before anything is sent on conn
+
+    conn:socket.socket      A connection just returned by accept()
+    """
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        raw = conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO,
+            _TCP_INFO_SENT_LEN)
+    except (OSError, socket.error):
+        return None
+    if len(raw) < _TCP_INFO_SENT_LEN:
+        return None
+    return struct.unpack(_TCP_INFO_SENT_FMT, raw)[0] / 1000.0
+
+
+def _read_proc_sockets(paths, port):
+    """
+    Yields the split lines of the /proc/net socket tables, in paths, which
+    are bound to the local port
+    """
+    for path in paths:
+        try:
+            with open(path) as fh:
+                lines = fh.readlines()[1:]
+        except (IOError, OSError):
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+            if int(fields[1].rsplit(':', 1)[1], 16) != port:
+                continue
+            yield fields
+
+
+def tcp_listen_queues(port):
+    """
+    Returns a list with the current accept queue length for each listening
+    tcp socket bound to port.  With reuse_port, there will be one entry
+    per child socket
+
+    port:int        The local port to look for
+    """
+    ret = []
+    for fields in _read_proc_sockets(('/proc/net/tcp', '/proc/net/tcp6'),
+            port):
+        if fields[3] != _TCP_LISTEN:
+            continue
+        ret.append(int(fields[4].split(':')[1], 16))
+    return ret
+
+
+def tcp_listen_drops():
+    """
+    Returns a (listen_overflows, listen_drops) tuple of the host wide
+    counters from /proc/net/netstat, or None if unavailable.  These count
+    SYNs and completed handshakes dropped because an accept queue was full
+    """
+    try:
+        with open('/proc/net/netstat') as fh:
+            lines = fh.readlines()
+    except (IOError, OSError):
+        return None
+    for i in range(0, len(lines) - 1, 2):
+        names = lines[i].split()
+        values = lines[i + 1].split()
+        if not names or names[0] != 'TcpExt:':
+            continue
+        stats = dict(zip(names[1:], values[1:]))
+        try:
+            return (int(stats['ListenOverflows']), int(stats['ListenDrops']))
+        except (KeyError, ValueError):
+            return None
+    return None
+
+
+def udp_queues(port):
+    """
+    Returns a list of (rx_queue_bytes, drops) tuples, one for each udp
+    socket bound to port
+
+    port:int        The local port to look for
+    """
+    ret = []
+    for fields in _read_proc_sockets(('/proc/net/udp', '/proc/net/udp6'),
+            port):
+        rx_queue = int(fields[4].split(':')[1], 16)
+        drops = int(fields[-1]) if len(fields) >= 13 else 0
+        ret.append((rx_queue, drops))
+    return ret
+
+
+def sample(protocol, port, sock=None):
+    """
+    Take a sample of the queue stats for the server, returning a dict.
+    The keys present depend on the protocol:
+
+        tcp:    queue, queue_max, sockets, backlog, listen_overflows,
+                listen_drops
+        udp:    rx_queue, rx_queue_max, sockets, drops
+
+    protocol:str            Either tcp or udp
+    port:int                The bound port
+    sock:socket.socket      The listening socket, if it is held by the
+                            caller.  This is used for the more precise
+                            TCP_INFO numbers
+    """
+    ret = {}
+    if protocol == 'tcp':
+        queues = tcp_listen_queues(port)
+        info = tcp_info_queue(sock) if sock is not None else None
+        if info is not None:
+            queues = [info[0]]
+            ret['backlog'] = info[1]
+        ret['sockets'] = len(queues)
+        ret['queue'] = sum(queues)
+        ret['queue_max'] = max(queues) if queues else 0
+        drops = tcp_listen_drops()
+        if drops is not None:
+            ret['listen_overflows'], ret['listen_drops'] = drops
+    else:
+        queues = udp_queues(port)
+        ret['sockets'] = len(queues)
+        ret['rx_queue'] = sum([ q[0] for q in queues ])
+        ret['rx_queue_max'] = max([ q[0] for q in queues ]) if queues else 0
+        ret['drops'] = sum([ q[1] for q in queues ])
+    return ret
@@ -0,0 +1,48 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A base for the wrappers the children put around an accepted socket, such
+# as preforkserver.deadline.DeadlineSocket and the capture recorder.  The
+# subclasses override the calls they care about, and everything else goes
+# through to the real socket.
+#
+
+import socket
+
+__all__ = ['SocketWrapper']
+
+
+class SocketWrapper(object):
+    """
+    Passes everything it doesn't override through to sock
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def makefile(self, *args, **kwargs):
+        # socket.makefile() only needs recv_into(), send() and the
+        # refcounting from its self, so building the file on the wrapper,
+        # rather than the real socket, keeps the overrides in the path
+        return socket.socket.makefile(self, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
@@ -0,0 +1,384 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+#
+# Connection steering for reuse_port.  By default the kernel picks the
+# socket in a reuse_port group from a hash of the whole 4-tuple, so every
+# new connection from a client, with its new source port, lands on a
+# random child.  This attaches a classic BPF program to the group which
+# picks the socket from the client's address instead, or from the CPU
+# the packet came in on:
+#
+#     manager = Manager(MyChild, reuse_port=True,
+#         steering=ReusePortSteering('source'))
+#
+# A given client then keeps going to the same child, which is what makes
+# per-child caches and state pay off.
+#
+# 'flow' spreads connections by client address and port, much like the
+# kernel's own hashing.  The manager uses that when draining is on and no
+# steering was given, since a child which is draining its accept queue
+# has to be taken out of the group, or the kernel keeps sending it new
+# connections until it closes.  A draining child gives up its seat and
+# attaches the new program itself, right away.
+#
+# The hash is taken modulo a fixed number of seats, max_servers by
+# default, and each child holds one seat while it is bound.  A child
+# that exits gives up its seat and its replacement takes the same one,
+# so recycling a child only moves that seat's clients.  A seat with no
+# child is handed to one of the others by rendezvous hashing, which
+# again only moves the clients of the seat that changed.
+#
+# The program has to return an index into the kernel's array of sockets
+# for the group, not a seat.  The kernel appends a socket to that array
+# when it starts listening (or binds, for udp) and fills the hole left
+# by a closed one with the last socket.  The children bind and close
+# their sockets under a shared lock and mirror those moves in shared
+# memory, so the seat to index table can be kept right.  A child that
+# dies without closing its sockets is dropped from the mirror when the
+# manager reaps it, and if several die at once their order may no
+# longer match the kernel's.  Clients then still get spread over the
+# live children, just not the ones they had.  The mirror also assumes
+# the children are the only sockets in the group.
+#
+# Whoever changes the table bumps a generation counter, and the children
+# attach a new program, between requests, when it changes.  A program
+# attached to any socket applies to the whole group.
+#
+# This is Linux only (SO_ATTACH_REUSEPORT_CBPF, 4.5+).  Elsewhere, or if
+# the attach fails, the kernel's default hashing is used.
+#
+
+import multiprocessing as mp
+import ctypes
+import os
+import socket
+import struct
+
+__all__ = ['ReusePortSteering']
+
+_SO_ATTACH_REUSEPORT_CBPF = getattr(socket, 'SO_ATTACH_REUSEPORT_CBPF', 51)
+
+# Classic BPF opcodes
+_LD_W_ABS = 0x20
+_LD_H_ABS = 0x28
+_LD_H_IND = 0x48
+_LDX_B_MSH = 0xb1
+_MISC_TAX = 0x07
+_ALU_XOR_X = 0xac
+_ALU_MUL_K = 0x24
+_ALU_RSH_K = 0x74
+_ALU_MOD_K = 0x94
+_JMP_JEQ_K = 0x15
+_RET_K = 0x06
+
+# Negative offsets for loads relative to the network header and for the
+# ancillary data
+_SKF_NET_OFF = -0x100000
+_SKF_AD_CPU = -0x1000 + 36
+
+# The source address in the IPv4 header, and the last 4 bytes of it in
+# the IPv6 header
+_SRC_OFF = {
+    socket.AF_INET: 12,
+    socket.AF_INET6: 20,
+}
+
+# The tcp or udp header, after a fixed IPv6 header.  IPv4 uses the header
+# length from the packet
+_IP6_HDR = 40
+
+_INSN = struct.Struct('=HBBI')
+
+# The kernel takes at most 4096 instructions.  The program is a few for
+# the hash plus two per seat
+_MAX_SEATS = 2040
+
+# How long to wait for the lock before going ahead without it.  It is
+# only ever held for a few system calls, so this means its holder died
+_LOCK_TIMEOUT = 2.0
+
+
+def _insn(code, k=0, jt=0, jf=0):
+    return _INSN.pack(code, jt, jf, k & 0xffffffff)
+
+
+def _weight(seat, owner):
+    """
+    The rendezvous weight of owner for a vacant seat
+    """
+    h = (seat * 0x9e3779b1 ^ owner * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 16
+    h = (h * 0x7feb352d) & 0xffffffff
+    return h ^ (h >> 15)
+
+
+class _Locked(object):
+    """
+    Holds the steering lock, for a with block
+    """
+    def __init__(self, lock):
+        self._lock = lock
+        self._held = False
+
+    def __enter__(self):
+        self._held = self._lock.acquire(timeout=_LOCK_TIMEOUT)
+        return self
+
+    def __exit__(self, *exc):
+        if self._held:
+            self._lock.release()
+
+
+class ReusePortSteering(object):
+    """
+    Steers reuse_port connections to a stable child.  Pass this to the
+    Manager as steering
+    """
+    modes = ('source', 'cpu', 'flow')
+
+    def __init__(self, mode='source', seats=None):
+        """
+        mode:str        'source' picks the child from the client's IP
+                        address.  'cpu' picks it from the CPU the packet
+                        arrived on, which pairs well with one child per
+                        CPU and RSS.  'flow' picks it from the client's
+                        address and port, which spreads connections
+                        evenly rather than keeping a client on one child
+        seats:int       The number of seats to hash over.  This should
+                        be at least the most children the pool will ever
+                        have, since a child with no seat gets no new
+                        connections.  The manager's max_servers (or the
+                        autosize ceiling) by default
+        """
+        if mode not in self.modes:
+            raise ValueError('Invalid steering mode %r, must be in: %r' %
+                (mode, self.modes))
+        self.mode = mode
+        self.seats = seats
+        self._lock = None
+        # The pid holding each seat, or 0, and when each was last
+        # vacated, so a replacement takes the seat just given up
+        self._seat_pid = None
+        self._vacated = None
+        self._clock = None
+        # The pids of the sockets in the kernel's array, in its order
+        self._order = None
+        self._count = None
+        # The kernel index each seat maps to, -1 if there is nobody
+        self._table = None
+        self._gen = None
+        # The generation of the program attached in this process
+        self._attached = 0
+
+    def setup(self, seats):
+        """
+        Allocate the shared state.  The manager calls this before forking,
+        with its max_servers unless seats was given
+        """
+        seats = min(_MAX_SEATS, max(1, int(self.seats or seats)))
+        self.seats = seats
+        self._lock = mp.Lock()
+        self._seat_pid = mp.RawArray('i', seats)
+        self._vacated = mp.RawArray('L', seats)
+        self._clock = mp.RawValue('L', 0)
+        # Children on their way out are still in the group
+        self._order = mp.RawArray('i', seats * 4 + 16)
+        self._count = mp.RawValue('i', 0)
+        self._table = mp.RawArray('i', [-1] * seats)
+        self._gen = mp.RawValue('L', 0)
+
+    def join(self, bind):
+        """
+        Called by a child to bind its sockets, with bind, a callable that
+        binds them and returns the ones in the group.  They are bound
+        under the lock, so the kernel's order is known, and the child
+        takes the seat vacated last, or else the first free one
+        """
+        pid = os.getpid()
+        with _Locked(self._lock):
+            socks = bind()
+            if self._count.value < len(self._order):
+                self._order[self._count.value] = pid
+                self._count.value += 1
+            free = [ i for i in range(self.seats) if not self._seat_pid[i] ]
+            if free:
+                seat = max(free, key=lambda i: (self._vacated[i], -i))
+                self._seat_pid[seat] = pid
+            self._changed()
+            self._attach_all(socks)
+        return socks
+
+    def release(self, socks):
+        """
+        Called by a child which is about to drain its accept queue.  It
+        gives up its seat but stays bound, and attaches the new program
+        to socks now, so no new connections are sent its way
+        """
+        with _Locked(self._lock):
+            if self._vacate(os.getpid()):
+                self._changed()
+            self._attach_all(socks)
+
+    def leave(self, socks):
+        """
+        Called by a child on its way out to close socks and give up its
+        seat
+        """
+        with _Locked(self._lock):
+            for sock in socks:
+                sock.close()
+            self._drop(os.getpid())
+
+    def reap(self, pid):
+        """
+        Called by the manager for each child it reaps, in case it died
+        without leaving
+        """
+        with _Locked(self._lock):
+            self._drop(pid)
+
+    def _drop(self, pid):
+        """
+        Take pid out of the mirror, the way the kernel does, and vacate
+        its seat.  Call this with the lock held
+        """
+        changed = self._vacate(pid)
+        for i in range(self._count.value):
+            if self._order[i] == pid:
+                last = self._count.value - 1
+                self._order[i] = self._order[last]
+                self._count.value = last
+                changed = True
+                break
+        if changed:
+            self._changed()
+
+    def _vacate(self, pid):
+        for i in range(self.seats):
+            if self._seat_pid[i] == pid:
+                self._seat_pid[i] = 0
+                self._clock.value += 1
+                self._vacated[i] = self._clock.value
+                return True
+        return False
+
+    def _changed(self):
+        """
+        Rebuild the table and bump the generation.  Call this with the
+        lock held
+        """
+        index = dict((self._order[i], i) for i in range(self._count.value))
+        held = [ i for i in range(self.seats)
+            if self._seat_pid[i] in index ]
+        for i in range(self.seats):
+            if self._seat_pid[i] in index:
+                owner = i
+            elif held:
+                owner = max(held, key=lambda o: _weight(i, o))
+            else:
+                self._table[i] = -1
+                continue
+            self._table[i] = index[self._seat_pid[owner]]
+        self._gen.value += 1
+
+    def program(self, family, table):
+        """
+        Returns the BPF program, as bytes, for sockets of family, where
+        table holds the kernel index for each seat
+        """
+        if self.mode == 'cpu':
+            insns = [_insn(_LD_W_ABS, _SKF_AD_CPU)]
+        elif self.mode == 'flow':
+            if family == socket.AF_INET:
+                insns = [
+                    # X = the IPv4 header length, A = the source port
+                    _insn(_LDX_B_MSH, _SKF_NET_OFF),
+                    _insn(_LD_H_IND, _SKF_NET_OFF),
+                ]
+            else:
+                insns = [_insn(_LD_H_ABS, _SKF_NET_OFF + _IP6_HDR)]
+            insns += [
+                _insn(_MISC_TAX),
+                _insn(_LD_W_ABS, _SKF_NET_OFF + _SRC_OFF[family]),
+                _insn(_ALU_XOR_X),
+                _insn(_ALU_MUL_K, 0x9e3779b1),
+                _insn(_ALU_RSH_K, 16),
+            ]
+        else:
+            insns = [
+                _insn(_LD_W_ABS, _SKF_NET_OFF + _SRC_OFF[family]),
+                # Mix the high bits of the address into the low ones,
+                # so clients that only differ in their network part
+                # still spread out
+                _insn(_ALU_MUL_K, 0x9e3779b1),
+                _insn(_ALU_RSH_K, 16),
+            ]
+        insns.append(_insn(_ALU_MOD_K, len(table)))
+        for seat, index in enumerate(table[:-1]):
+            insns.append(_insn(_JMP_JEQ_K, seat, 0, 1))
+            insns.append(_insn(_RET_K, index))
+        insns.append(_insn(_RET_K, table[-1]))
+        return b''.join(insns)
+
+    def attach(self, sock, table):
+        """
+        Attach the program to the reuse_port group of sock.  Returns False
+        if that isn't possible here
+        """
+        family = sock.family
+        if family not in _SRC_OFF:
+            return False
+        code = self.program(family, table)
+        buf = ctypes.create_string_buffer(code, len(code))
+        # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+        fprog = struct.pack('@HP', len(code) // _INSN.size,
+            ctypes.addressof(buf))
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_ATTACH_REUSEPORT_CBPF,
+                fprog)
+        except (OSError, socket.error):
+            return False
+        return True
+
+    def _attach_all(self, socks):
+        """
+        Attach the current table to socks.  Call this with the lock held,
+        so an older table can't replace a newer one
+        """
+        self._attached = self._gen.value
+        table = list(self._table)
+        if -1 in table:
+            # Nobody is bound
+            return False
+        for sock in socks:
+            self.attach(sock, table)
+        return True
+
+    def check(self, socks):
+        """
+        Called by the children between requests.  Attach a new program to
+        each of socks if the table changed.  Returns True if it did
+        """
+        if self._gen.value == self._attached:
+            return False
+        with _Locked(self._lock):
+            return self._attach_all(socks)
@@ -0,0 +1,401 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# TLS termination in the children.  The manager builds the SSLContext
+# once, before forking, so every child inherits the loaded certificate
+# and keys instead of parsing them again.
+#
+#     tls = TLSConfig('/etc/myapp/cert.pem', '/etc/myapp/key.pem')
+#     manager = Manager(MyChild, port=443, tls=tls)
+#
+# For session resumption to work no matter which child a client lands on,
+# all the children need the same session ticket key.  By default they
+# share the key OpenSSL made when the context was built, since they
+# inherit it, but it is never rotated.
+#
+# With openssl_hooks=True, the key lives in shared memory instead.  The
+# manager replaces it every ticket_rotation seconds, and the children
+# encrypt and decrypt tickets with it from OpenSSL's ticket key callback.
+# The key it replaced is kept until the next rotation, so tickets issued
+# under it still resume, and are reissued under the new key.  Python has
+# no API for any of this, so it calls OpenSSL directly through ctypes,
+# which means finding the SSL_CTX inside CPython's SSLContext object.
+# That is only done on CPython, against the libssl the ssl module is
+# linked with, when its version matches the ssl module's, and after
+# checking the pointer in a throwaway child process.  If any of that
+# fails, it falls back to the inherited key.
+#
+# Session ID resumption uses OpenSSL's in-memory cache, which each child
+# keeps for itself.  With openssl_hooks, it is sized by
+# session_cache_size.
+#
+
+from preforkserver.shm import anon_mmap
+from preforkserver.exceptions import TLSHandshakeError
+import platform
+import struct
+import socket
+import ctypes
+import time
+import ssl
+import os
+
+__all__ = ['TLSConfig']
+
+# OpenSSL SSL_CTX_ctrl() and SSL_CTX_callback_ctrl() commands
+_CTRL_SET_SESS_CACHE_SIZE = 42
+_CTRL_SET_TLSEXT_TICKET_KEY_CB = 72
+
+# A ticket key is a name, which goes out in the ticket so the key can be
+# found again, then the AES-256 and HMAC-SHA256 keys
+_NAME_LEN = 16
+_AES_LEN = 32
+_HMAC_LEN = 32
+_KEY_LEN = _NAME_LEN + _AES_LEN + _HMAC_LEN
+_IV_LEN = 16
+
+# The generation of the keys, followed by the current key and the one it
+# replaced.  The generation is odd while the manager is writing new keys
+_GEN = struct.Struct('=Q')
+
+# int cb(SSL *s, unsigned char key_name[16], unsigned char *iv,
+#     EVP_CIPHER_CTX *ctx, HMAC_CTX *hctx, int enc)
+_TICKET_KEY_CB = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p,
+    ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+    ctypes.c_int)
+
+
+def _ssl_library():
+    """
+    Returns the CDLL for the libssl the ssl module is linked with, or
+    None.  Symbols looked up through the _ssl extension's own handle come
+    from its dependencies, so this can't pick up some other libssl loaded
+    in the process
+    """
+    import _ssl
+    path = getattr(_ssl, '__file__', None)
+    try:
+        # Without a file, _ssl is built into the interpreter
+        return ctypes.CDLL(path)
+    except OSError:
+        return None
+
+
+class _OpenSSL(object):
+    """
+    Direct calls into the libssl that the ssl module is using
+    """
+
+    def __init__(self):
+        self.lib = None
+        if platform.python_implementation() != 'CPython':
+            return
+        lib = _ssl_library()
+        if lib is None:
+            return
+        try:
+            lib.OpenSSL_version_num.argtypes = []
+            lib.OpenSSL_version_num.restype = ctypes.c_ulong
+            # Anything older has other names for half of these
+            if lib.OpenSSL_version_num() != ssl.OPENSSL_VERSION_NUMBER or \
+                    ssl.OPENSSL_VERSION_NUMBER < 0x10101000:
+                return
+            lib.SSL_CTX_ctrl.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                ctypes.c_long, ctypes.c_void_p]
+            lib.SSL_CTX_ctrl.restype = ctypes.c_long
+            lib.SSL_CTX_callback_ctrl.argtypes = [ctypes.c_void_p,
+                ctypes.c_int, ctypes.c_void_p]
+            lib.SSL_CTX_callback_ctrl.restype = ctypes.c_long
+            lib.SSL_CTX_get_verify_mode.argtypes = [ctypes.c_void_p]
+            lib.SSL_CTX_get_verify_mode.restype = ctypes.c_int
+            lib.SSL_CTX_get_options.argtypes = [ctypes.c_void_p]
+            lib.SSL_CTX_get_options.restype = ctypes.c_uint64 \
+                if ssl.OPENSSL_VERSION_NUMBER >= 0x30000000 \
+                else ctypes.c_ulong
+            lib.EVP_aes_256_cbc.argtypes = []
+            lib.EVP_aes_256_cbc.restype = ctypes.c_void_p
+            lib.EVP_sha256.argtypes = []
+            lib.EVP_sha256.restype = ctypes.c_void_p
+            for name in ('EVP_EncryptInit_ex', 'EVP_DecryptInit_ex'):
+                func = getattr(lib, name)
+                func.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                    ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p]
+                func.restype = ctypes.c_int
+            lib.HMAC_Init_ex.argtypes = [ctypes.c_void_p, ctypes.c_char_p,
+                ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+            lib.HMAC_Init_ex.restype = ctypes.c_int
+            self.cipher = lib.EVP_aes_256_cbc()
+            self.digest = lib.EVP_sha256()
+        except AttributeError:
+            return
+        self.lib = lib
+
+    def _read_ctx_ptr(self, context):
+        """
+        The pointer is the first field after the object header in
+        CPython's SSLContext, if the object is big enough to have one
+        """
+        if type(context).__basicsize__ < object.__basicsize__ + \
+                ctypes.sizeof(ctypes.c_void_p):
+            return None
+        return ctypes.c_void_p.from_address(id(context) +
+            object.__basicsize__).value
+
+    def _matches(self, ptr, context):
+        """
+        Make sure ptr really is the SSL_CTX by checking that OpenSSL
+        agrees with Python about the verify mode and the options
+        """
+        want = {
+            ssl.CERT_NONE: 0,
+            ssl.CERT_OPTIONAL: 1,
+            ssl.CERT_REQUIRED: 3,
+        }[context.verify_mode]
+        return self.lib.SSL_CTX_get_verify_mode(ptr) == want and \
+            self.lib.SSL_CTX_get_options(ptr) == int(context.options)
+
+    def ctx_ptr(self, context):
+        """
+        Returns the SSL_CTX pointer for context, or None if it can't be
+        found safely.  A wrong pointer could crash the process, so it is
+        tried out in a child process first
+        """
+        if self.lib is None:
+            return None
+        ptr = self._read_ctx_ptr(context)
+        if not ptr:
+            return None
+        pid = os.fork()
+        if not pid:
+            try:
+                ok = self._matches(ptr, context)
+            except Exception:
+                ok = False
+            os._exit(0 if ok else 1)
+        while True:
+            try:
+                status = os.waitpid(pid, 0)[1]
+                break
+            except InterruptedError:
+                continue
+        if status != 0:
+            return None
+        return ptr
+
+    def ctrl(self, ptr, cmd, larg, parg=None):
+        return self.lib.SSL_CTX_ctrl(ptr, cmd, larg, parg)
+
+    def set_ticket_key_cb(self, ptr, cb):
+        return self.lib.SSL_CTX_callback_ctrl(ptr,
+            _CTRL_SET_TLSEXT_TICKET_KEY_CB, ctypes.cast(cb, ctypes.c_void_p))
+
+
+class TLSConfig(object):
+    """
+    The server side TLS settings.  Pass this to the Manager as tls
+    """
+
+    def __init__(self, certfile=None, keyfile=None, password=None,
+            cafile=None, verify_client=False, ciphers=None,
+            alpn_protocols=None, ticket_rotation=3600,
+            session_cache_size=20480, handshake_timeout=10.0, context=None,
+            openssl_hooks=False):
+        """
+        certfile:str            The PEM certificate chain
+        keyfile:str             The private key, if not in certfile
+        password:str            The password for the private key
+        cafile:str              CA certificates for verifying clients
+        verify_client:bool      Require a client certificate
+        ciphers:str             An OpenSSL cipher string
+        alpn_protocols:list     Protocols to offer with ALPN
+        ticket_rotation:float   Seconds between session ticket key
+                                rotations, with openssl_hooks.  Zero
+                                disables rotation
+        session_cache_size:int  The size of each child's session ID
+                                cache, with openssl_hooks
+        handshake_timeout:float The max seconds for the handshake
+        context:SSLContext      Use this context rather than building one
+                                from the above
+        openssl_hooks:bool      Call into OpenSSL with ctypes to rotate a
+                                shared session ticket key and size the
+                                session cache.  This relies on CPython
+                                internals, so it is off by default
+        """
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.password = password
+        self.cafile = cafile
+        self.verify_client = verify_client
+        self.ciphers = ciphers
+        self.alpn_protocols = alpn_protocols
+        self.ticket_rotation = float(ticket_rotation)
+        self.session_cache_size = int(session_cache_size)
+        self.handshake_timeout = handshake_timeout
+        self.context = context
+        self.openssl_hooks = openssl_hooks
+        # True if the ticket keys are shared through shared memory and
+        # rotated, False if the key is only inherited
+        self.shared_tickets = False
+        self.rotations = 0
+        self._ossl = None
+        self._ctx_ptr = None
+        self._mem = None
+        self._ticket_cb = None
+        self._next_rotation = 0
+
+    def _build_context(self):
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(self.certfile, self.keyfile, self.password)
+        if self.cafile:
+            ctx.load_verify_locations(self.cafile)
+        if self.verify_client:
+            ctx.verify_mode = ssl.CERT_REQUIRED
+        if self.ciphers:
+            ctx.set_ciphers(self.ciphers)
+        if self.alpn_protocols:
+            ctx.set_alpn_protocols(self.alpn_protocols)
+        return ctx
+
+    def setup(self):
+        """
+        Build the context and the shared ticket keys.  The manager calls
+        this before any children are forked
+        """
+        if self.context is None:
+            self.context = self._build_context()
+        if not self.openssl_hooks:
+            return
+        self._ossl = _OpenSSL()
+        self._ctx_ptr = self._ossl.ctx_ptr(self.context)
+        if self._ctx_ptr is None:
+            return
+        self._ossl.ctrl(self._ctx_ptr, _CTRL_SET_SESS_CACHE_SIZE,
+            self.session_cache_size)
+        self._mem = anon_mmap(_GEN.size + 2 * _KEY_LEN)
+        self.rotate(force=True)
+        # Keep a reference, as OpenSSL only has the function pointer
+        self._ticket_cb = _TICKET_KEY_CB(self._on_ticket_key)
+        if self._ossl.set_ticket_key_cb(self._ctx_ptr, self._ticket_cb) != 1:
+            self._ticket_cb = None
+            return
+        self.shared_tickets = True
+
+    def rotate(self, force=False):
+        """
+        Put a new ticket key in place for all the children.  Tickets
+        issued under the old key are still accepted until the next
+        rotation
+        """
+        if not (self.shared_tickets or force):
+            return False
+        gen = _GEN.unpack_from(self._mem, 0)[0]
+        _GEN.pack_into(self._mem, 0, gen + 1)
+        cur = _GEN.size
+        self._mem[cur + _KEY_LEN:cur + 2 * _KEY_LEN] = \
+            self._mem[cur:cur + _KEY_LEN]
+        self._mem[cur:cur + _KEY_LEN] = os.urandom(_KEY_LEN)
+        _GEN.pack_into(self._mem, 0, gen + 2)
+        self._next_rotation = time.time() + self.ticket_rotation
+        self.rotations += 1
+        return True
+
+    def maybe_rotate(self):
+        """
+        Called from the manager loop.  Rotate the key if it is time
+        """
+        if self.shared_tickets and self.ticket_rotation and \
+                time.time() >= self._next_rotation:
+            self.rotate()
+
+    def _keys(self):
+        """
+        Returns the current and previous keys, as consistent copies
+        """
+        while True:
+            gen = _GEN.unpack_from(self._mem, 0)[0]
+            if gen & 1:
+                # The manager is in the middle of a write
+                continue
+            data = self._mem[_GEN.size:_GEN.size + 2 * _KEY_LEN]
+            if _GEN.unpack_from(self._mem, 0)[0] == gen:
+                # The previous key is all zeros until the first rotation
+                return [ data[i:i + _KEY_LEN] for i in (0, _KEY_LEN)
+                    if data[i:i + _NAME_LEN].strip(b'\0') ]
+
+    def _on_ticket_key(self, ssl_ptr, key_name, iv, cipher_ctx, hmac_ctx,
+            enc):
+        """
+        OpenSSL's ticket key callback.  When encrypting, this fills in the
+        name of the current key and a new IV.  When decrypting, it finds
+        the key by name, and returns 2 for the previous key to have the
+        ticket reissued, or 0 for an unknown one to do a full handshake
+        """
+        lib = self._ossl.lib
+        try:
+            keys = self._keys()
+            if enc:
+                key = keys[0]
+                ctypes.memmove(key_name, key, _NAME_LEN)
+                ctypes.memmove(iv, os.urandom(_IV_LEN), _IV_LEN)
+                init = lib.EVP_EncryptInit_ex
+                ret = 1
+            else:
+                name = ctypes.string_at(key_name, _NAME_LEN)
+                for ret, key in enumerate(keys, 1):
+                    if key[:_NAME_LEN] == name:
+                        break
+                else:
+                    return 0
+            aes = key[_NAME_LEN:_NAME_LEN + _AES_LEN]
+            mac = key[_NAME_LEN + _AES_LEN:]
+            if lib.HMAC_Init_ex(hmac_ctx, mac, _HMAC_LEN, self._ossl.digest,
+                    None) != 1:
+                return 0
+            if not enc:
+                init = lib.EVP_DecryptInit_ex
+            if init(cipher_ctx, self._ossl.cipher, None, aes, iv) != 1:
+                return 0
+            return ret
+        except Exception:
+            # Never let an exception out into OpenSSL.  No ticket, or a
+            # full handshake, is always safe
+            return 0
+
+    def wrap(self, sock):
+        """
+        Wrap an accepted socket.  The handshake is done by handshake()
+        """
+        return self.context.wrap_socket(sock, server_side=True,
+            do_handshake_on_connect=False)
+
+    def handshake(self, tls_sock):
+        """
+        Do the handshake on a socket from wrap().  Raises
+        TLSHandshakeError if it fails or takes too long
+        """
+        tls_sock.settimeout(self.handshake_timeout)
+        try:
+            tls_sock.do_handshake()
+        except socket.timeout:
+            raise TLSHandshakeError('handshake timed out')
+        except (ssl.SSLError, OSError) as e:
+            raise TLSHandshakeError('handshake failed: %s' % e)
+        tls_sock.settimeout(None)
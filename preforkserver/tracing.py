@@ -0,0 +1,310 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Per-request tracing for the child hook pipeline.  A Tracer makes a
+# head-based sampling decision at the start of each request.  Unsampled
+# requests get the NULL_TRACE, which does nothing, so the overhead for
+# those is a single random() call.  Sampled requests produce a root span
+# plus one child span per phase, which are handed to an exporter.  For
+# tcp on Linux, the time the connection spent in the kernel's accept
+# queue, before the child picked it up, is recorded as an accept_queue
+# span ahead of the rest.
+#
+
+from collections import deque
+import threading
+import binascii
+import random
+import json
+import time
+import os
+
+__all__ = ['Span', 'Tracer', 'BatchExporter', 'JSONLinesExporter',
+    'NULL_TRACE']
+
+
+def _new_id():
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+class Span(object):
+    """
+    A single timed span.  Times are wall clock epoch seconds
+    """
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'pid', 'start',
+        'end', 'attrs')
+
+    def __init__(self, name, trace_id, parent_id=None, start=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.pid = os.getpid()
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attrs = None
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def set_attr(self, key, value):
+        if self.attrs is None:
+            self.attrs = {}
+        self.attrs[key] = value
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'pid': self.pid,
+            'start': self.start,
+            'end': self.end,
+            'duration': self.duration,
+            'attrs': self.attrs or {},
+        }
+
+
+class _Trace(object):
+    """
+    A sampled request.  Phases are contiguous, so each call to mark()
+    closes a child span that runs from the previous mark to now
+    """
+
+    def __init__(self, tracer, name):
+        self._tracer = tracer
+        self._last = time.time()
+        self.root = Span(name, _new_id(), start=self._last)
+        self.spans = []
+
+    def mark(self, name):
+        now = time.time()
+        span = Span(name, self.root.trace_id, self.root.span_id, self._last)
+        span.end = now
+        self.spans.append(span)
+        self._last = now
+        return span
+
+    def mark_before(self, name, start):
+        """
+        Record a span from start up to the beginning of the trace, for
+        time spent before the request was picked up, and move the root
+        back to cover it
+        """
+        if start >= self.root.start:
+            return None
+        span = Span(name, self.root.trace_id, self.root.span_id, start)
+        span.end = self.root.start
+        self.spans.append(span)
+        self.root.start = start
+        return span
+
+    def set_attr(self, key, value):
+        self.root.set_attr(key, value)
+
+    def finish(self):
+        self.root.end = time.time()
+        self._tracer.export(self.root)
+        for span in self.spans:
+            self._tracer.export(span)
+
+
+class _NullTrace(object):
+    """
+    Stand-in for an unsampled request.  Every method is a no-op
+    """
+
+    def mark(self, name):
+        return None
+
+    def mark_before(self, name, start):
+        return None
+
+    def set_attr(self, key, value):
+        return
+
+    def finish(self):
+        return
+
+NULL_TRACE = _NullTrace()
+
+
+class Tracer(object):
+    """
+    Creates sampled traces and hands finished spans to an exporter
+    """
+
+    def __init__(self, exporter, sample_rate=0.01):
+        """
+        exporter:BatchExporter  Anything with export(span) and shutdown()
+                                methods
+        sample_rate:float       The fraction of requests to trace, between
+                                0.0 and 1.0
+        """
+        sample_rate = float(sample_rate)
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError('sample_rate must be between 0.0 and 1.0')
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def begin(self, name='request'):
+        """
+        Make the head sampling decision and return a trace object.  The
+        NULL_TRACE is returned for unsampled requests
+        """
+        if self.sample_rate and random.random() < self.sample_rate:
+            return _Trace(self, name)
+        return NULL_TRACE
+
+    def export(self, span):
+        self.exporter.export(span)
+
+    def shutdown(self):
+        """
+        Flush anything pending in the exporter
+        """
+        self.exporter.shutdown()
+
+
+class BatchExporter(object):
+    """
+    A non-blocking exporter.  Spans are queued in memory and written to
+    the sink in batches from a background thread.  If the queue is full,
+    spans are dropped and counted in self.dropped rather than blocking
+    the request path.
+
+    The background thread is started lazily in whatever process first
+    exports a span, so an exporter can be created in the manager and
+    used safely in the forked children
+    """
+
+    def __init__(self, sink, max_queue=8192, max_batch=512, interval=1.0):
+        """
+        sink:JSONLinesExporter  Anything with a write(spans) method which
+                                takes a list of Span objects
+        max_queue:int           The maximum number of spans to hold before
+                                dropping
+        max_batch:int           The maximum number of spans per write
+        interval:float          The maximum number of seconds between writes
+        """
+        self.sink = sink
+        self.max_queue = int(max_queue)
+        self.max_batch = int(max_batch)
+        self.interval = float(interval)
+        self.dropped = 0
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._pid = None
+        self._thread = None
+        self._stopped = False
+
+    def export(self, span):
+        if self._pid != os.getpid():
+            self._start()
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append(span)
+        if len(self._queue) >= self.max_batch:
+            with self._cond:
+                self._cond.notify()
+
+    def shutdown(self):
+        """
+        Stop the background thread and write out anything still queued
+        """
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(self.interval + 1)
+        self._flush()
+
+    def _start(self):
+        # Anything queued belongs to the process we were forked from
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and len(self._queue) < self.max_batch:
+                    self._cond.wait(self.interval)
+                if self._stopped:
+                    return
+            self._flush()
+
+    def _flush(self):
+        while self._queue:
+            batch = []
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.popleft())
+            except IndexError:
+                pass
+            try:
+                self.sink.write(batch)
+            except Exception:
+                self.dropped += len(batch)
+
+
+class JSONLinesExporter(object):
+    """
+    Writes spans as one JSON object per line.  Each batch goes out in a
+    single O_APPEND write so that all the children can share one file
+    """
+
+    def __init__(self, path):
+        """
+        path:str        The path to the file to append to
+        """
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def write(self, spans):
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        data = ''.join([ json.dumps(s.to_dict()) + '\n' for s in spans ])
+        os.write(self._fd, data.encode('utf-8'))
+
+    def export(self, span):
+        """
+        Write a single span synchronously.  This makes it possible to use
+        this directly as a Tracer exporter, though you almost always want
+        to wrap it in a BatchExporter instead
+        """
+        self.write([span])
+
+    def shutdown(self):
+        return
@@ -0,0 +1,197 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Socket tuning.  A SocketProfile is a set of socket options which the
+# Manager applies to every tcp listener, whether it is bound in the
+# manager or, with reuse_port, in the children, and to each accepted
+# connection.
+#
+#     profile = SocketProfile(nodelay=True, defer_accept=5, fastopen=256,
+#         keepalive=True, keepidle=60)
+#     manager = Manager(MyChild, socket_profile=profile)
+#     print(manager.socket_options)
+#
+# Options the kernel copies from a listener to the sockets it accepts,
+# which is all of them but TCP_QUICKACK on Linux, are only set on the
+# listener.  That saves a few system calls on every connection.  Options
+# not supported on this system are skipped.
+#
+
+import socket
+import sys
+
+__all__ = ['SocketProfile', 'default_backlog', 'tcp_migrate_req']
+
+# Linux values, for Pythons built without the constants
+_TCP_DEFER_ACCEPT = getattr(socket, 'TCP_DEFER_ACCEPT', 9)
+_TCP_QUICKACK = getattr(socket, 'TCP_QUICKACK', 12)
+_TCP_FASTOPEN = getattr(socket, 'TCP_FASTOPEN', 23)
+_LINUX = sys.platform.startswith('linux')
+
+
+def default_backlog():
+    """
+    Returns the listen backlog to use by default, which is the kernel's
+    limit, net.core.somaxconn
+    """
+    try:
+        with open('/proc/sys/net/core/somaxconn') as fh:
+            return int(fh.read().strip())
+    except (IOError, OSError, ValueError):
+        return socket.SOMAXCONN
+
+
+def tcp_migrate_req():
+    """
+    Returns True if net.ipv4.tcp_migrate_req is on.  With it, the kernel
+    moves the queued connections of a closing reuse_port listener to
+    another socket in its group instead of resetting them
+    """
+    try:
+        with open('/proc/sys/net/ipv4/tcp_migrate_req') as fh:
+            return fh.read().strip() == '1'
+    except (IOError, OSError):
+        return False
+
+
+class SocketProfile(object):
+    """
+    A set of socket options.  None means leave the system default alone
+    """
+
+    def __init__(self, nodelay=True, defer_accept=None, fastopen=None,
+            rcvbuf=None, sndbuf=None, quickack=False, keepalive=None,
+            keepidle=None, keepintvl=None, keepcnt=None):
+        """
+        nodelay:bool        Set TCP_NODELAY, turning off Nagle
+        defer_accept:int    Set TCP_DEFER_ACCEPT to this many seconds, so
+                            a connection is only accepted once the client
+                            sends data
+        fastopen:int        Enable TCP_FASTOPEN with this queue length
+        rcvbuf:int          SO_RCVBUF in bytes
+        sndbuf:int          SO_SNDBUF in bytes
+        quickack:bool       Set TCP_QUICKACK on each accepted connection
+        keepalive:bool      Set SO_KEEPALIVE
+        keepidle:int        Seconds idle before keepalive probes start
+        keepintvl:int       Seconds between keepalive probes
+        keepcnt:int         Failed probes before the connection is dropped
+        """
+        self.nodelay = nodelay
+        self.defer_accept = defer_accept
+        self.fastopen = fastopen
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.quickack = quickack
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+
+    def _options(self):
+        """
+        Yields (name, level, option, value, before_listen) for every
+        option that is set and supported here
+        """
+        tcp = socket.IPPROTO_TCP
+        opts = [
+            ('rcvbuf', socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf,
+                True),
+            ('sndbuf', socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf,
+                True),
+            ('nodelay', tcp, socket.TCP_NODELAY,
+                None if self.nodelay is None else int(self.nodelay), False),
+            ('keepalive', socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                None if self.keepalive is None else int(self.keepalive),
+                False),
+            ('keepidle', tcp, getattr(socket, 'TCP_KEEPIDLE', None),
+                self.keepidle, False),
+            ('keepintvl', tcp, getattr(socket, 'TCP_KEEPINTVL', None),
+                self.keepintvl, False),
+            ('keepcnt', tcp, getattr(socket, 'TCP_KEEPCNT', None),
+                self.keepcnt, False),
+            ('defer_accept', tcp, _TCP_DEFER_ACCEPT if _LINUX else None,
+                self.defer_accept, True),
+            ('fastopen', tcp, _TCP_FASTOPEN if _LINUX else None,
+                self.fastopen, True),
+        ]
+        for name, level, opt, value, before_listen in opts:
+            if value is not None and opt is not None:
+                yield (name, level, opt, value, before_listen)
+
+    def apply_listener(self, sock, before_listen):
+        """
+        Set the options on a tcp listening socket.  This is called twice
+        by the bind, once before listen() and once after
+
+        sock:socket.socket      The bound socket
+        before_listen:bool      Whether listen() has been called yet
+        """
+        for name, level, opt, value, pre in self._options():
+            if pre != before_listen:
+                continue
+            try:
+                sock.setsockopt(level, opt, value)
+            except (OSError, socket.error):
+                pass
+
+    def apply_buffers(self, sock):
+        """
+        Set only the buffer sizes, for udp and unix sockets
+        """
+        for name, level, opt, value, pre in self._options():
+            if level == socket.SOL_SOCKET and name != 'keepalive':
+                try:
+                    sock.setsockopt(level, opt, value)
+                except (OSError, socket.error):
+                    pass
+
+    def apply_conn(self, conn):
+        """
+        Set the options on an accepted connection.  On Linux, everything
+        but TCP_QUICKACK was already copied from the listener
+        """
+        if self.quickack and _LINUX:
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, _TCP_QUICKACK, 1)
+            except (OSError, socket.error):
+                pass
+        if _LINUX:
+            return
+        for name, level, opt, value, pre in self._options():
+            if not pre:
+                try:
+                    conn.setsockopt(level, opt, value)
+                except (OSError, socket.error):
+                    pass
+
+    def effective(self, sock):
+        """
+        Read back what the kernel actually has for each option in the
+        profile.  Returns a dict of name to value.  Note that Linux
+        doubles the buffer sizes it is given
+        """
+        ret = {}
+        for name, level, opt, value, pre in self._options():
+            try:
+                ret[name] = sock.getsockopt(level, opt)
+            except (OSError, socket.error):
+                ret[name] = None
+        return ret
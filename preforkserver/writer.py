@@ -0,0 +1,175 @@
+#
+#    Author: Jay Deiman
+#    Email: admin@splitstreams.com
+#
+#    This file is part of py-prefork-server.
+#
+#    py-prefork-server is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    py-prefork-server is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with py-prefork-server.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# A coalescing response writer.  For tcp, each accepted connection gets
+# one as self.writer.  Writes are queued as a list of buffers, without
+# concatenating them, and go out together with sendmsg() once the queue
+# gets over buffer_size or on flush().  The child flushes the writer
+# before it closes the connection.
+#
+#     def process_request(self):
+#         self.writer.write(b'HTTP/1.1 200 OK\r\n')
+#         self.writer.write(headers)
+#         with open(path, 'rb') as fh:
+#             self.writer.sendfile(fh)
+#
+# File bodies go out with sendfile(), which means os.sendfile() on a
+# plain socket.  If cork is set, TCP_CORK is held on the socket for the
+# length of the response so that the headers and body are packed into
+# full segments.
+#
+
+import socket
+
+__all__ = ['ResponseWriter']
+
+# The most buffers passed to a single sendmsg() call.  This is IOV_MAX on
+# Linux
+_MAX_IOV = 1024
+
+
+class ResponseWriter(object):
+    """
+    Buffers writes to a connected socket and sends them with as few
+    system calls as possible
+    """
+
+    def __init__(self, sock, buffer_size=16384, cork=False, vectored=True):
+        """
+        sock:socket.socket      The connection, or anything wrapping it
+        buffer_size:int         Flush once this many bytes are queued
+        cork:bool               Hold TCP_CORK on the socket while there
+                                is a response in progress
+        vectored:bool           Use sendmsg().  Turn this off for sockets
+                                that can't do it, like an ssl.SSLSocket
+        """
+        self._sock = sock
+        self.buffer_size = int(buffer_size)
+        self._cork = cork and hasattr(socket, 'TCP_CORK')
+        self._corked = False
+        self._bufs = []
+        self._pending = 0
+        self.bytes_sent = 0
+        self._vectored = vectored and hasattr(sock, 'sendmsg')
+
+    @property
+    def pending(self):
+        """
+        The number of bytes queued and not sent yet
+        """
+        return self._pending
+
+    def _set_cork(self, on):
+        if not self._cork or self._corked == on:
+            return
+        try:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK,
+                1 if on else 0)
+        except socket.error:
+            # Not a tcp socket.  Don't try again
+            self._cork = False
+            return
+        self._corked = on
+
+    def write(self, data):
+        """
+        Queue data to be sent.  Nothing is copied; data must not be
+        changed until it has been flushed
+
+        data:bytes      A bytes-like object, or a str which will be
+                        encoded as utf-8
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data:
+            return
+        self._set_cork(True)
+        self._bufs.append(data)
+        self._pending += len(data)
+        if self._pending >= self.buffer_size:
+            self._send_queued()
+
+    def writev(self, buffers):
+        """
+        Queue a list of buffers.  See write()
+        """
+        for data in buffers:
+            self.write(data)
+
+    def sendfile(self, fh, offset=0, count=None):
+        """
+        Send count bytes, or to the end, of the open file fh starting at
+        offset.  Anything queued goes out first.  Returns the number of
+        bytes sent from the file
+
+        fh:file         A regular file opened in binary mode
+        offset:int      Where in the file to start
+        count:int       The number of bytes to send, or None for the
+                        whole file
+        """
+        self._set_cork(True)
+        self._send_queued()
+        sent = self._sock.sendfile(fh, offset, count)
+        self.bytes_sent += sent
+        return sent
+
+    def _send_queued(self):
+        bufs = self._bufs
+        if not bufs:
+            return
+        if len(bufs) == 1:
+            self._sock.sendall(bufs[0])
+            self.bytes_sent += self._pending
+        elif not self._vectored:
+            # Without sendmsg(), one copy beats a send (and for TLS, a
+            # record) per buffer
+            self._sock.sendall(b''.join(bufs))
+            self.bytes_sent += self._pending
+        else:
+            while bufs:
+                sent = self._sock.sendmsg(bufs[:_MAX_IOV])
+                self.bytes_sent += sent
+                # Drop whatever went out and trim a partially sent buffer
+                while sent:
+                    size = len(bufs[0])
+                    if sent < size:
+                        bufs[0] = memoryview(bufs[0])[sent:]
+                        break
+                    sent -= size
+                    del bufs[0]
+        self._bufs = []
+        self._pending = 0
+
+    def flush(self):
+        """
+        Send everything queued and, if corked, push out the final
+        partial segment
+        """
+        self._send_queued()
+        self._set_cork(False)
+
+    def reset(self):
+        """
+        Discard anything still queued
+        """
+        self._bufs = []
+        self._pending = 0
+        self._corked = False